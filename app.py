@@ -16,8 +16,11 @@ import plotly.express as px
 import plotly.graph_objects as go
 from datetime import datetime, timedelta
 import database as db
+import previews
+import text_extraction
 import io
 import base64
+import html
 
 # Page configuration
 st.set_page_config(
@@ -60,6 +63,14 @@ st.markdown("""
         color: #94a3b8 !important;
     }
     
+    /* Search match highlighting */
+    mark {
+        background: #0d948840;
+        color: #5eead4;
+        padding: 0 2px;
+        border-radius: 3px;
+    }
+    
     /* Custom card styling */
     .metric-card {
         background: linear-gradient(135deg, #1e293b 0%, #334155 100%);
@@ -120,6 +131,26 @@ st.markdown("""
         font-size: 0.85rem;
     }
     
+    .doc-preview {
+        display: block;
+        max-width: 100%;
+        max-height: 160px;
+        border-radius: 8px;
+        margin-bottom: 10px;
+    }
+    
+    .doc-preview-text {
+        color: #cbd5e1;
+        background: #0f172a;
+        border-left: 3px solid #334155;
+        border-radius: 6px;
+        padding: 8px 10px;
+        margin-bottom: 10px;
+        font-size: 0.75rem;
+        max-height: 96px;
+        overflow: hidden;
+    }
+    
     .category-badge {
         display: inline-block;
         padding: 4px 12px;
@@ -270,6 +301,23 @@ def format_file_size(size_bytes):
     return f"{size_bytes:.1f} TB"
 
 
+def format_count(count):
+    """Format a document count, marking counts that stopped at the estimate cap"""
+    return f"{count:,}+" if count >= db.COUNT_ESTIMATE_CAP else f"{count:,}"
+
+
+def format_preview(doc):
+    """Return the HTML of a document's cached preview, or an empty string while there is none"""
+    preview = previews.get_preview(doc)
+    if preview is None or not preview[1]:
+        return ''
+    kind, data = preview
+    if kind == 'image':
+        return (f'<img class="doc-preview" alt="Preview of {html.escape(doc["title"])}" '
+                f'src="data:image/jpeg;base64,{base64.b64encode(data).decode()}">')
+    return f'<div class="doc-preview-text">{html.escape(data.decode("utf-8"))}</div>'
+
+
 def get_file_icon(file_type):
     """Get icon based on file type"""
     icons = {
@@ -290,6 +338,109 @@ def get_file_icon(file_type):
     return icons.get(file_type.lower() if file_type else '', '📄')
 
 
+def format_highlight(text):
+    """Escape search highlight text and mark the matched terms"""
+    escaped = html.escape(text or '')
+    return escaped.replace(db.HIGHLIGHT_START, '<mark>').replace(db.HIGHLIGHT_END, '</mark>')
+
+
+def record_view(doc, key):
+    """Toggle callback logging a view when a document's preview is opened"""
+    if st.session_state.get(key):
+        db.log_view(doc['id'], doc['title'], "Admin", details=f"Previewed {doc['file_name']}")
+
+
+def render_document_preview(doc):
+    """Render a toggle that shows the document's preview and logs the view"""
+    key = f"preview_{doc['id']}"
+    if not st.toggle("👁️ Preview", key=key, on_change=record_view, args=(doc, key)):
+        return
+    preview = format_preview(doc)
+    if preview:
+        st.markdown(preview, unsafe_allow_html=True)
+    elif (doc['file_type'] or '').lower() in previews.PREVIEW_FILE_TYPES:
+        st.caption("The preview is being prepared; download the file to open it now")
+    else:
+        st.caption("No preview for this file type; download the file to open it")
+
+
+def finish_download(doc, file_name, version):
+    """Record a download and release the prepared file"""
+    db.log_download(doc['id'], doc['title'], file_name, "Admin", version=version)
+    st.session_state.pop('download_request', None)
+
+
+def render_download(doc, key_prefix, version=None):
+    """Render a download control that only reads the file once it is requested"""
+    item = version if version is not None else doc
+    if not item['has_file']:
+        return
+    
+    # Keyed by document and version so only the requested file is read and sent
+    version_number = version['version'] if version is not None else None
+    key = f"{key_prefix}_{doc['id']}_{version_number or 'current'}"
+    if st.session_state.get('download_request') == key:
+        open_data = db.open_version_data if version is not None else db.open_document_data
+        try:
+            reader = open_data(item['id'])
+        except FileNotFoundError:
+            reader = None
+        if reader is None:
+            # Deleted meanwhile, or its stored file is missing
+            st.error(f"The file {item['file_name']} is no longer available")
+            return
+        with reader:
+            st.download_button(
+                label="📥 Download",
+                data=reader,
+                file_name=item['file_name'],
+                mime="application/octet-stream",
+                key=key,
+                on_click=finish_download,
+                args=(doc, item['file_name'], version_number)
+            )
+    elif st.button("📥 Prepare Download", key=f"prepare_{key}"):
+        st.session_state['download_request'] = key
+        st.rerun()
+
+
+def get_page_cursor(key, filters):
+    """Return the keyset cursor of the page being viewed, starting over when the filters change"""
+    state = st.session_state.setdefault(key, {'filters': None, 'cursors': [None]})
+    if state['filters'] != filters:
+        state['filters'] = filters
+        state['cursors'] = [None]
+    return state['cursors'][-1]
+
+
+def render_pagination(key, rows, total, order, page_size=db.DOCUMENT_PAGE_SIZE):
+    """Render previous/next controls; rows holds one extra row when a next page exists"""
+    cursors = st.session_state[key]['cursors']
+    page = len(cursors)
+    has_next = len(rows) > page_size
+    if page == 1 and not has_next:
+        return
+    
+    first = (page - 1) * page_size + 1
+    last = first + min(len(rows), page_size) - 1
+    position = f"{first:,}–{last:,}" + (f" of {format_count(total)}" if total is not None else "")
+    col1, col2, col3 = st.columns([1, 2, 1])
+    
+    with col1:
+        st.button("← Previous", key=f"{key}_prev", disabled=page == 1,
+                  on_click=cursors.pop, use_container_width=True)
+    
+    with col2:
+        st.markdown(f"<div style='text-align: center; color: #94a3b8;'>Page {page} • {position}</div>",
+                    unsafe_allow_html=True)
+    
+    with col3:
+        if has_next:
+            next_cursor = db.page_cursor(rows[page_size - 1], order)
+            st.button("Next →", key=f"{key}_next", on_click=cursors.append,
+                      args=(next_cursor,), use_container_width=True)
+
+
 def render_header():
     """Render the application header"""
     st.markdown("""
@@ -454,27 +605,19 @@ def render_dashboard():
     with col2:
         st.markdown("### ⏰ Upcoming Deadlines")
         
-        expiring = db.get_expiring_documents(30)
-        review_due = db.get_documents_for_review(30)
+        upcoming = db.get_deadlines(start_date=datetime.now().date(),
+                                    end_date=(datetime.now() + timedelta(days=30)).date(), limit=10)
         
-        if expiring or review_due:
+        if upcoming:
             # Timeline chart
             deadlines = []
             
-            for doc in expiring[:5]:
-                deadlines.append({
-                    'Document': doc['title'][:30] + '...' if len(doc['title']) > 30 else doc['title'],
-                    'Date': doc['expiry_date'],
-                    'Type': 'Expiry',
-                    'Color': '#ef4444'
-                })
-            
-            for doc in review_due[:5]:
+            for doc in upcoming:
                 deadlines.append({
                     'Document': doc['title'][:30] + '...' if len(doc['title']) > 30 else doc['title'],
-                    'Date': doc['review_date'],
-                    'Type': 'Review',
-                    'Color': '#f59e0b'
+                    'Date': doc['due_date'],
+                    'Type': 'Expiry' if doc['kind'] == 'expiry' else 'Review',
+                    'Color': '#ef4444' if doc['kind'] == 'expiry' else '#f59e0b'
                 })
             
             if deadlines:
@@ -505,7 +648,7 @@ def render_dashboard():
     # Recent documents
     st.markdown("### 📄 Recent Documents")
     
-    recent_docs = db.get_all_documents()[:6]
+    recent_docs = db.get_all_documents(limit=6)
     
     if recent_docs:
         cols = st.columns(3)
@@ -513,7 +656,7 @@ def render_dashboard():
             with cols[i % 3]:
                 file_icon = get_file_icon(doc['file_type'])
                 st.markdown(f"""
-                <div class="doc-card">
+                <div class="doc-card">{format_preview(doc)}
                     <div class="doc-title">{file_icon} {doc['title']}</div>
                     <div class="doc-meta">
                         <span class="category-badge" style="background: {doc['category_color']}20; color: {doc['category_color']};">
@@ -563,6 +706,14 @@ def render_dashboard():
         st.info("No activity recorded yet")
 
 
+# Sort options of the documents listing and their database orderings
+SORT_ORDERS = {
+    "Newest First": 'newest',
+    "Oldest First": 'oldest',
+    "Name A-Z": 'title',
+}
+
+
 def render_documents():
     """Render the documents listing page"""
     st.markdown("## 📄 All Documents")
@@ -580,16 +731,24 @@ def render_documents():
         selected_category = st.selectbox("📁 Filter by Category", list(category_options.keys()))
     
     with col3:
-        sort_option = st.selectbox("Sort by", ["Newest First", "Oldest First", "Name A-Z"])
+        sort_option = st.selectbox("Sort by", list(SORT_ORDERS.keys()))
     
-    # Get documents
+    # Get one page of documents, plus one row to tell whether another page follows
     category_id = category_options.get(selected_category)
-    documents = db.get_all_documents(category_id=category_id, search_term=search_term if search_term else None)
+    search_term = search_term if search_term else None
+    order = SORT_ORDERS[sort_option]
+    after = get_page_cursor('documents_page', (search_term, category_id, order))
+    documents = db.get_all_documents(category_id=category_id, search_term=search_term,
+                                     limit=db.DOCUMENT_PAGE_SIZE + 1, after=after, order=order)
+    total = db.count_documents(category_id=category_id, search_term=search_term)
     
     if documents:
-        st.markdown(f"**Found {len(documents)} documents**")
+        st.markdown(f"**Found {format_count(total)} documents**")
+        
+        page = documents[:db.DOCUMENT_PAGE_SIZE]
+        version_summaries = db.get_version_summaries(tuple(doc['id'] for doc in page))
         
-        for doc in documents:
+        for doc in page:
             file_icon = get_file_icon(doc['file_type'])
             
             with st.expander(f"{file_icon} {doc['title']}", expanded=False):
@@ -614,22 +773,28 @@ def render_documents():
                         st.markdown(f"**Expiry Date:** {doc['expiry_date']}")
                     if doc['review_date']:
                         st.markdown(f"**Review Date:** {doc['review_date']}")
+                    
+                    render_document_preview(doc)
                 
                 with col2:
                     # Download button
-                    if doc['file_data']:
-                        st.download_button(
-                            label="📥 Download",
-                            data=doc['file_data'],
-                            file_name=doc['file_name'],
-                            mime="application/octet-stream",
-                            key=f"download_{doc['id']}"
-                        )
+                    render_download(doc, "download")
                     
                     # View versions
-                    versions = db.get_document_versions(doc['id'])
+                    versions = version_summaries.get(doc['id'])
                     if versions:
-                        st.markdown(f"**Version History:** {len(versions)} previous versions")
+                        st.markdown(f"**Version History:** {versions['version_count']} previous versions "
+                                    f"(latest v{versions['latest_version']}, "
+                                    f"{versions['latest_created_at'][:10] if versions['latest_created_at'] else 'unknown date'})")
+                        
+                        # Earlier versions are only listed for the document the user opens
+                        if st.toggle("Show versions", key=f"versions_{doc['id']}"):
+                            for version in db.get_document_versions(doc['id']):
+                                st.markdown(f"v{version['version']} • {version['file_name']} • "
+                                            f"{version['created_at'][:10] if version['created_at'] else 'Unknown'}")
+                                render_download(doc, "version_download", version=version)
+                    
+                    render_new_version(doc)
                     
                     # Delete button
                     if st.button("🗑️ Delete", key=f"delete_{doc['id']}"):
@@ -638,6 +803,40 @@ def render_documents():
                         st.rerun()
     else:
         st.info("No documents found matching your criteria")
+    
+    render_pagination('documents_page', documents, total, order)
+
+
+# File extensions accepted for new documents and new versions
+UPLOAD_FILE_TYPES = ['pdf', 'doc', 'docx', 'xls', 'xlsx', 'ppt', 'pptx', 'txt', 'csv', 'jpg', 'jpeg', 'png', 'gif']
+
+
+def render_new_version(doc):
+    """Render the form that replaces a document's file with a new version"""
+    if not st.toggle("Upload new version", key=f"new_version_{doc['id']}"):
+        return
+    
+    with st.form(f"new_version_form_{doc['id']}", clear_on_submit=True):
+        uploaded_file = st.file_uploader("📎 New file", type=UPLOAD_FILE_TYPES)
+        changes_summary = st.text_input("📝 What changed?", placeholder="e.g., Updated emergency contacts")
+        
+        if st.form_submit_button("🔄 Upload Version", use_container_width=True):
+            if not uploaded_file:
+                st.error("Please select a file to upload")
+            else:
+                # The previous file is kept as a compressed earlier version
+                uploaded_file.seek(0)
+                file_name = uploaded_file.name
+                version = db.add_document_version(
+                    doc['id'],
+                    file_name=file_name,
+                    file_type=file_name.split('.')[-1] if '.' in file_name else '',
+                    file_size=uploaded_file.size,
+                    file_data=uploaded_file,
+                    uploaded_by="Admin",
+                    changes_summary=changes_summary or None
+                )
+                st.success(f"✅ Version {version} uploaded")
 
 
 def render_upload():
@@ -665,7 +864,7 @@ def render_upload():
         
         uploaded_file = st.file_uploader(
             "📎 Choose file to upload",
-            type=['pdf', 'doc', 'docx', 'xls', 'xlsx', 'ppt', 'pptx', 'txt', 'csv', 'jpg', 'jpeg', 'png', 'gif'],
+            type=UPLOAD_FILE_TYPES,
             help="Supported formats: PDF, Word, Excel, PowerPoint, Text, CSV, Images"
         )
         
@@ -677,11 +876,11 @@ def render_upload():
             elif not uploaded_file:
                 st.error("Please select a file to upload")
             else:
-                # Process upload
-                file_data = uploaded_file.read()
+                # Process upload - the file is streamed into storage in chunks
+                uploaded_file.seek(0)
                 file_name = uploaded_file.name
                 file_type = file_name.split('.')[-1] if '.' in file_name else ''
-                file_size = len(file_data)
+                file_size = uploaded_file.size
                 
                 # Parse tags
                 tag_list = [t.strip() for t in tags.split(',')] if tags else None
@@ -694,7 +893,7 @@ def render_upload():
                     file_name=file_name,
                     file_type=file_type,
                     file_size=file_size,
-                    file_data=file_data,
+                    file_data=uploaded_file,
                     uploaded_by="Admin",
                     review_date=str(review_date) if review_date else None,
                     expiry_date=str(expiry_date) if expiry_date else None,
@@ -705,6 +904,68 @@ def render_upload():
                 st.balloons()
 
 
+# Advanced Search date range options and how many days back each reaches
+SEARCH_DATE_RANGES = {
+    "Any Time": None,
+    "Last 7 Days": 7,
+    "Last 30 Days": 30,
+    "Last Year": 365,
+}
+
+
+def render_tag_cloud(tag_counts):
+    """Render tags sized by how many documents carry them"""
+    most = max(tag_counts.values())
+    badges = ' '.join(
+        f'<span class="category-badge" style="background: #14b8a620; color: #2dd4bf; '
+        f'font-size: {0.75 + 0.5 * count / most:.2f}rem;">{html.escape(tag)} · {count}</span>'
+        for tag, count in sorted(tag_counts.items())
+    )
+    st.markdown(f'<div style="line-height: 2.2; margin-bottom: 0.5rem;">{badges}</div>', unsafe_allow_html=True)
+
+
+# Result facets shown on the search page, their titles and the values listed of each
+SEARCH_FACETS = {
+    'category': "Category",
+    'file_type': "File Type",
+    'department': "Department",
+    'year': "Year",
+}
+SEARCH_FACET_VALUES = 5
+
+
+def set_search_facet(facet, value, label):
+    """Button callback narrowing the search to one facet value, or clearing it with value None"""
+    if facet == 'category':
+        st.session_state['search_category'] = label if value is not None else 'All Categories'
+    elif facet == 'file_type':
+        st.session_state['search_file_type'] = label if value is not None else 'All Types'
+    else:
+        st.session_state['search_facet_filters'][facet] = value
+
+
+def render_search_facets(facets, category_options):
+    """Render hit counts per facet value as buttons that filter the results"""
+    active = {
+        'category': st.session_state.get('search_category', 'All Categories') != 'All Categories',
+        'file_type': st.session_state.get('search_file_type', 'All Types') != 'All Types',
+        **{facet: bool(st.session_state['search_facet_filters'].get(facet)) for facet in ('department', 'year')},
+    }
+    columns = st.columns(len(SEARCH_FACETS))
+    for column, (facet, title) in zip(columns, SEARCH_FACETS.items()):
+        with column:
+            st.markdown(f"**{title}**")
+            if active[facet]:
+                st.button("✕ Clear", key=f"facet_clear_{facet}", on_click=set_search_facet, args=(facet, None, None))
+            for value, label, count in facets[facet][:SEARCH_FACET_VALUES]:
+                # Values without a matching filter are listed but not clickable
+                clickable = value is not None and not active[facet] and (facet != 'category' or label in category_options)
+                st.button(f"{label} ({format_count(count)})", key=f"facet_{facet}_{value}", disabled=not clickable,
+                          on_click=set_search_facet, args=(facet, value, label), use_container_width=True)
+    if not facets['complete']:
+        st.caption(f"Facet counts cover the first {db.COUNT_ESTIMATE_CAP:,} matches")
+
+
 def render_search():
     """Render the search page"""
     st.markdown("## 🔍 Advanced Search")
@@ -729,31 +990,90 @@ def render_search():
             categories = db.get_categories()
             category_options = {cat['name']: cat['id'] for cat in categories}
             category_options = {'All Categories': None, **category_options}
-            selected_category = st.selectbox("Category", list(category_options.keys()))
+            selected_category = st.selectbox("Category", list(category_options.keys()), key="search_category")
         
         with col2:
-            date_range = st.selectbox("Date Range", ["Any Time", "Last 7 Days", "Last 30 Days", "Last Year"])
+            date_range = st.selectbox("Date Range", list(SEARCH_DATE_RANGES))
         
         with col3:
-            file_type = st.selectbox("File Type", ["All Types", "PDF", "Word", "Excel", "Images"])
-    
-    if search_query or search_btn:
+            file_type = st.selectbox("File Type", ["All Types", *db.FILE_TYPE_GROUPS], key="search_file_type")
+        
+        # Most used tags in the chosen category, from one grouped query
+        tag_counts = {row['name']: row['documents'] for row in db.get_tag_counts(category_options[selected_category])}
+        if tag_counts:
+            render_tag_cloud(tag_counts)
+            col1, col2 = st.columns([3, 1])
+            with col1:
+                selected_tags = st.multiselect("Tags", list(tag_counts),
+                                               format_func=lambda tag: f"{tag} ({tag_counts[tag]})")
+            with col2:
+                tag_match = st.radio("Match", ["All tags", "Any tag"], horizontal=True)
+        else:
+            selected_tags = []
+            tag_match = "All tags"
+    
+    # Applied by the database in the same query as the search
+    filters = db.DocumentFilter(file_types=None if file_type == "All Types" else file_type)
+    if selected_tags:
+        filters = filters.where(**{'tags_all' if tag_match == "All tags" else 'tags_any': selected_tags})
+    # Department and year are chosen from the result facets
+    facet_filters = st.session_state.setdefault('search_facet_filters', {})
+    if facet_filters.get('department'):
+        filters = filters.where(department=facet_filters['department'])
+    if SEARCH_DATE_RANGES[date_range] is not None:
+        filters = filters.where(created_from=datetime.now().date() - timedelta(days=SEARCH_DATE_RANGES[date_range]))
+    if facet_filters.get('year'):
+        # Intersected with the date range, which may start later in the year
+        year_start = f"{facet_filters['year']}-01-01"
+        filters = filters.where(created_from=max(filters.get('created_from') or year_start, year_start),
+                                created_to=f"{facet_filters['year']}-12-31")
+    
+    # Searching with an empty query lists everything, and keeps doing so
+    # while the user pages through the results
+    if search_btn:
+        st.session_state['search_submitted'] = True
+    
+    if search_query or st.session_state.get('search_submitted'):
         category_id = category_options.get(selected_category)
-        results = db.get_all_documents(category_id=category_id, search_term=search_query)
+        if db.build_search_query(search_query):
+            # Ranked by relevance, with matched terms highlighted
+            order = 'rank'
+            after = get_page_cursor('search_page', (search_query, category_id, filters))
+            results = db.search_documents(search_query, category_id=category_id,
+                                          limit=db.DOCUMENT_PAGE_SIZE + 1, after=after, filters=filters)
+            total = db.count_documents(category_id=category_id, search_term=search_query, filters=filters)
+        else:
+            order = 'newest'
+            after = get_page_cursor('search_page', (None, category_id, filters))
+            results = db.get_all_documents(category_id=category_id, limit=db.DOCUMENT_PAGE_SIZE + 1, after=after,
+                                           filters=filters)
+            total = db.count_documents(category_id=category_id, filters=filters)
         
-        st.markdown(f"### Found {len(results)} results")
+        st.markdown(f"### Found {format_count(total)} results")
+        render_search_facets(db.get_search_facets(category_id=category_id, search_term=search_query, filters=filters),
+                             category_options)
         
-        for doc in results:
+        for doc in results[:db.DOCUMENT_PAGE_SIZE]:
             file_icon = get_file_icon(doc['file_type'])
             
+            if 'snippet' in doc.keys():
+                title = format_highlight(doc['title_highlight'])
+                # Show where the file contents matched when the description did not
+                if db.HIGHLIGHT_START not in (doc['snippet'] or '') and doc['content_snippet']:
+                    summary = format_highlight(doc['content_snippet'])
+                else:
+                    summary = format_highlight(doc['snippet'])
+            else:
+                title = html.escape(doc['title'])
+                summary = doc['description'][:100] + '...' if doc['description'] and len(doc['description']) > 100 else doc['description'] or ''
+            
             st.markdown(f"""
-            <div class="doc-card">
-                <div class="doc-title">{file_icon} {doc['title']}</div>
+            <div class="doc-card">{format_preview(doc)}
+                <div class="doc-title">{file_icon} {title}</div>
                 <div class="doc-meta">
                     <span class="category-badge" style="background: {doc['category_color']}20; color: {doc['category_color']};">
                         {doc['category_name'] or 'Uncategorized'}
-                    </span>
-                    {doc['description'][:100] + '...' if doc['description'] and len(doc['description']) > 100 else doc['description'] or ''}
+                    </span> {summary}
                     <br><br>
                     📅 {doc['created_at'][:10] if doc['created_at'] else 'Unknown'} • 
                     📦 {format_file_size(doc['file_size'])} •
@@ -762,20 +1082,26 @@ def render_search():
             </div>
             """, unsafe_allow_html=True)
             
-            if doc['file_data']:
-                st.download_button(
-                    label="📥 Download",
-                    data=doc['file_data'],
-                    file_name=doc['file_name'],
-                    mime="application/octet-stream",
-                    key=f"search_download_{doc['id']}"
-                )
+            render_download(doc, "search_download")
+        
+        render_pagination('search_page', results, total, order)
+
+
+def render_deadline_counts(kind, overdue_label):
+    """Render overdue and urgency-window counts for one kind of deadline"""
+    counts = db.get_deadline_counts()[kind]
+    columns = st.columns(1 + len(db.DEADLINE_URGENCY_DAYS))
+    columns[0].metric(overdue_label, counts['overdue'])
+    for column, days in zip(columns[1:], db.DEADLINE_URGENCY_DAYS):
+        column.metric(f"Within {days} Days", counts[f'within_{days}'])
 
 
 def render_expiring():
     """Render expiring documents page"""
     st.markdown("## ⚠️ Documents Expiring Soon")
     
+    render_deadline_counts('expiry', "Already Expired")
+    
     days = st.slider("Show documents expiring within:", 7, 90, 30, 7)
     
     expiring_docs = db.get_expiring_documents(days)
@@ -813,6 +1139,8 @@ def render_review():
     """Render documents due for review"""
     st.markdown("## 📋 Documents Due for Review")
     
+    render_deadline_counts('review', "Overdue")
+    
     days = st.slider("Show documents due for review within:", 7, 90, 30, 7)
     
     review_docs = db.get_documents_for_review(days)
@@ -855,6 +1183,87 @@ def render_review():
         st.success("✅ No documents due for review within the selected timeframe")
 
 
+# Analytics time ranges: label -> (days back, or None for all time, and the bucket each point covers)
+ANALYTICS_RANGES = {
+    "Last 3 Months": (91, 'week'),
+    "Last Year": (365, 'week'),
+    "Last 3 Years": (3 * 365, 'month'),
+    "All Time": (None, 'month'),
+}
+
+
+def style_chart(fig):
+    """Apply the dark theme used by every Analytics chart"""
+    fig.update_layout(
+        paper_bgcolor='rgba(0,0,0,0)',
+        plot_bgcolor='rgba(0,0,0,0)',
+        font_color='#94a3b8',
+        xaxis=dict(showgrid=False),
+        yaxis=dict(showgrid=True, gridcolor='#334155'),
+        legend_title_text=''
+    )
+    return fig
+
+
+def render_analytics_trends():
+    """Render upload, storage, activity and compliance time series from the daily rollups"""
+    st.markdown("### 📅 Trends")
+    days, period = ANALYTICS_RANGES[st.selectbox("Period", list(ANALYTICS_RANGES), index=1)]
+    start_date = (datetime.now() - timedelta(days=days)).date() if days else None
+    category_names = {cat['id']: cat['name'] for cat in db.get_categories()}
+    
+    col1, col2 = st.columns(2)
+    with col1:
+        st.markdown("#### Uploads")
+        uploads = db.get_upload_series(period, group_by='category', start_date=start_date)
+        if uploads:
+            df = pd.DataFrame([{'Period': row['period'], 'Category': category_names.get(row['grp'], 'Uncategorized'),
+                                'Documents': row['documents']} for row in uploads])
+            st.plotly_chart(style_chart(px.bar(df, x='Period', y='Documents', color='Category')),
+                            use_container_width=True)
+        else:
+            st.info("No uploads in this period")
+    
+    with col2:
+        st.markdown("#### Storage Growth")
+        storage = db.get_storage_series(period, start_date=start_date)
+        if storage:
+            df = pd.DataFrame([{'Period': row['period'], 'Size (MB)': row['bytes'] / (1024 * 1024),
+                                'Documents': row['documents']} for row in storage])
+            fig = px.area(df, x='Period', y='Size (MB)', hover_data=['Documents'],
+                          color_discrete_sequence=['#2dd4bf'])
+            st.plotly_chart(style_chart(fig), use_container_width=True)
+        else:
+            st.info("No stored documents yet")
+    
+    col1, col2 = st.columns(2)
+    with col1:
+        st.markdown("#### Activity by Department")
+        activity = db.get_activity_series(period, group_by='department', start_date=start_date)
+        if activity:
+            df = pd.DataFrame([{'Period': row['period'], 'Department': row['grp'] or 'No department',
+                                'Events': row['events']} for row in activity])
+            st.plotly_chart(style_chart(px.line(df, x='Period', y='Events', color='Department', markers=True)),
+                            use_container_width=True)
+        else:
+            st.info("No activity in this period")
+    
+    with col2:
+        st.markdown("#### Review Compliance")
+        compliance = db.get_compliance_series(start_date=start_date)
+        if compliance:
+            df = pd.DataFrame([{'Day': row['day'],
+                                'Reviews on time': row['review_rate'] * 100 if row['review_rate'] is not None else None,
+                                'Not expired': row['expiry_rate'] * 100 if row['expiry_rate'] is not None else None}
+                               for row in compliance])
+            fig = px.line(df, x='Day', y=['Reviews on time', 'Not expired'],
+                          color_discrete_sequence=['#2dd4bf', '#f59e0b'])
+            fig.update_yaxes(title_text='%', range=[0, 100])
+            st.plotly_chart(style_chart(fig), use_container_width=True)
+        else:
+            st.info("Compliance is recorded once a day from today")
+
+
 def render_analytics():
     """Render analytics page"""
     st.markdown("## 📊 Document Analytics")
@@ -866,7 +1275,10 @@ def render_analytics():
     
     with col1:
         st.markdown("### 💾 Storage Overview")
-        st.metric("Total Storage Used", format_file_size(stats['total_size']))
+        st.metric("Total Storage Used", format_file_size(stats['stored_size']),
+                  help="Bytes on disk after compression, deduplication and version chunking")
+        st.metric("Original File Size", format_file_size(stats['total_size']),
+                  help="Combined size of the current files as uploaded")
         st.metric("Total Documents", stats['total_documents'])
     
     with col2:
@@ -898,23 +1310,95 @@ def render_analytics():
             yaxis=dict(showgrid=True, gridcolor='#334155')
         )
         st.plotly_chart(fig, use_container_width=True)
+    
+    render_analytics_trends()
+    
+    # Space used by earlier versions
+    st.markdown("### 🗂️ Version Storage")
+    
+    version_stats = db.get_version_storage_stats()
+    if version_stats:
+        version_bytes = sum(row['version_bytes'] for row in version_stats)
+        stored_bytes = sum(row['stored_bytes'] for row in version_stats)
+        
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            st.metric("Earlier Versions", sum(row['versions'] for row in version_stats))
+        with col2:
+            st.metric("Full Size", format_file_size(version_bytes))
+        with col3:
+            st.metric("Stored Size", format_file_size(stored_bytes),
+                      delta=f"-{1 - stored_bytes / version_bytes:.0%}" if version_bytes else None,
+                      delta_color="inverse")
+        
+        st.dataframe(
+            pd.DataFrame([{
+                'Document': row['title'],
+                'Versions': row['versions'],
+                'Full Size': format_file_size(row['version_bytes']),
+                'Stored Size': format_file_size(row['stored_bytes']),
+                'Saved': f"{1 - row['stored_bytes'] / row['version_bytes']:.0%}" if row['version_bytes'] else '—'
+            } for row in version_stats]),
+            use_container_width=True,
+            hide_index=True
+        )
+    else:
+        st.info("No documents have earlier versions yet")
+
+
+# Activity Log action filter options and their logged action names
+ACTIVITY_ACTIONS = {
+    "All Actions": None,
+    "Uploads": 'upload',
+    "New Versions": 'new_version',
+    "Downloads": 'download',
+    "Views": 'view',
+    "Deletions": 'delete',
+}
 
 
 def render_activity():
     """Render activity log"""
     st.markdown("## 📝 Activity Log")
     
-    activity = db.get_recent_activity(100)
+    # Filters narrow the audit trail through indexed queries; a date range
+    # reaching back past the live months also searches the monthly archives
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        user = st.text_input("User", placeholder="Any user")
+    with col2:
+        action = st.selectbox("Action", list(ACTIVITY_ACTIONS.keys()))
+    with col3:
+        document_id = st.number_input("Document ID", min_value=0, value=0, step=1, help="0 for any document")
+    
+    col1, col2 = st.columns(2)
+    with col1:
+        start_date = st.date_input("From", value=None, help="Search the full audit history, including archived months")
+    with col2:
+        end_date = st.date_input("To", value=None)
+    
+    filters = {
+        'start_date': start_date,
+        'end_date': end_date,
+        'user': user.strip() or None,
+        'action': ACTIVITY_ACTIONS[action],
+        'document_id': int(document_id) or None,
+    }
+    after = get_page_cursor('activity_page', filters)
+    activity = db.search_activity(**filters, limit=db.ACTIVITY_PAGE_SIZE + 1, after=after)
     
     if activity:
         # Convert to dataframe
-        df = pd.DataFrame([dict(row) for row in activity])
+        df = pd.DataFrame([dict(row) for row in activity[:db.ACTIVITY_PAGE_SIZE]])
         
         # Format the dataframe
-        df = df[['created_at', 'user', 'action', 'document_title', 'details']]
-        df.columns = ['Timestamp', 'User', 'Action', 'Document', 'Details']
+        df = df[['created_at', 'user', 'action', 'document_id', 'document_title', 'details']]
+        df.columns = ['Timestamp', 'User', 'Action', 'Document ID', 'Document', 'Details']
         
         st.dataframe(df, use_container_width=True, height=500)
+        render_pagination('activity_page', activity, None, 'activity', page_size=db.ACTIVITY_PAGE_SIZE)
+    elif any(value is not None for value in filters.values()):
+        st.info("No activity matches these filters")
     else:
         st.info("No activity recorded yet")
 
@@ -923,7 +1407,7 @@ def render_settings():
     """Render settings page"""
     st.markdown("## ⚙️ Settings")
     
-    tab1, tab2 = st.tabs(["📁 Categories", "ℹ️ About"])
+    tab1, tab2, tab3 = st.tabs(["📁 Categories", "⚙️ Background Jobs", "ℹ️ About"])
     
     with tab1:
         st.markdown("### Document Categories")
@@ -944,6 +1428,36 @@ def render_settings():
             """, unsafe_allow_html=True)
     
     with tab2:
+        st.markdown("### 📝 Text Extraction")
+        
+        extraction_stats = db.get_extraction_stats()
+        col1, col2, col3, col4 = st.columns(4)
+        col1.metric("Pending", extraction_stats.get('pending', {}).get('count', 0))
+        col2.metric("Extracted", extraction_stats.get('done', {}).get('count', 0))
+        col3.metric("Failed", extraction_stats.get('failed', {}).get('count', 0))
+        col4.metric("Unsupported", extraction_stats.get('unsupported', {}).get('count', 0))
+        
+        if extraction_stats:
+            df = pd.DataFrame(extraction_stats.values())
+            df = df[['status', 'count', 'avg_ms', 'max_ms', 'oldest_queued']]
+            df.columns = ['Status', 'Documents', 'Avg Time (ms)', 'Max Time (ms)', 'Oldest Queued']
+            st.dataframe(df, use_container_width=True, hide_index=True)
+        
+        st.markdown("### ⚡ Query Cache")
+        
+        cache_stats = db.get_cache_stats()
+        col1, col2, col3, col4 = st.columns(4)
+        col1.metric("Hit Rate", f"{cache_stats['hit_rate']:.0%}")
+        col2.metric("Hits", cache_stats['hits'])
+        col3.metric("Misses", cache_stats['misses'])
+        col4.metric("Cached Results", cache_stats['entries'])
+        st.caption(f"Invalidated by {cache_stats['invalidations']} writes since the server started")
+        
+        if st.button("🧹 Clear Cache"):
+            db.clear_query_cache()
+            st.rerun()
+    
+    with tab3:
         st.markdown("""
         ### About This System
         
@@ -976,6 +1490,10 @@ def main():
     """Main application entry point"""
     # Initialize database
     db.init_database()
+    db.start_garbage_collector()
+    db.start_activity_archiver()
+    text_extraction.start_pipeline()
+    previews.start_previews()
     
     # Render sidebar and get selected page
     page = render_sidebar()
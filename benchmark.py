@@ -0,0 +1,116 @@
+"""
+Query Benchmarks for Care Home Document Management System
+Builds throwaway databases of synthetic documents and times database queries
+against them. Run with: python benchmark.py [--rows 10000 100000 1000000]
+"""
+
+import argparse
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import database as db
+
+
+def legacy_dashboard_stats():
+    """The original five-query implementation of get_dashboard_stats"""
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        stats = {}
+        future_date = (datetime.now() + timedelta(days=30)).strftime('%Y-%m-%d')
+        week_ago = (datetime.now() - timedelta(days=7)).strftime('%Y-%m-%d')
+
+        cursor.execute("SELECT COUNT(*) FROM documents WHERE status = 'active'")
+        stats['total_documents'] = cursor.fetchone()[0]
+        cursor.execute("SELECT COUNT(*) FROM documents WHERE status = 'active' AND expiry_date IS NOT NULL AND expiry_date <= ?", (future_date,))
+        stats['expiring_soon'] = cursor.fetchone()[0]
+        cursor.execute("SELECT COUNT(*) FROM documents WHERE status = 'active' AND review_date IS NOT NULL AND review_date <= ?", (future_date,))
+        stats['due_for_review'] = cursor.fetchone()[0]
+        cursor.execute("SELECT COUNT(*) FROM documents WHERE status = 'active' AND created_at >= ?", (week_ago,))
+        stats['recent_uploads'] = cursor.fetchone()[0]
+        cursor.execute("SELECT SUM(file_size) FROM documents WHERE status = 'active'")
+        stats['total_size'] = cursor.fetchone()[0] or 0
+    return stats
+
+
+def populate(rows, batch_size=50000):
+    """Insert synthetic document metadata rows (no payloads)"""
+    now = datetime.now()
+    categories = [cat['id'] for cat in db.get_categories()]
+
+    def day(offset):
+        return (now + timedelta(days=offset)).strftime('%Y-%m-%d')
+
+    def document(i):
+        created = (now - timedelta(days=random.randint(0, 1500), seconds=random.randint(0, 86400)))
+        return (
+            f'Document {i}', 'Synthetic benchmark document', random.choice(categories),
+            f'document_{i}.pdf', 'pdf', random.randint(10_000, 5_000_000),
+            'deleted' if random.random() < 0.05 else 'active',
+            day(random.randint(-60, 365)) if random.random() < 0.7 else None,
+            day(random.randint(-30, 730)) if random.random() < 0.5 else None,
+            created.strftime('%Y-%m-%d %H:%M:%S'), created.strftime('%Y-%m-%d %H:%M:%S')
+        )
+
+    for start in range(0, rows, batch_size):
+        batch = [document(i) for i in range(start, min(start + batch_size, rows))]
+        with db.connection() as conn:
+            conn.executemany('''INSERT INTO documents (title, description, category_id, file_name, file_type,
+                                file_size, status, review_date, expiry_date, created_at, updated_at)
+                                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', batch)
+
+
+def time_call(func, repeat):
+    """Best-of-N wall time in milliseconds"""
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - started)
+    return best * 1000
+
+
+def bench_dashboard_stats(rows, repeat):
+    legacy = legacy_dashboard_stats()
+    summary = db.get_dashboard_stats.uncached()
+    assert legacy == {key: summary[key] for key in legacy}, (legacy, summary)
+    legacy_ms = time_call(legacy_dashboard_stats, repeat)
+    summary_ms = time_call(db.get_dashboard_stats.uncached, repeat)
+    print(f"{rows:>10,} rows | five queries {legacy_ms:9.2f} ms | summary table {summary_ms:9.2f} ms | "
+          f"{legacy_ms / summary_ms:7.1f}x")
+
+
+BENCHMARKS = {
+    'dashboard-stats': bench_dashboard_stats,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark database queries on synthetic data")
+    parser.add_argument("benchmarks", nargs="*", metavar="benchmark",
+                        help=f"Benchmarks to run (default: all of {', '.join(BENCHMARKS)})")
+    parser.add_argument("--rows", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"unknown benchmark: {', '.join(sorted(unknown))}")
+
+    for name in args.benchmarks or BENCHMARKS:
+        print(f"== {name}")
+        for rows in args.rows:
+            with tempfile.TemporaryDirectory() as workdir:
+                db.DATABASE_PATH = os.path.join(workdir, 'benchmark.db')
+                db.set_blob_store(db.FileSystemBlobStore(os.path.join(workdir, 'blobs')))
+                db.init_database()
+                populate(rows)
+                with db.connection() as conn:
+                    conn.execute('ANALYZE')
+                BENCHMARKS[name](rows, args.repeat)
+                db.get_pool().close_all()
+
+
+if __name__ == "__main__":
+    main()
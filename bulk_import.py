@@ -0,0 +1,172 @@
+"""
+Bulk Import for Care Home Document Management System
+Imports a shared-drive folder or ZIP archive. Top-level folders map to
+categories, files are hashed and stored by a pool of worker threads, and
+metadata is written in large batched transactions. Re-running an interrupted
+import skips the files it already brought in.
+Run with: python manage.py import <folder or .zip>
+"""
+
+import os
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+import database as db
+
+# Threads storing payloads; hashing, compression and file I/O release the GIL
+IMPORT_WORKERS = 4
+
+# Documents inserted per transaction
+IMPORT_BATCH_SIZE = 500
+
+# Files that are never documents
+IGNORED_FILE_NAMES = {'thumbs.db', 'desktop.ini', '.ds_store'}
+
+
+class ImportFile:
+    """One file found in an import source"""
+
+    def __init__(self, path, size, opener):
+        self.path = path
+        self.size = size
+        self.open = opener
+
+    @property
+    def folder(self):
+        parts = self.path.split('/')
+        return parts[0] if len(parts) > 1 else None
+
+    @property
+    def file_name(self):
+        return self.path.rsplit('/', 1)[-1]
+
+    @property
+    def file_type(self):
+        return self.file_name.rsplit('.', 1)[-1].lower() if '.' in self.file_name else ''
+
+    @property
+    def title(self):
+        stem = self.file_name.rsplit('.', 1)[0] if '.' in self.file_name else self.file_name
+        return ' '.join(stem.replace('_', ' ').replace('-', ' ').split()) or self.file_name
+
+
+def _is_ignored(path):
+    parts = path.split('/')
+    return (any(part.startswith('.') or part == '__MACOSX' for part in parts)
+            or parts[-1].lower() in IGNORED_FILE_NAMES)
+
+
+def _walk_directory(root):
+    for folder, dirs, files in os.walk(root):
+        dirs.sort()
+        for name in sorted(files):
+            full_path = os.path.join(folder, name)
+            path = os.path.relpath(full_path, root).replace(os.sep, '/')
+            if not _is_ignored(path):
+                yield ImportFile(path, os.path.getsize(full_path),
+                                 lambda full_path=full_path: open(full_path, 'rb'))
+
+
+def _walk_zip(archive_path):
+    # ZipFile handles are not shared between threads, so each worker opens its own
+    local = threading.local()
+
+    def open_member(name):
+        if not hasattr(local, 'archive'):
+            local.archive = zipfile.ZipFile(archive_path)
+        return local.archive.open(name)
+
+    with zipfile.ZipFile(archive_path) as archive:
+        members = [info for info in archive.infolist() if not info.is_dir()]
+    for info in sorted(members, key=lambda info: info.filename):
+        path = info.filename.strip('/')
+        if not _is_ignored(path):
+            yield ImportFile(path, info.file_size, lambda name=info.filename: open_member(name))
+
+
+def scan_source(source):
+    """List the files of a directory or ZIP archive"""
+    if os.path.isdir(source):
+        return list(_walk_directory(source))
+    if zipfile.is_zipfile(source):
+        return list(_walk_zip(source))
+    raise ValueError(f"{source} is neither a folder nor a ZIP archive")
+
+
+def match_categories(folders, category_map=None):
+    """Map folder names to category ids by explicit mapping, then by name"""
+    categories = {cat['name'].lower(): cat['id'] for cat in db.get_categories()}
+    explicit = {folder.lower(): name.lower() for folder, name in (category_map or {}).items()}
+    mapping = {}
+    for folder in folders:
+        name = explicit.get(folder.lower(), folder.lower())
+        if name in categories:
+            mapping[folder] = categories[name]
+        else:
+            # Loose match such as "Policies" for "Policies & Procedures"
+            matches = [cat_id for cat_name, cat_id in categories.items()
+                       if cat_name.startswith(name) or name.startswith(cat_name)]
+            mapping[folder] = matches[0] if len(matches) == 1 else None
+    return mapping
+
+
+def _store(item):
+    with item.open() as stream:
+        return db.store_payload(stream, item.file_type)
+
+
+def import_source(source, uploaded_by="Bulk Import", category_map=None, workers=IMPORT_WORKERS,
+                  batch_size=IMPORT_BATCH_SIZE, progress=None):
+    """Import the files of a folder or ZIP archive not already imported from it; returns running totals"""
+    source_key = os.path.realpath(source)
+    files = scan_source(source)
+    imported_paths = db.get_imported_paths(source_key)
+    pending = [item for item in files if item.path not in imported_paths]
+    categories = match_categories({item.folder for item in pending if item.folder}, category_map)
+
+    totals = {'found': len(files), 'skipped': len(files) - len(pending), 'imported': 0,
+              'failed': [], 'bytes': 0, 'seconds': 0.0, 'files_per_second': 0.0,
+              'uncategorized_folders': sorted(folder for folder, cat_id in categories.items() if cat_id is None)}
+    started = time.perf_counter()
+
+    def flush(batch):
+        db.add_documents(batch, uploaded_by, import_source=source_key)
+        totals['imported'] += len(batch)
+        totals['bytes'] += sum(doc['file_size'] for doc in batch)
+        totals['seconds'] = time.perf_counter() - started
+        totals['files_per_second'] = totals['imported'] / totals['seconds'] if totals['seconds'] else 0.0
+        if progress:
+            progress(totals)
+
+    # All files are submitted up front so workers keep storing payloads while
+    # a batch is being inserted; results are consumed in source order.
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [(item, executor.submit(_store, item)) for item in pending]
+        batch = []
+        for item, future in futures:
+            try:
+                content_hash, file_size, stored_size = future.result()
+            except (OSError, zipfile.BadZipFile) as e:
+                totals['failed'].append((item.path, f'{type(e).__name__}: {e}'))
+                continue
+            batch.append({
+                'title': item.title,
+                'category_id': categories.get(item.folder),
+                'file_name': item.file_name,
+                'file_type': item.file_type,
+                'content_hash': content_hash,
+                'file_size': file_size,
+                'stored_size': stored_size,
+                'open': item.open,
+                'source_path': item.path
+            })
+            if len(batch) >= batch_size:
+                flush(batch)
+                batch = []
+        if batch:
+            flush(batch)
+
+    totals['seconds'] = time.perf_counter() - started
+    return totals
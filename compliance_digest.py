@@ -0,0 +1,209 @@
+"""
+Compliance Digest for Care Home Document Management System
+Reports deadlines that have come within the alert window or become overdue
+since the previous run, outside the Streamlit process. Each run re-evaluates
+only the dates the window moved over and the documents changed since the last
+run, so its cost does not grow with the size of the repository.
+Run with: python manage.py digest [--every MINUTES]
+"""
+
+import os
+import smtplib
+import sqlite3
+import time
+from datetime import date, datetime, timedelta
+from email.message import EmailMessage
+
+import database as db
+
+# Deadlines due within this many days are reported
+DIGEST_HORIZON_DAYS = 30
+
+# Folder digest reports are written to
+DIGEST_PATH = "compliance_digests"
+
+# Entries listed per section of a report; the rest are counted
+DIGEST_MAX_LISTED = 200
+
+DEADLINE_LABELS = {'expiry': 'Expires', 'review': 'Review due'}
+
+
+def _entry(doc, kind, due_date):
+    return {'document_id': doc['id'], 'kind': kind, 'due_date': due_date, 'title': doc['title'],
+            'category_name': doc['category_name']}
+
+
+class Digest:
+    """The deadlines that changed state in one run"""
+
+    def __init__(self, run_at, run_date, horizon_date, counts):
+        self.run_at = run_at
+        self.run_date = run_date
+        self.horizon_date = horizon_date
+        self.counts = counts
+        self.upcoming = []
+        self.overdue = []
+        self.resolved = []
+
+    @property
+    def is_empty(self):
+        return not (self.upcoming or self.overdue or self.resolved)
+
+    @property
+    def subject(self):
+        return (f"Compliance digest {self.run_date}: {len(self.upcoming)} upcoming, "
+                f"{len(self.overdue)} overdue, {len(self.resolved)} resolved")
+
+    def _section(self, title, entries):
+        lines = [f"## {title} ({len(entries)})", ""]
+        for entry in entries[:DIGEST_MAX_LISTED]:
+            line = (f"- {DEADLINE_LABELS[entry['kind']]} {entry['due_date']}: {entry['title']} "
+                    f"({entry['category_name'] or 'Uncategorized'}, document {entry['document_id']})")
+            if entry.get('previous_due_date'):
+                line += f", previously {entry['previous_due_date']}"
+            lines.append(line)
+        if len(entries) > DIGEST_MAX_LISTED:
+            lines.append(f"- ... and {len(entries) - DIGEST_MAX_LISTED} more")
+        return lines + [""]
+
+    def to_text(self):
+        lines = [f"# {self.subject}", "",
+                 f"Deadlines up to {self.horizon_date}, changes since the previous digest.", ""]
+        lines += self._section("Now overdue", self.overdue)
+        lines += self._section("Coming up", self.upcoming)
+        lines += self._section("No longer due", self.resolved)
+        lines += ["## All deadlines", ""]
+        for kind, counts in self.counts.items():
+            due_soon = ', '.join(f"{counts[f'within_{days}']} within {days} days" for days in db.DEADLINE_URGENCY_DAYS)
+            lines.append(f"- {kind.title()}: {counts['overdue']} overdue, {due_soon}")
+        return '\n'.join(lines) + '\n'
+
+    def file_stem(self):
+        return 'digest-' + self.run_at.replace(' ', '-').replace(':', '')
+
+
+def build_digest(horizon_days=DIGEST_HORIZON_DAYS):
+    """Compare the deadlines that may have changed since the last run with what it reported"""
+    run_at = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+    today = date.today()
+    horizon = today + timedelta(days=horizon_days)
+    last_run = db.get_last_digest_run()
+
+    # Deadlines to evaluate, keyed by (document_id, kind); a due_date of None
+    # means the document no longer has that deadline within the window.
+    candidates = {}
+    if last_run is None:
+        ranges = [(None, horizon)]
+    else:
+        last_date = date.fromisoformat(last_run['run_date'])
+        last_horizon = date.fromisoformat(last_run['horizon_date'])
+        # Dates the window has moved over, and upcoming deadlines that have since passed
+        ranges = [(max(last_horizon + timedelta(days=1), today), horizon), (last_date, today - timedelta(days=1))]
+    for start, end in ranges:
+        if start is None or start <= end:
+            for row in db.get_deadlines(start_date=start, end_date=end):
+                candidates[(row['id'], row['kind'])] = _entry(row, row['kind'], row['due_date'])
+    if last_run is not None:
+        # Documents added, replaced or deleted since the last run are re-evaluated in full
+        for doc in db.get_documents_changed_since(last_run['run_at']):
+            for kind, column in (('expiry', 'expiry_date'), ('review', 'review_date')):
+                due_date = doc[column]
+                in_window = doc['status'] == 'active' and due_date and due_date <= horizon.isoformat()
+                candidates[(doc['id'], kind)] = _entry(doc, kind, due_date if in_window else None)
+
+    digest = Digest(run_at, today, horizon, db.get_deadline_counts())
+    previous = db.get_digest_alerts({doc_id for doc_id, kind in candidates})
+    alerts = []
+    resolved = []
+    for key, entry in sorted(candidates.items(), key=lambda item: (item[1]['due_date'] or '', item[0])):
+        reported = previous.get(key)
+        if entry['due_date'] is None:
+            if reported is not None:
+                resolved.append(key)
+                digest.resolved.append({**entry, 'due_date': reported['due_date']})
+            continue
+        status = 'overdue' if entry['due_date'] < today.isoformat() else 'upcoming'
+        if reported is not None and (reported['due_date'], reported['status']) == (entry['due_date'], status):
+            continue
+        alerts.append((*key, entry['due_date'], status))
+        if reported is not None and reported['due_date'] != entry['due_date']:
+            entry['previous_due_date'] = reported['due_date']
+        (digest.overdue if status == 'overdue' else digest.upcoming).append(entry)
+    return digest, alerts, resolved
+
+
+class FileNotifier:
+    """Writes each digest as a Markdown report in a folder"""
+
+    def __init__(self, directory=DIGEST_PATH):
+        self.directory = directory
+
+    def send(self, digest):
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, digest.file_stem() + '.md')
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(digest.to_text())
+        return path
+
+
+class SMTPNotifier:
+    """Emails each digest through an SMTP server"""
+
+    def __init__(self, host, port=25, sender='compliance@localhost', recipients=()):
+        self.host = host
+        self.port = port
+        self.sender = sender
+        self.recipients = list(recipients)
+
+    def message(self, digest):
+        message = EmailMessage()
+        message['Subject'] = digest.subject
+        message['From'] = self.sender
+        message['To'] = ', '.join(self.recipients)
+        message.set_content(digest.to_text())
+        return message
+
+    def send(self, digest):
+        with smtplib.SMTP(self.host, self.port) as smtp:
+            smtp.send_message(self.message(digest))
+        return f"{self.host}:{self.port}"
+
+
+class OutboxNotifier(SMTPNotifier):
+    """Stands in for SMTPNotifier by saving each digest email as an .eml file"""
+
+    def __init__(self, directory, sender='compliance@localhost', recipients=()):
+        super().__init__(None, sender=sender, recipients=recipients)
+        self.directory = directory
+
+    def send(self, digest):
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, digest.file_stem() + '.eml')
+        with open(path, 'wb') as f:
+            f.write(self.message(digest).as_bytes())
+        return path
+
+
+def run_digest(notifiers, horizon_days=DIGEST_HORIZON_DAYS, send_empty=False):
+    """Build a digest, send it and record the run; returns the digest and where it was sent"""
+    digest, alerts, resolved = build_digest(horizon_days)
+    sent = []
+    if send_empty or not digest.is_empty:
+        sent = [notifier.send(digest) for notifier in notifiers]
+    # Recorded only once every notifier has succeeded, so a failed run is
+    # reported again in full by the next one
+    db.record_digest_run(digest.run_at, digest.run_date, digest.horizon_date, alerts, resolved)
+    return digest, sent
+
+
+def run_forever(notifiers, interval_seconds, horizon_days=DIGEST_HORIZON_DAYS, report=None):
+    """Run the digest every interval_seconds until interrupted"""
+    while True:
+        try:
+            digest, sent = run_digest(notifiers, horizon_days)
+            if report:
+                report(digest, sent, None)
+        except (sqlite3.Error, OSError) as e:
+            if report:
+                report(None, [], e)
+        time.sleep(interval_seconds)
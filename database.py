@@ -6,18 +6,1263 @@ Author: Ayoolumi Melehon
 
 import sqlite3
 import os
+import io
+import hashlib
+import tempfile
+import gzip
+import shutil
+import threading
+import time
+import queue
+import functools
+import atexit
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import date
 from datetime import datetime, timedelta
 import json
+import re
 
 DATABASE_PATH = "documents.db"
+BLOB_STORE_PATH = "blob_store"
+
+# Blobs no longer referenced by any document are kept this long before the
+# garbage collector removes them.
+BLOB_GC_GRACE_PERIOD = timedelta(days=7)
+BLOB_GC_INTERVAL_SECONDS = 3600
+
+# Connection pool sizing and per-connection tuning
+POOL_SIZE = 8
+POOL_TIMEOUT_SECONDS = 30
+CACHE_SIZE_KIB = 64 * 1024
+MMAP_SIZE_BYTES = 256 * 1024 * 1024
+
+# Read results are cached in-process until a write to one of the tables they
+# depend on. The age limit catches writes made by other processes (such as
+# manage.py commands), which cannot bump this process's generations.
+QUERY_CACHE_MAX_ENTRIES = 512
+QUERY_CACHE_MAX_AGE_SECONDS = 300
+
+# High-frequency activity events (views, downloads) are buffered in memory and
+# written in batches by a background thread
+ACTIVITY_QUEUE_SIZE = 10_000
+ACTIVITY_BATCH_SIZE = 500
+ACTIVITY_FLUSH_INTERVAL_SECONDS = 2
+
+# activity_log holds the current month and the ACTIVITY_LIVE_MONTHS - 1 before
+# it. Older months are moved into gzip-compressed SQLite files, one per month,
+# catalogued in activity_archives and kept indefinitely.
+ACTIVITY_ARCHIVE_PATH = "activity_archive"
+ACTIVITY_LIVE_MONTHS = 3
+ACTIVITY_ARCHIVE_INTERVAL_SECONDS = 24 * 3600
+# Archives decompressed for audit searches are kept in a temporary directory
+# and reused, most recently used first
+ACTIVITY_ARCHIVE_CACHE_ENTRIES = 6
+
+# Audit trail entries shown per page of the Activity Log
+ACTIVITY_PAGE_SIZE = 100
+
+# Compliance deadlines are counted as overdue or due within each of these
+# numbers of days
+DEADLINE_URGENCY_DAYS = (7, 14)
+
+# Every documents column except the file_data payload. Listing queries select
+# only these so that rendering a page never loads document bytes.
+DOCUMENT_METADATA_COLUMNS = (
+    'id', 'title', 'description', 'category_id', 'file_name', 'file_type', 'file_size',
+    'version', 'status', 'uploaded_by', 'department', 'review_date', 'expiry_date', 'tags',
+    'content_hash', 'created_at', 'updated_at'
+)
+
+VERSION_METADATA_COLUMNS = (
+    'id', 'document_id', 'version', 'file_name', 'file_size', 'chunk_count', 'content_hash', 'changes_summary',
+    'uploaded_by', 'created_at'
+)
+
+# Relative bm25 weights of the title, description, tags and content search columns
+SEARCH_WEIGHTS = (10.0, 3.0, 5.0, 1.0)
+
+# Markers placed around matched terms in search highlights and snippets; the UI
+# escapes the text and then swaps these for markup.
+HIGHLIGHT_START = '\x02'
+HIGHLIGHT_END = '\x03'
+
+# Listing orders usable for keyset pagination: name -> (sort column, direction).
+# Ties are broken by id in the same direction.
+DOCUMENT_ORDERINGS = {
+    'newest': ('updated_at', 'DESC'),
+    'oldest': ('updated_at', 'ASC'),
+    'title': ('title', 'ASC'),
+}
+
+# File type groups offered by the search filters -> file_type values, as
+# stored from the file extension in either case
+FILE_TYPE_GROUPS = {
+    'PDF': ('pdf',),
+    'Word': ('doc', 'docx', 'odt', 'rtf'),
+    'Excel': ('xls', 'xlsx', 'ods', 'csv'),
+    'Images': ('jpg', 'jpeg', 'png', 'gif', 'webp', 'bmp'),
+}
+
+# Tags shown in the search page's tag cloud
+TAG_CLOUD_SIZE = 30
+
+# Analytics time series buckets -> SQL for the first day of the bucket holding
+# a 'YYYY-MM-DD' column; weeks start on Monday
+ANALYTICS_PERIODS = {
+    'day': '{column}',
+    'week': "date({column}, '-6 days', 'weekday 1')",
+    'month': "substr({column}, 1, 7) || '-01'",
+    'year': "substr({column}, 1, 4) || '-01-01'",
+}
+
+# Documents shown per page in listings
+DOCUMENT_PAGE_SIZE = 20
+
+# Filtered counts stop at this many rows; the UI shows larger counts as "N+"
+COUNT_ESTIMATE_CAP = 10_000
+
+# Stored payloads are zlib-compressed unless their file type is already a
+# compressed format, or a sample of the first chunk shrinks by less than
+# PAYLOAD_MIN_SAVING. Hashes and sizes always refer to the original bytes.
+PAYLOAD_COMPRESSION = True
+PAYLOAD_COMPRESSION_LEVEL = 6
+PAYLOAD_MIN_SAVING = 0.1
+PRECOMPRESSED_FILE_TYPES = {
+    'jpg', 'jpeg', 'png', 'gif', 'webp', 'docx', 'xlsx', 'pptx', 'zip', 'gz', '7z', 'mp3', 'mp4'
+}
+
+# Earlier document versions are split into chunks of this size, compressed and
+# stored once per distinct chunk, so unchanged parts of a re-issued file cost
+# nothing.
+VERSION_CHUNK_SIZE = 64 * 1024
+VERSION_COMPRESSION_LEVEL = 6
+# New chunks are written this many to a transaction
+VERSION_CHUNK_BATCH = 16
+
+# Payloads are copied to and from SQLite in pieces of this size so memory use
+# stays bounded regardless of file size.
+CHUNK_SIZE = 1024 * 1024
+
+def _document_columns(alias='d'):
+    columns = ', '.join(f'{alias}.{col}' for col in DOCUMENT_METADATA_COLUMNS)
+    return f'{columns}, ({alias}.content_hash IS NOT NULL OR {alias}.file_data IS NOT NULL) as has_file'
+
+# Set by check_query_plans to capture every statement the read functions run
+_statement_observer = None
 
 def get_connection():
-    conn = sqlite3.connect(DATABASE_PATH, check_same_thread=False, timeout=30)
+    # A new, unpooled connection. Most callers should use connection() instead;
+    # this is for long-lived handles such as BLOB readers.
+    conn = sqlite3.connect(DATABASE_PATH, check_same_thread=False, timeout=POOL_TIMEOUT_SECONDS)
     conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA synchronous = NORMAL')
+    conn.execute(f'PRAGMA cache_size = -{CACHE_SIZE_KIB}')
+    conn.execute(f'PRAGMA mmap_size = {MMAP_SIZE_BYTES}')
+    conn.execute('PRAGMA temp_store = MEMORY')
+    if _statement_observer is not None:
+        conn.set_trace_callback(_statement_observer)
     return conn
 
+class ConnectionPool:
+    """Bounded pool of configured connections, reused re-entrantly within a thread."""
+
+    def __init__(self, path, max_size=POOL_SIZE):
+        self.path = path
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._local = threading.local()
+
+    @contextmanager
+    def connection(self):
+        # Nested use on the same thread shares the outer connection and its
+        # transaction; only the outermost block commits or rolls back.
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            yield conn
+            return
+        
+        if not self._slots.acquire(timeout=POOL_TIMEOUT_SECONDS):
+            raise sqlite3.OperationalError('Timed out waiting for a database connection')
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            try:
+                conn = get_connection()
+            except BaseException:
+                self._slots.release()
+                raise
+        conn.set_trace_callback(_statement_observer)
+        self._local.conn = conn
+        try:
+            yield conn
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            self._local.conn = None
+            self._idle.put(conn)
+            self._slots.release()
+
+    def close_all(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool.path != DATABASE_PATH:
+            if _pool is not None:
+                _pool.close_all()
+            _pool = ConnectionPool(DATABASE_PATH)
+        return _pool
+
+def connection():
+    return get_pool().connection()
+
+# Query result cache. Each cached function names the tables it reads; writers
+# bump those tables' generation counters, which makes dependent entries stale.
+# The cache lives at module level, so it is shared by every Streamlit session
+# and rerun in the server process.
+_generations = {'documents': 0, 'categories': 0, 'versions': 0, 'activity': 0, 'document_text': 0, 'analytics': 0}
+_query_cache = OrderedDict()
+_cache_stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+_cache_lock = threading.Lock()
+
+def _invalidate(*tables):
+    with _cache_lock:
+        for table in tables:
+            _generations[table] += 1
+        _cache_stats['invalidations'] += 1
+
+def _cached(*tables, daily=False):
+    # daily=True adds today's date to the key, for results that depend on now()
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = (func.__name__, args, tuple(sorted(kwargs.items())), date.today() if daily else None)
+            now = time.monotonic()
+            with _cache_lock:
+                generation = tuple(_generations[table] for table in tables)
+                entry = _query_cache.get(key)
+                if entry and entry[0] == generation and now - entry[1] < QUERY_CACHE_MAX_AGE_SECONDS:
+                    _query_cache.move_to_end(key)
+                    _cache_stats['hits'] += 1
+                    return entry[2]
+                _cache_stats['misses'] += 1
+            
+            # The generation was read before querying, so a write that lands
+            # during the query leaves this entry stale rather than wrong.
+            result = func(*args, **kwargs)
+            if isinstance(result, list):
+                result = tuple(result)
+            with _cache_lock:
+                _query_cache[key] = (generation, now, result)
+                _query_cache.move_to_end(key)
+                while len(_query_cache) > QUERY_CACHE_MAX_ENTRIES:
+                    _query_cache.popitem(last=False)
+            return result
+        wrapper.uncached = func
+        return wrapper
+    return decorator
+
+def clear_query_cache():
+    with _cache_lock:
+        _query_cache.clear()
+
+def get_cache_stats():
+    with _cache_lock:
+        lookups = _cache_stats['hits'] + _cache_stats['misses']
+        return {
+            **_cache_stats,
+            'entries': len(_query_cache),
+            'hit_rate': _cache_stats['hits'] / lookups if lookups else 0.0,
+            'generations': dict(_generations),
+        }
+
+class _SubstrBlob:
+    # Fallback for Python < 3.11 where Connection.blobopen is unavailable
+    def __init__(self, conn, table, column, rowid):
+        self._conn = conn
+        self._query = f'SELECT substr({column}, ?, ?) FROM {table} WHERE rowid = ?'
+        self._rowid = rowid
+        self._size = conn.execute(f'SELECT length({column}) FROM {table} WHERE rowid = ?', (rowid,)).fetchone()[0] or 0
+        self._pos = 0
+
+    def __len__(self):
+        return self._size
+
+    def read(self, length=-1):
+        if length < 0:
+            length = self._size - self._pos
+        data = self._conn.execute(self._query, (self._pos + 1, length, self._rowid)).fetchone()[0] or b''
+        self._pos += len(data)
+        return bytes(data)
+
+    def seek(self, offset, origin=os.SEEK_SET):
+        base = {os.SEEK_SET: 0, os.SEEK_CUR: self._pos, os.SEEK_END: self._size}[origin]
+        self._pos = max(0, min(base + offset, self._size))
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        pass
+
+class BlobReader(io.RawIOBase):
+    """Read-only file object over a stored BLOB that reads it incrementally."""
+
+    def __init__(self, conn, table, column, rowid):
+        self._conn = conn
+        if hasattr(conn, 'blobopen'):
+            self._blob = conn.blobopen(table, column, rowid, readonly=True)
+        else:
+            self._blob = _SubstrBlob(conn, table, column, rowid)
+        self.size = len(self._blob)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self._blob.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def readall(self):
+        # A single read into one bytes object, used when a consumer needs the whole file
+        return self._blob.read()
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        self._blob.seek(offset, whence)
+        return self._blob.tell()
+
+    def tell(self):
+        return self._blob.tell()
+
+    def close(self):
+        if not self.closed:
+            self._blob.close()
+            self._conn.close()
+        super().close()
+
+def _write_blob(conn, table, column, rowid, stream, size):
+    # The row must already hold zeroblob(size); the stream is copied into it chunk by chunk
+    if not hasattr(conn, 'blobopen'):
+        conn.execute(f'UPDATE {table} SET {column} = ? WHERE rowid = ?', (stream.read(), rowid))
+        return
+    written = 0
+    with conn.blobopen(table, column, rowid) as blob:
+        while written < size:
+            chunk = stream.read(min(CHUNK_SIZE, size - written))
+            if not chunk:
+                raise ValueError(f'File stream ended after {written} of {size} bytes')
+            blob.write(chunk)
+            written += len(chunk)
+
+class _PayloadWriter:
+    # Writes a payload to a file object, compressing it when asked to and
+    # when a sample of the first chunk shows it is worth it
+    def __init__(self, target, compress):
+        self._target = target
+        self._compress = compress
+        self._compressor = None
+        self.digest = hashlib.sha256()
+        self.size = 0
+        self.stored_size = 0
+
+    @property
+    def compressed(self):
+        return self._compressor is not None
+
+    def write(self, chunk):
+        if self.size == 0 and self._compress:
+            sample = chunk[:VERSION_CHUNK_SIZE]
+            if len(zlib.compress(sample, 1)) <= len(sample) * (1 - PAYLOAD_MIN_SAVING):
+                self._compressor = zlib.compressobj(PAYLOAD_COMPRESSION_LEVEL)
+        self.digest.update(chunk)
+        self.size += len(chunk)
+        self._emit(self._compressor.compress(chunk) if self._compressor else chunk)
+
+    def close(self):
+        if self._compressor:
+            self._emit(self._compressor.flush())
+
+    def _emit(self, data):
+        self._target.write(data)
+        self.stored_size += len(data)
+
+    def copy_from(self, stream):
+        while True:
+            chunk = stream.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            self.write(chunk)
+        self.close()
+
+class _DecompressingReader(io.RawIOBase):
+    # Streams the original bytes back out of a zlib-compressed file object.
+    # Seeking backwards restarts decompression from the start of the stream
+    # and seeking forwards decompresses and discards, so consumers that
+    # rewind before reading (such as Streamlit's download_button) work.
+    def __init__(self, raw):
+        self._raw = raw
+        self._decompressor = zlib.decompressobj()
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return self._raw.seekable()
+
+    def readinto(self, buffer):
+        while True:
+            data = self._decompressor.unconsumed_tail
+            if not data and not self._decompressor.eof:
+                data = self._raw.read(CHUNK_SIZE)
+            if not data and not self._decompressor.unconsumed_tail:
+                return 0
+            out = self._decompressor.decompress(data, len(buffer))
+            if out:
+                buffer[:len(out)] = out
+                self._pos += len(out)
+                return len(out)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._pos
+        elif whence == os.SEEK_END:
+            # The original size is only known by decompressing to the end
+            while self.readinto(bytearray(CHUNK_SIZE)):
+                pass
+            offset += self._pos
+        offset = max(offset, 0)
+        if offset < self._pos:
+            self._raw.seek(0)
+            self._decompressor = zlib.decompressobj()
+            self._pos = 0
+        while self._pos < offset:
+            if not self.readinto(bytearray(min(CHUNK_SIZE, offset - self._pos))):
+                break
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        if not self.closed:
+            self._raw.close()
+        super().close()
+
+def _hash_to_spool(stream, compress=False):
+    # Copies a stream to a temporary file while hashing it; returns
+    # (file, sha256, size, stored size, compressed)
+    spool = tempfile.SpooledTemporaryFile(max_size=8 * CHUNK_SIZE)
+    writer = _PayloadWriter(spool, compress)
+    writer.copy_from(stream)
+    spool.seek(0)
+    return spool, writer.digest.hexdigest(), writer.size, writer.stored_size, writer.compressed
+
+class FileSystemBlobStore:
+    """Content-addressed payload store: one file per SHA-256, sharded as ab/cd/<hash>.
+
+    Compressed payloads are kept as <hash>.z; path() only ever names an
+    uncompressed file that other programs can read directly.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, content_hash):
+        return os.path.join(self.root, content_hash[:2], content_hash[2:4], content_hash)
+
+    def put(self, stream, compress=False):
+        # Returns (sha256, size, stored size)
+        tmp_dir = os.path.join(self.root, 'tmp')
+        os.makedirs(tmp_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=tmp_dir)
+        try:
+            with os.fdopen(fd, 'wb') as tmp:
+                writer = _PayloadWriter(tmp, compress)
+                writer.copy_from(stream)
+                tmp.flush()
+                os.fsync(tmp.fileno())
+            content_hash = writer.digest.hexdigest()
+            existing = self._existing_path(content_hash)
+            if existing:
+                os.remove(tmp_path)
+                # Restarts the grace period of a file not yet referenced again
+                os.utime(existing)
+                return content_hash, writer.size, os.path.getsize(existing)
+            path = self._path(content_hash) + ('.z' if writer.compressed else '')
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return content_hash, writer.size, writer.stored_size
+
+    def _existing_path(self, content_hash):
+        for path in (self._path(content_hash), self._path(content_hash) + '.z'):
+            if os.path.exists(path):
+                return path
+        return None
+
+    def open(self, content_hash):
+        path = self._path(content_hash)
+        if not os.path.exists(path) and os.path.exists(path + '.z'):
+            return io.BufferedReader(_DecompressingReader(open(path + '.z', 'rb')), buffer_size=CHUNK_SIZE)
+        return open(path, 'rb', buffering=CHUNK_SIZE)
+
+    def path(self, content_hash):
+        return self._path(content_hash)
+
+    def exists(self, content_hash):
+        return self._existing_path(content_hash) is not None
+
+    def delete(self, content_hash):
+        for path in (self._path(content_hash), self._path(content_hash) + '.z'):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def stored_files(self):
+        # (content hash, path) of every file in the store; temporary files
+        # left by interrupted puts have no hash
+        tmp_dir = os.path.join(self.root, 'tmp')
+        for folder, dirs, files in os.walk(self.root):
+            for name in files:
+                content_hash = None if folder == tmp_dir else name[:-2] if name.endswith('.z') else name
+                yield content_hash, os.path.join(folder, name)
+
+class SQLiteBlobStore:
+    """Content-addressed payload store kept in the blob_data table of the main database."""
+
+    def put(self, stream, compress=False):
+        spool, content_hash, size, stored_size, compressed = _hash_to_spool(stream, compress)
+        with spool, connection() as conn:
+            cursor = conn.execute('INSERT OR IGNORE INTO blob_data (hash, data, compressed) VALUES (?, zeroblob(?), ?)',
+                                  (content_hash, stored_size, compressed))
+            if cursor.rowcount:
+                _write_blob(conn, 'blob_data', 'data', cursor.lastrowid, spool, stored_size)
+            else:
+                stored_size = conn.execute('SELECT length(data) FROM blob_data WHERE hash = ?',
+                                           (content_hash,)).fetchone()[0]
+        return content_hash, size, stored_size
+
+    def open(self, content_hash):
+        with connection() as conn:
+            row = conn.execute('SELECT rowid, compressed FROM blob_data WHERE hash = ?', (content_hash,)).fetchone()
+        if not row:
+            raise FileNotFoundError(content_hash)
+        # The reader outlives this call, so it gets its own connection
+        reader = BlobReader(get_connection(), 'blob_data', 'data', row[0])
+        if row[1]:
+            reader = _DecompressingReader(reader)
+        return io.BufferedReader(reader, buffer_size=CHUNK_SIZE)
+
+    def exists(self, content_hash):
+        with connection() as conn:
+            row = conn.execute('SELECT 1 FROM blob_data WHERE hash = ?', (content_hash,)).fetchone()
+        return row is not None
+
+    def delete(self, content_hash):
+        with connection() as conn:
+            conn.execute('DELETE FROM blob_data WHERE hash = ?', (content_hash,))
+
+_blob_store = FileSystemBlobStore(BLOB_STORE_PATH)
+
+def get_blob_store():
+    return _blob_store
+
+def set_blob_store(store):
+    global _blob_store
+    _blob_store = store
+
+def should_compress(file_type):
+    return PAYLOAD_COMPRESSION and (file_type or '').lower() not in PRECOMPRESSED_FILE_TYPES
+
+def store_payload(file_data, file_type=None):
+    # Returns (sha256, size, stored size)
+    stream = file_data if hasattr(file_data, 'read') else io.BytesIO(file_data)
+    return _blob_store.put(stream, compress=should_compress(file_type))
+
+def _acquire_blob(cursor, content_hash, size, stored_size=None):
+    cursor.execute('''INSERT INTO blobs (hash, size, stored_size, ref_count) VALUES (?, ?, ?, 1)
+                      ON CONFLICT(hash) DO UPDATE SET ref_count = ref_count + 1, released_at = NULL''',
+                   (content_hash, size, size if stored_size is None else stored_size))
+
+def _release_blob(cursor, content_hash):
+    cursor.execute('''UPDATE blobs SET ref_count = ref_count - 1,
+                      released_at = CASE WHEN ref_count <= 1 THEN CURRENT_TIMESTAMP END
+                      WHERE hash = ?''', (content_hash,))
+
+def _open_payload(table, row_id):
+    with connection() as conn:
+        row = conn.execute(f'SELECT content_hash, file_data IS NOT NULL as inline FROM {table} WHERE id = ?',
+                           (row_id,)).fetchone()
+    if row and row['content_hash']:
+        return _blob_store.open(row['content_hash'])
+    if row and row['inline']:
+        return io.BufferedReader(BlobReader(get_connection(), table, 'file_data', row_id), buffer_size=CHUNK_SIZE)
+    return None
+
+def _iter_payload(table, row_id, chunk_size):
+    return _iter_reader(_open_payload(table, row_id), chunk_size)
+
+def _iter_reader(reader, chunk_size):
+    if reader is None:
+        return
+    with reader:
+        while True:
+            chunk = reader.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+def _store_version_chunks(stream):
+    # Splits a payload into VERSION_CHUNK_SIZE pieces and adds the ones not
+    # already stored to version_chunks, compressing them before each short
+    # write transaction so no lock is held while compressing. Chunks are
+    # never deleted, so chunks stored for a version that then fails to be
+    # recorded are simply shared by later ones. Returns (size, chunk hashes).
+    size = 0
+    hashes = []
+    batch = {}
+    while True:
+        chunk = stream.read(VERSION_CHUNK_SIZE)
+        if chunk:
+            chunk_hash = hashlib.sha256(chunk).hexdigest()
+            hashes.append(chunk_hash)
+            size += len(chunk)
+            if chunk_hash not in batch:
+                with connection() as conn:
+                    stored = conn.execute('SELECT 1 FROM version_chunks WHERE hash = ?', (chunk_hash,)).fetchone()
+                if not stored:
+                    data = zlib.compress(chunk, VERSION_COMPRESSION_LEVEL)
+                    compressed = len(data) < len(chunk)
+                    batch[chunk_hash] = (chunk_hash, len(chunk), len(data) if compressed else len(chunk),
+                                         compressed, data if compressed else chunk)
+        if batch and (not chunk or len(batch) >= VERSION_CHUNK_BATCH):
+            with connection() as conn:
+                conn.executemany('''INSERT OR IGNORE INTO version_chunks (hash, size, stored_size, compressed, data)
+                                    VALUES (?, ?, ?, ?, ?)''', batch.values())
+            batch = {}
+        if not chunk:
+            return size, hashes
+
+def _record_version_manifest(cursor, version_id, hashes):
+    cursor.executemany('INSERT INTO version_manifest (version_id, seq, chunk_hash) VALUES (?, ?, ?)',
+                       [(version_id, seq, chunk_hash) for seq, chunk_hash in enumerate(hashes)])
+
+class VersionReader(io.RawIOBase):
+    """Read-only, seekable file object that reassembles a chunked version one chunk at a time."""
+
+    def __init__(self, version_id):
+        with connection() as conn:
+            rows = conn.execute('''SELECT m.chunk_hash, c.size FROM version_manifest m
+                                    JOIN version_chunks c ON c.hash = m.chunk_hash
+                                    WHERE m.version_id = ? ORDER BY m.seq''', (version_id,)).fetchall()
+        self._hashes = [row[0] for row in rows]
+        # Offset of each chunk in the version, plus the total size
+        self._offsets = [0]
+        for row in rows:
+            self._offsets.append(self._offsets[-1] + row[1])
+        self._next = 0
+        self._chunk = b''
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def _load_next(self):
+        with connection() as conn:
+            row = conn.execute('SELECT compressed, data FROM version_chunks WHERE hash = ?',
+                               (self._hashes[self._next],)).fetchone()
+        self._chunk = zlib.decompress(row['data']) if row['compressed'] else bytes(row['data'])
+        self._pos = 0
+        self._next += 1
+
+    def readinto(self, buffer):
+        while self._pos >= len(self._chunk):
+            if self._next >= len(self._hashes):
+                return 0
+            self._load_next()
+        count = min(len(buffer), len(self._chunk) - self._pos)
+        buffer[:count] = self._chunk[self._pos:self._pos + count]
+        self._pos += count
+        return count
+
+    def tell(self):
+        # _next is one past the loaded chunk, which starts at _offsets[_next - 1]
+        return self._offsets[max(self._next - 1, 0)] + self._pos
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        base = {os.SEEK_SET: 0, os.SEEK_CUR: self.tell(), os.SEEK_END: self._offsets[-1]}[whence]
+        offset = max(0, min(base + offset, self._offsets[-1]))
+        # Index of the chunk holding offset; the loaded chunk is kept if it is that one
+        index = max(i for i in range(len(self._hashes) or 1) if self._offsets[i] <= offset)
+        if self._next != index + 1 or not self._chunk:
+            self._next = index
+            self._chunk = b''
+            if index < len(self._hashes):
+                self._load_next()
+        self._pos = offset - self._offsets[index]
+        return offset
+
+def _add_column_if_missing(cursor, table, column, definition):
+    columns = [row[1] for row in cursor.execute(f'PRAGMA table_info({table})')]
+    if column not in columns:
+        cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+def _migration_blob_store(cursor):
+    # Payloads live in the blob store; rows keep the content hash, blobs keeps
+    # one reference-counted entry per distinct payload.
+    cursor.execute('''CREATE TABLE IF NOT EXISTS blobs (
+        hash TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        ref_count INTEGER NOT NULL DEFAULT 0,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        released_at TIMESTAMP
+    )''')
+    
+    cursor.execute('''CREATE TABLE IF NOT EXISTS blob_data (
+        hash TEXT UNIQUE NOT NULL,
+        data BLOB
+    )''')
+    
+    _add_column_if_missing(cursor, 'documents', 'content_hash', 'TEXT')
+    _add_column_if_missing(cursor, 'document_versions', 'content_hash', 'TEXT')
+
+def _migration_access_path_indexes(cursor):
+    # Listing: status filter, optional category, newest first
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_documents_status_updated ON documents (status, updated_at)')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS idx_documents_status_category_updated
+                      ON documents (status, category_id, updated_at)''')
+    # Compliance windows and the recent-uploads count
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_documents_status_expiry ON documents (status, expiry_date)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_documents_status_review ON documents (status, review_date)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_documents_status_created ON documents (status, created_at)')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS idx_document_versions_document
+                      ON document_versions (document_id, version)''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_activity_log_created ON activity_log (created_at)')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS idx_blobs_released
+                      ON blobs (released_at) WHERE released_at IS NOT NULL''')
+
+def _migration_full_text_search(cursor):
+    # Full-text index over the searchable document fields, keyed by documents.id
+    # and kept in sync by triggers.
+    cursor.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS documents_fts USING fts5(
+        title, description, tags,
+        tokenize = 'unicode61 remove_diacritics 2',
+        prefix = '2 3'
+    )''')
+    cursor.execute('''CREATE TRIGGER IF NOT EXISTS documents_fts_insert AFTER INSERT ON documents BEGIN
+        INSERT INTO documents_fts (rowid, title, description, tags)
+        VALUES (new.id, new.title, new.description, new.tags);
+    END''')
+    cursor.execute('''CREATE TRIGGER IF NOT EXISTS documents_fts_update
+        AFTER UPDATE OF title, description, tags ON documents BEGIN
+        UPDATE documents_fts SET title = new.title, description = new.description, tags = new.tags
+        WHERE rowid = new.id;
+    END''')
+    cursor.execute('''CREATE TRIGGER IF NOT EXISTS documents_fts_delete AFTER DELETE ON documents BEGIN
+        DELETE FROM documents_fts WHERE rowid = old.id;
+    END''')
+    cursor.execute('''INSERT INTO documents_fts (rowid, title, description, tags)
+                      SELECT id, title, description, tags FROM documents''')
+
+def _migration_document_text(cursor):
+    # Text extracted from uploaded files, one row per document, with the state
+    # and timing of its extraction job.
+    cursor.execute('''CREATE TABLE IF NOT EXISTS document_text (
+        document_id INTEGER PRIMARY KEY,
+        status TEXT NOT NULL DEFAULT 'pending',
+        content TEXT,
+        extractor TEXT,
+        error TEXT,
+        char_count INTEGER,
+        queued_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        started_at TIMESTAMP,
+        finished_at TIMESTAMP,
+        duration_ms INTEGER,
+        FOREIGN KEY (document_id) REFERENCES documents(id)
+    )''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_document_text_status ON document_text (status, queued_at)')
+    
+    # FTS5 tables cannot gain columns, so the search index is recreated with
+    # a content column fed from document_text.
+    for trigger in ('documents_fts_insert', 'documents_fts_update', 'documents_fts_delete'):
+        cursor.execute(f'DROP TRIGGER IF EXISTS {trigger}')
+    cursor.execute('DROP TABLE IF EXISTS documents_fts')
+    cursor.execute('''CREATE VIRTUAL TABLE documents_fts USING fts5(
+        title, description, tags, content,
+        tokenize = 'unicode61 remove_diacritics 2',
+        prefix = '2 3'
+    )''')
+    cursor.execute('''CREATE TRIGGER documents_fts_insert AFTER INSERT ON documents BEGIN
+        INSERT INTO documents_fts (rowid, title, description, tags)
+        VALUES (new.id, new.title, new.description, new.tags);
+    END''')
+    cursor.execute('''CREATE TRIGGER documents_fts_update
+        AFTER UPDATE OF title, description, tags ON documents BEGIN
+        UPDATE documents_fts SET title = new.title, description = new.description, tags = new.tags
+        WHERE rowid = new.id;
+    END''')
+    cursor.execute('''CREATE TRIGGER documents_fts_delete AFTER DELETE ON documents BEGIN
+        DELETE FROM documents_fts WHERE rowid = old.id;
+        DELETE FROM document_text WHERE document_id = old.id;
+    END''')
+    cursor.execute('''CREATE TRIGGER document_text_fts_insert AFTER INSERT ON document_text BEGIN
+        UPDATE documents_fts SET content = new.content WHERE rowid = new.document_id;
+    END''')
+    cursor.execute('''CREATE TRIGGER document_text_fts_update AFTER UPDATE OF content ON document_text BEGIN
+        UPDATE documents_fts SET content = new.content WHERE rowid = new.document_id;
+    END''')
+    _rebuild_search_index(cursor)
+    cursor.execute('''INSERT OR IGNORE INTO document_text (document_id)
+                      SELECT id FROM documents WHERE status = 'active' ''')
+
+def _dashboard_stats_delta(row, sign):
+    # Adds (sign '+') or removes (sign '-') an active document's contribution
+    # to document_stats: the overall total plus its expiry, review and upload day.
+    return f'''INSERT INTO document_stats (kind, day, documents, total_size)
+        SELECT kind, day, {sign}1, {sign}size FROM (
+            SELECT 'total' as kind, '' as day, COALESCE({row}.file_size, 0) as size
+            UNION ALL SELECT 'expiry', {row}.expiry_date, 0
+            UNION ALL SELECT 'review', {row}.review_date, 0
+            UNION ALL SELECT 'created', substr({row}.created_at, 1, 10), 0
+        ) WHERE day IS NOT NULL AND {row}.status = 'active'
+        ON CONFLICT (kind, day) DO UPDATE SET documents = documents + excluded.documents,
+                                              total_size = total_size + excluded.total_size;'''
+
+def _migration_dashboard_stats(cursor):
+    # Active-document counts bucketed by day, kept current by triggers so the
+    # dashboard reads a handful of index ranges instead of the documents table.
+    cursor.execute('''CREATE TABLE IF NOT EXISTS document_stats (
+        kind TEXT NOT NULL,
+        day TEXT NOT NULL,
+        documents INTEGER NOT NULL DEFAULT 0,
+        total_size INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (kind, day)
+    ) WITHOUT ROWID''')
+    cursor.execute(f'''CREATE TRIGGER document_stats_insert AFTER INSERT ON documents BEGIN
+        {_dashboard_stats_delta('new', '+')}
+    END''')
+    cursor.execute(f'''CREATE TRIGGER document_stats_delete AFTER DELETE ON documents BEGIN
+        {_dashboard_stats_delta('old', '-')}
+    END''')
+    cursor.execute(f'''CREATE TRIGGER document_stats_update
+        AFTER UPDATE OF status, file_size, expiry_date, review_date, created_at ON documents BEGIN
+        {_dashboard_stats_delta('old', '-')}
+        {_dashboard_stats_delta('new', '+')}
+    END''')
+    cursor.execute('''INSERT INTO document_stats (kind, day, documents, total_size)
+                      SELECT 'total', '', COUNT(*), COALESCE(SUM(file_size), 0)
+                      FROM documents WHERE status = 'active'
+                      UNION ALL
+                      SELECT 'expiry', expiry_date, COUNT(*), 0 FROM documents
+                      WHERE status = 'active' AND expiry_date IS NOT NULL GROUP BY expiry_date
+                      UNION ALL
+                      SELECT 'review', review_date, COUNT(*), 0 FROM documents
+                      WHERE status = 'active' AND review_date IS NOT NULL GROUP BY review_date
+                      UNION ALL
+                      SELECT 'created', substr(created_at, 1, 10), COUNT(*), 0 FROM documents
+                      WHERE status = 'active' AND created_at IS NOT NULL GROUP BY substr(created_at, 1, 10)''')
+
+def _migration_title_indexes(cursor):
+    # Keyset pagination of listings sorted by name
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_documents_status_title ON documents (status, title)')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS idx_documents_status_category_title
+                      ON documents (status, category_id, title)''')
+
+def _migration_version_chunks(cursor):
+    # Earlier versions are stored as compressed chunks shared between all
+    # versions; version_manifest lists each version's chunks in order.
+    cursor.execute('''CREATE TABLE IF NOT EXISTS version_chunks (
+        hash TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        stored_size INTEGER NOT NULL,
+        compressed INTEGER NOT NULL,
+        data BLOB NOT NULL
+    )''')
+    cursor.execute('''CREATE TABLE IF NOT EXISTS version_manifest (
+        version_id INTEGER NOT NULL,
+        seq INTEGER NOT NULL,
+        chunk_hash TEXT NOT NULL,
+        PRIMARY KEY (version_id, seq)
+    ) WITHOUT ROWID''')
+    _add_column_if_missing(cursor, 'document_versions', 'file_size', 'INTEGER')
+    _add_column_if_missing(cursor, 'document_versions', 'chunk_count', 'INTEGER')
+
+def _stored_bytes_delta(part, size, condition):
+    # Adds size to the ('stored', part) row of document_stats when condition holds
+    return f'''INSERT INTO document_stats (kind, day, documents, total_size)
+        SELECT 'stored', '{part}', 0, {size} WHERE {condition}
+        ON CONFLICT (kind, day) DO UPDATE SET total_size = total_size + excluded.total_size;'''
+
+def _migration_payload_compression(cursor):
+    # Payloads may be stored compressed, so blobs records the stored size next
+    # to the original one. document_stats gains trigger-maintained totals of
+    # the bytes held for referenced blobs and for version chunks.
+    _add_column_if_missing(cursor, 'blobs', 'stored_size', 'INTEGER')
+    _add_column_if_missing(cursor, 'blob_data', 'compressed', 'INTEGER NOT NULL DEFAULT 0')
+    cursor.execute('UPDATE blobs SET stored_size = size WHERE stored_size IS NULL')
+    
+    cursor.execute(f'''CREATE TRIGGER blobs_stats_insert AFTER INSERT ON blobs BEGIN
+        {_stored_bytes_delta('documents', 'new.stored_size', 'new.ref_count > 0')}
+    END''')
+    cursor.execute(f'''CREATE TRIGGER blobs_stats_update AFTER UPDATE OF ref_count, stored_size ON blobs BEGIN
+        {_stored_bytes_delta('documents', '-old.stored_size', 'old.ref_count > 0')}
+        {_stored_bytes_delta('documents', 'new.stored_size', 'new.ref_count > 0')}
+    END''')
+    cursor.execute(f'''CREATE TRIGGER blobs_stats_delete AFTER DELETE ON blobs BEGIN
+        {_stored_bytes_delta('documents', '-old.stored_size', 'old.ref_count > 0')}
+    END''')
+    cursor.execute(f'''CREATE TRIGGER version_chunks_stats_insert AFTER INSERT ON version_chunks BEGIN
+        {_stored_bytes_delta('versions', 'new.stored_size', '1')}
+    END''')
+    cursor.execute('''INSERT INTO document_stats (kind, day, documents, total_size)
+                      SELECT 'stored', 'documents', 0, COALESCE(SUM(stored_size), 0) FROM blobs WHERE ref_count > 0
+                      UNION ALL
+                      SELECT 'stored', 'versions', 0, COALESCE(SUM(stored_size), 0) FROM version_chunks''')
+
+def _migration_import_files(cursor):
+    # Files brought in by bulk imports, so an interrupted import resumes where it stopped
+    cursor.execute('''CREATE TABLE IF NOT EXISTS import_files (
+        source TEXT NOT NULL,
+        path TEXT NOT NULL,
+        document_id INTEGER,
+        imported_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (source, path)
+    ) WITHOUT ROWID''')
+
+def _migration_activity_archives(cursor):
+    # One row per month of activity moved out of activity_log into an archive file
+    cursor.execute('''CREATE TABLE IF NOT EXISTS activity_archives (
+        month TEXT PRIMARY KEY,
+        file_name TEXT NOT NULL,
+        row_count INTEGER NOT NULL,
+        first_at TIMESTAMP,
+        last_at TIMESTAMP,
+        file_size INTEGER NOT NULL,
+        sha256 TEXT NOT NULL,
+        archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    ) WITHOUT ROWID''')
+
+def _migration_activity_filter_indexes(cursor):
+    # Audit searches filter on one of user, document or action and read a time
+    # range newest first; the index's trailing rowid also orders ties by id.
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_activity_log_user_created ON activity_log (user, created_at)')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS idx_activity_log_document_created
+                      ON activity_log (document_id, created_at)''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_activity_log_action_created ON activity_log (action, created_at)')
+
+def _compliance_deadline_rows(row):
+    # The expiry and review deadlines of an active document, as
+    # (due_date, kind, document_id) rows
+    return f'''SELECT due_date, kind, {row}.id FROM (
+            SELECT {row}.expiry_date as due_date, 'expiry' as kind
+            UNION ALL SELECT {row}.review_date, 'review'
+        ) WHERE due_date IS NOT NULL AND {row}.status = 'active'
+    '''
+
+def _migration_compliance_deadlines(cursor):
+    # Every active document's expiry and review dates in date order, kept
+    # current by triggers, so deadline windows, urgency counts and the next
+    # deadlines are each one range of the primary key.
+    cursor.execute('''CREATE TABLE IF NOT EXISTS compliance_deadlines (
+        due_date TEXT NOT NULL,
+        kind TEXT NOT NULL,
+        document_id INTEGER NOT NULL,
+        PRIMARY KEY (due_date, kind, document_id)
+    ) WITHOUT ROWID''')
+    cursor.execute(f'''CREATE TRIGGER compliance_deadlines_insert AFTER INSERT ON documents BEGIN
+        INSERT OR IGNORE INTO compliance_deadlines (due_date, kind, document_id) {_compliance_deadline_rows('new')};
+    END''')
+    cursor.execute('''CREATE TRIGGER compliance_deadlines_delete AFTER DELETE ON documents BEGIN
+        DELETE FROM compliance_deadlines WHERE due_date = old.expiry_date AND kind = 'expiry' AND document_id = old.id;
+        DELETE FROM compliance_deadlines WHERE due_date = old.review_date AND kind = 'review' AND document_id = old.id;
+    END''')
+    cursor.execute(f'''CREATE TRIGGER compliance_deadlines_update
+        AFTER UPDATE OF status, expiry_date, review_date ON documents BEGIN
+        DELETE FROM compliance_deadlines WHERE due_date = old.expiry_date AND kind = 'expiry' AND document_id = old.id;
+        DELETE FROM compliance_deadlines WHERE due_date = old.review_date AND kind = 'review' AND document_id = old.id;
+        INSERT OR IGNORE INTO compliance_deadlines (due_date, kind, document_id) {_compliance_deadline_rows('new')};
+    END''')
+    cursor.execute('''INSERT OR IGNORE INTO compliance_deadlines (due_date, kind, document_id)
+                      SELECT expiry_date, 'expiry', id FROM documents
+                      WHERE status = 'active' AND expiry_date IS NOT NULL
+                      UNION ALL
+                      SELECT review_date, 'review', id FROM documents
+                      WHERE status = 'active' AND review_date IS NOT NULL''')
+
+def _migration_compliance_digests(cursor):
+    # Runs of the compliance digest job, newest last, and the deadlines it has
+    # reported, so each run only re-evaluates what changed since the one before.
+    cursor.execute('''CREATE TABLE IF NOT EXISTS compliance_digest_runs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        run_at TIMESTAMP NOT NULL,
+        run_date TEXT NOT NULL,
+        horizon_date TEXT NOT NULL,
+        new_upcoming INTEGER NOT NULL DEFAULT 0,
+        new_overdue INTEGER NOT NULL DEFAULT 0,
+        resolved INTEGER NOT NULL DEFAULT 0
+    )''')
+    cursor.execute('''CREATE TABLE IF NOT EXISTS compliance_digest_alerts (
+        document_id INTEGER NOT NULL,
+        kind TEXT NOT NULL,
+        due_date TEXT NOT NULL,
+        status TEXT NOT NULL,
+        reported_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (document_id, kind)
+    ) WITHOUT ROWID''')
+
+def _migration_document_filter_indexes(cursor):
+    # Search filters on file type, uploader and department, newest first
+    cursor.execute('''CREATE INDEX IF NOT EXISTS idx_documents_status_type_updated
+                      ON documents (status, file_type, updated_at)''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS idx_documents_status_uploader_updated
+                      ON documents (status, uploaded_by, updated_at)''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS idx_documents_status_department_updated
+                      ON documents (status, department, updated_at)''')
+
+def _document_tags_insert(row):
+    # Links a document row to its tags, parsed from the JSON list in row.tags
+    return f'''INSERT OR IGNORE INTO tags (name)
+        SELECT lower(trim(value)) FROM json_each(CASE WHEN json_valid({row}.tags) THEN {row}.tags END)
+        WHERE type = 'text' AND length(trim(value)) > 0;
+        INSERT OR IGNORE INTO document_tags (document_id, tag_id)
+        SELECT {row}.id, t.id FROM json_each(CASE WHEN json_valid({row}.tags) THEN {row}.tags END) j
+        JOIN tags t ON t.name = lower(trim(j.value))
+        WHERE j.type = 'text';'''
+
+def _migration_document_tags(cursor):
+    # One row per distinct tag and per document-tag pair, kept in step with
+    # the JSON list in documents.tags by triggers. documents.tags stays as the
+    # display and full-text copy.
+    cursor.execute('''CREATE TABLE IF NOT EXISTS tags (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT UNIQUE NOT NULL
+    )''')
+    cursor.execute('''CREATE TABLE IF NOT EXISTS document_tags (
+        document_id INTEGER NOT NULL,
+        tag_id INTEGER NOT NULL,
+        PRIMARY KEY (document_id, tag_id)
+    ) WITHOUT ROWID''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_document_tags_tag ON document_tags (tag_id, document_id)')
+    cursor.execute(f'''CREATE TRIGGER document_tags_insert AFTER INSERT ON documents BEGIN
+        {_document_tags_insert('new')}
+    END''')
+    cursor.execute(f'''CREATE TRIGGER document_tags_update AFTER UPDATE OF tags ON documents BEGIN
+        DELETE FROM document_tags WHERE document_id = old.id;
+        {_document_tags_insert('new')}
+    END''')
+    cursor.execute('''CREATE TRIGGER document_tags_delete AFTER DELETE ON documents BEGIN
+        DELETE FROM document_tags WHERE document_id = old.id;
+    END''')
+    # Existing documents, parsed the same way as by the triggers
+    cursor.execute('''INSERT OR IGNORE INTO tags (name)
+                      SELECT lower(trim(j.value))
+                      FROM documents d, json_each(CASE WHEN json_valid(d.tags) THEN d.tags END) j
+                      WHERE j.type = 'text' AND length(trim(j.value)) > 0''')
+    cursor.execute('''INSERT OR IGNORE INTO document_tags (document_id, tag_id)
+                      SELECT d.id, t.id
+                      FROM documents d, json_each(CASE WHEN json_valid(d.tags) THEN d.tags END) j
+                      JOIN tags t ON t.name = lower(trim(j.value))
+                      WHERE j.type = 'text' ''')
+
+def _analytics_storage_delta(row, sign, day):
+    # Adds (sign '+') or removes (sign '-') an active document's contribution
+    # to the running storage totals of its category and department on day.
+    return f'''INSERT INTO analytics_daily (kind, day, category_id, department, documents, bytes)
+        SELECT 'storage', {day}, COALESCE({row}.category_id, 0), COALESCE({row}.department, ''),
+               {sign}1, {sign}COALESCE({row}.file_size, 0)
+        WHERE {row}.status = 'active'
+        ON CONFLICT (kind, day, category_id, department) DO UPDATE SET documents = documents + excluded.documents,
+                                                                       bytes = bytes + excluded.bytes;'''
+
+def _fill_analytics(cursor):
+    # Rollups of the documents table and the live activity log as they stand
+    cursor.execute('''INSERT INTO analytics_daily (kind, day, category_id, department, documents, bytes)
+                      SELECT 'upload', substr(created_at, 1, 10), COALESCE(category_id, 0), COALESCE(department, ''),
+                             COUNT(*), COALESCE(SUM(file_size), 0)
+                      FROM documents WHERE created_at IS NOT NULL GROUP BY 2, 3, 4
+                      UNION ALL
+                      SELECT 'storage', substr(created_at, 1, 10), COALESCE(category_id, 0), COALESCE(department, ''),
+                             COUNT(*), COALESCE(SUM(file_size), 0)
+                      FROM documents WHERE status = 'active' AND created_at IS NOT NULL GROUP BY 2, 3, 4
+                      UNION ALL
+                      SELECT 'version', substr(v.created_at, 1, 10), COALESCE(d.category_id, 0),
+                             COALESCE(d.department, ''), COUNT(*), 0
+                      FROM document_versions v JOIN documents d ON d.id = v.document_id
+                      WHERE v.created_at IS NOT NULL GROUP BY 2, 3, 4''')
+    cursor.execute('''INSERT INTO activity_daily (day, action, department, events)
+                      SELECT substr(a.created_at, 1, 10), a.action, COALESCE(d.department, ''), COUNT(*)
+                      FROM activity_log a LEFT JOIN documents d ON d.id = a.document_id
+                      WHERE a.created_at IS NOT NULL GROUP BY 1, 2, 3''')
+
+def _migration_analytics_rollups(cursor):
+    # Per-day rollups the Analytics page reads instead of documents and
+    # activity_log. analytics_daily holds uploads, new versions and net
+    # changes to active documents and bytes ('storage', summed over time for
+    # totals) by category and department; activity_daily holds activity
+    # events by action and department; compliance_daily a daily snapshot of
+    # review and expiry deadlines. The first two are kept current by triggers.
+    cursor.execute('''CREATE TABLE IF NOT EXISTS analytics_daily (
+        kind TEXT NOT NULL,
+        day TEXT NOT NULL,
+        category_id INTEGER NOT NULL,
+        department TEXT NOT NULL,
+        documents INTEGER NOT NULL DEFAULT 0,
+        bytes INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (kind, day, category_id, department)
+    ) WITHOUT ROWID''')
+    cursor.execute('''CREATE TABLE IF NOT EXISTS activity_daily (
+        day TEXT NOT NULL,
+        action TEXT NOT NULL,
+        department TEXT NOT NULL,
+        events INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, action, department)
+    ) WITHOUT ROWID''')
+    cursor.execute('''CREATE TABLE IF NOT EXISTS compliance_daily (
+        day TEXT PRIMARY KEY,
+        reviews INTEGER NOT NULL,
+        reviews_overdue INTEGER NOT NULL,
+        expiries INTEGER NOT NULL,
+        expired INTEGER NOT NULL
+    )''')
+    cursor.execute(f'''CREATE TRIGGER analytics_document_insert AFTER INSERT ON documents BEGIN
+        INSERT INTO analytics_daily (kind, day, category_id, department, documents, bytes)
+        VALUES ('upload', substr(COALESCE(new.created_at, CURRENT_TIMESTAMP), 1, 10), COALESCE(new.category_id, 0),
+                COALESCE(new.department, ''), 1, COALESCE(new.file_size, 0))
+        ON CONFLICT (kind, day, category_id, department) DO UPDATE SET documents = documents + 1,
+                                                                       bytes = bytes + excluded.bytes;
+        {_analytics_storage_delta('new', '+', "substr(COALESCE(new.created_at, CURRENT_TIMESTAMP), 1, 10)")}
+    END''')
+    cursor.execute(f'''CREATE TRIGGER analytics_document_update
+        AFTER UPDATE OF status, file_size, category_id, department ON documents BEGIN
+        {_analytics_storage_delta('old', '-', "date('now')")}
+        {_analytics_storage_delta('new', '+', "date('now')")}
+    END''')
+    cursor.execute('''CREATE TRIGGER analytics_document_version AFTER UPDATE OF version ON documents
+        WHEN new.version > old.version BEGIN
+        INSERT INTO analytics_daily (kind, day, category_id, department, documents, bytes)
+        VALUES ('version', date('now'), COALESCE(new.category_id, 0), COALESCE(new.department, ''), 1, 0)
+        ON CONFLICT (kind, day, category_id, department) DO UPDATE SET documents = documents + 1;
+    END''')
+    cursor.execute(f'''CREATE TRIGGER analytics_document_delete AFTER DELETE ON documents BEGIN
+        {_analytics_storage_delta('old', '-', "date('now')")}
+    END''')
+    # Archiving moves rows out of activity_log without a trigger, so the
+    # rollup keeps counting archived months
+    cursor.execute('''CREATE TRIGGER analytics_activity_insert AFTER INSERT ON activity_log BEGIN
+        INSERT INTO activity_daily (day, action, department, events)
+        VALUES (substr(COALESCE(new.created_at, CURRENT_TIMESTAMP), 1, 10), new.action,
+                COALESCE((SELECT department FROM documents WHERE id = new.document_id), ''), 1)
+        ON CONFLICT (day, action, department) DO UPDATE SET events = events + 1;
+    END''')
+    _fill_analytics(cursor)
+
+def _migration_activity_archive_keys(cursor):
+    # The distinct users, actions and document ids in each archived month, so
+    # a filtered audit search opens only the archives that can match.
+    # Archives written before this have keys_indexed = 0 until the archiver
+    # indexes them, and are opened for every search meanwhile.
+    cursor.execute('''CREATE TABLE IF NOT EXISTS activity_archive_keys (
+        kind TEXT NOT NULL,
+        value TEXT NOT NULL,
+        month TEXT NOT NULL,
+        PRIMARY KEY (kind, value, month)
+    ) WITHOUT ROWID''')
+    _add_column_if_missing(cursor, 'activity_archives', 'keys_indexed', 'INTEGER NOT NULL DEFAULT 0')
+
+# Ordered schema changes applied after the base tables exist. Append new steps
+# with the next version number; never edit or reorder applied ones.
+MIGRATIONS = [
+    (1, 'Content-addressed blob store', _migration_blob_store),
+    (2, 'Indexes for listing, compliance and audit queries', _migration_access_path_indexes),
+    (3, 'Full-text search index', _migration_full_text_search),
+    (4, 'Extracted document text', _migration_document_text),
+    (5, 'Trigger-maintained dashboard statistics', _migration_dashboard_stats),
+    (6, 'Indexes for listings sorted by name', _migration_title_indexes),
+    (7, 'Chunked, compressed version storage', _migration_version_chunks),
+    (8, 'Compressed payloads and stored-size totals', _migration_payload_compression),
+    (9, 'Bulk import progress', _migration_import_files),
+    (10, 'Monthly activity log archives', _migration_activity_archives),
+    (11, 'Indexes for filtered audit searches', _migration_activity_filter_indexes),
+    (12, 'Trigger-maintained compliance deadline calendar', _migration_compliance_deadlines),
+    (13, 'Compliance digest runs and reported deadlines', _migration_compliance_digests),
+    (14, 'Indexes for document search filters', _migration_document_filter_indexes),
+    (15, 'Normalized document tags', _migration_document_tags),
+    (16, 'Daily analytics rollups', _migration_analytics_rollups),
+    (17, 'Searchable keys of activity archives', _migration_activity_archive_keys),
+]
+
+def get_schema_version(conn):
+    row = conn.execute('SELECT MAX(version) FROM schema_version').fetchone()
+    return row[0] or 0
+
+def run_migrations(conn):
+    # Applies any pending MIGRATIONS; returns the number of steps applied
+    conn.execute('''CREATE TABLE IF NOT EXISTS schema_version (
+        version INTEGER PRIMARY KEY,
+        description TEXT,
+        applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )''')
+    conn.commit()
+    if get_schema_version(conn) >= MIGRATIONS[-1][0]:
+        return 0
+    
+    applied = 0
+    for version, description, migrate in MIGRATIONS:
+        # Each step runs in its own write transaction; re-checking the version
+        # inside it keeps concurrent app processes from applying a step twice.
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if get_schema_version(conn) < version:
+                cursor = conn.cursor()
+                migrate(cursor)
+                cursor.execute('INSERT INTO schema_version (version, description) VALUES (?, ?)',
+                               (version, description))
+                applied += 1
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+    return applied
+
+# Database file the query cache was filled from
+_cache_database_path = None
+
 def init_database():
-    conn = get_connection()
+    # Runs on every Streamlit rerun, so the query cache is only cleared when
+    # the file changed underneath it: another DATABASE_PATH or a migration step
+    global _cache_database_path
+    with connection() as conn:
+        migrated = _create_schema(conn)
+    if migrated or _cache_database_path != DATABASE_PATH:
+        clear_query_cache()
+        _cache_database_path = DATABASE_PATH
+
+def _create_schema(conn):
     cursor = conn.cursor()
     
     cursor.execute('''CREATE TABLE IF NOT EXISTS users (
@@ -87,6 +1332,7 @@ def init_database():
     )''')
     
     conn.commit()
+    migrated = run_migrations(conn)
     
     default_categories = [
         ('Policies & Procedures', 'Organizational policies and standard operating procedures', '#0d9488', '📋'),
@@ -107,158 +1353,1585 @@ def init_database():
                           (name, desc, color, icon))
         except:
             pass
-    
-    conn.commit()
-    conn.close()
+    return migrated
+
+# Callables run with the document id after add_document or
+# add_document_version commits, i.e. whenever a document gets a new file
+_document_added_listeners = []
+
+def on_document_added(callback):
+    if callback not in _document_added_listeners:
+        _document_added_listeners.append(callback)
 
 def add_document(title, description, category_id, file_name, file_type, file_size, file_data, 
                  uploaded_by, department=None, review_date=None, expiry_date=None, tags=None):
-    conn = get_connection()
-    cursor = conn.cursor()
+    # file_data may be bytes or a binary file object. The payload is written to
+    # the blob store in CHUNK_SIZE pieces before the row is inserted; identical
+    # payloads share one stored blob.
+    content_hash, file_size, stored_size = store_payload(file_data, file_type)
+    with connection() as conn:
+        cursor = conn.cursor()
+        
+        cursor.execute('''INSERT INTO documents (title, description, category_id, file_name, file_type, 
+                          file_size, content_hash, uploaded_by, department, review_date, expiry_date, tags)
+                          VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                       (title, description, category_id, file_name, file_type, file_size, content_hash,
+                        uploaded_by, department, review_date, expiry_date, json.dumps(tags) if tags else None))
+        
+        doc_id = cursor.lastrowid
+        _acquire_blob(cursor, content_hash, file_size, stored_size)
+        cursor.execute('''INSERT INTO activity_log (user, action, document_id, document_title, details)
+                          VALUES (?, ?, ?, ?, ?)''',
+                       (uploaded_by, 'upload', doc_id, title, f'New document uploaded: {file_name}'))
+    _invalidate('documents', 'activity')
     
-    cursor.execute('''INSERT INTO documents (title, description, category_id, file_name, file_type, 
-                      file_size, file_data, uploaded_by, department, review_date, expiry_date, tags)
-                      VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-                   (title, description, category_id, file_name, file_type, file_size, file_data,
-                    uploaded_by, department, review_date, expiry_date, json.dumps(tags) if tags else None))
+    # The garbage collector may have removed an unreferenced copy between the
+    # store write and the commit; now that the blob is referenced, restore it.
+    if not _blob_store.exists(content_hash):
+        if hasattr(file_data, 'seek'):
+            file_data.seek(0)
+        store_payload(file_data, file_type)
     
-    doc_id = cursor.lastrowid
-    cursor.execute('''INSERT INTO activity_log (user, action, document_id, document_title, details)
-                      VALUES (?, ?, ?, ?, ?)''',
-                   (uploaded_by, 'upload', doc_id, title, f'New document uploaded: {file_name}'))
-    
-    conn.commit()
-    conn.close()
+    for listener in _document_added_listeners:
+        listener(doc_id)
     return doc_id
 
-def get_all_documents(category_id=None, search_term=None, status='active'):
-    conn = get_connection()
-    cursor = conn.cursor()
+def add_documents(documents, uploaded_by, import_source=None):
+    # Bulk add_document for imports. Each dict in documents has add_document's
+    # fields and either file_data or the content_hash, file_size and
+    # stored_size returned by an earlier store_payload call, plus an open
+    # callable returning the file again in case the garbage collector removed
+    # the stored copy before the batch referenced it. Every row goes in
+    # with executemany in one write transaction, so the new documents get
+    # consecutive ids, which are returned. With import_source, each dict's
+    # source_path is recorded in import_files for resuming the import.
+    rows = []
+    for doc in documents:
+        if 'content_hash' in doc:
+            rows.append((doc, doc['content_hash'], doc['file_size'], doc['stored_size']))
+        else:
+            rows.append((doc, *store_payload(doc['file_data'], doc.get('file_type'))))
+    if not rows:
+        return []
+    
+    blob_refs = {}
+    for doc, content_hash, file_size, stored_size in rows:
+        ref = blob_refs.setdefault(content_hash, [content_hash, file_size, stored_size, 0])
+        ref[3] += 1
+    
+    with connection() as conn:
+        if not conn.in_transaction:
+            conn.execute('BEGIN IMMEDIATE')
+        cursor = conn.cursor()
+        # With the write lock held, AUTOINCREMENT hands out the ids straight
+        # after the current sequence value
+        row = cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = 'documents'").fetchone()
+        first_id = (row[0] if row else 0) + 1
+        doc_ids = list(range(first_id, first_id + len(rows)))
+        
+        cursor.executemany('''INSERT INTO documents (title, description, category_id, file_name, file_type,
+                              file_size, content_hash, uploaded_by, department, review_date, expiry_date, tags)
+                              VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                           [(doc['title'], doc.get('description'), doc.get('category_id'), doc['file_name'],
+                             doc.get('file_type'), file_size, content_hash, uploaded_by, doc.get('department'),
+                             doc.get('review_date'), doc.get('expiry_date'),
+                             json.dumps(doc['tags']) if doc.get('tags') else None)
+                            for doc, content_hash, file_size, stored_size in rows])
+        last_id = cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = 'documents'").fetchone()[0]
+        if last_id != doc_ids[-1]:
+            raise sqlite3.IntegrityError(f'Expected document ids {first_id}-{doc_ids[-1]}, sequence is at {last_id}')
+        
+        cursor.executemany('''INSERT INTO blobs (hash, size, stored_size, ref_count) VALUES (?, ?, ?, ?)
+                              ON CONFLICT(hash) DO UPDATE SET ref_count = ref_count + excluded.ref_count,
+                              released_at = NULL''', list(blob_refs.values()))
+        # The garbage collector deletes blob files under the write lock, so a
+        # payload present now stays; restore any it removed before this batch
+        # referenced them
+        restored = set()
+        for doc, content_hash, file_size, stored_size in rows:
+            if content_hash in restored or _blob_store.exists(content_hash):
+                continue
+            if 'file_data' in doc:
+                if hasattr(doc['file_data'], 'seek'):
+                    doc['file_data'].seek(0)
+                store_payload(doc['file_data'], doc.get('file_type'))
+            elif 'open' in doc:
+                with doc['open']() as stream:
+                    store_payload(stream, doc.get('file_type'))
+            else:
+                raise FileNotFoundError(f"Payload {content_hash} of {doc['file_name']} is no longer stored")
+            restored.add(content_hash)
+        cursor.executemany('''INSERT INTO activity_log (user, action, document_id, document_title, details)
+                              VALUES (?, ?, ?, ?, ?)''',
+                           [(uploaded_by, 'upload', doc_id, doc['title'],
+                             f"Imported from {doc['source_path']}" if doc.get('source_path')
+                             else f"New document uploaded: {doc['file_name']}")
+                            for doc_id, (doc, *_) in zip(doc_ids, rows)])
+        # Text extraction picks these up on its next pass
+        cursor.executemany("INSERT OR IGNORE INTO document_text (document_id) VALUES (?)",
+                           [(doc_id,) for doc_id in doc_ids])
+        if import_source:
+            cursor.executemany('INSERT INTO import_files (source, path, document_id) VALUES (?, ?, ?)',
+                               [(import_source, doc['source_path'], doc_id)
+                                for doc_id, (doc, *_) in zip(doc_ids, rows)])
+    _invalidate('documents', 'activity', 'document_text')
+    return doc_ids
+
+def get_imported_paths(import_source):
+    with connection() as conn:
+        rows = conn.execute('SELECT path FROM import_files WHERE source = ?', (import_source,)).fetchall()
+    return {row[0] for row in rows}
+
+def add_document_version(doc_id, file_name, file_type, file_size, file_data, uploaded_by, changes_summary=None):
+    # Replaces a document's file and returns the new version number. The new
+    # file becomes the document's blob-store payload; the outgoing one is
+    # archived in document_versions as compressed, deduplicated chunks and
+    # its blob released. The outgoing payload is chunked before the write
+    # lock is taken, and again if another version replaced it meanwhile.
+    content_hash, file_size, stored_size = store_payload(file_data, file_type)
+    while True:
+        with connection() as conn:
+            outgoing = conn.execute('SELECT version FROM documents WHERE id = ?', (doc_id,)).fetchone()
+        if outgoing is None:
+            raise ValueError(f'Document {doc_id} does not exist')
+        chunks = None
+        reader = _open_payload('documents', doc_id)
+        if reader is not None:
+            with reader:
+                chunks = _store_version_chunks(reader)
+        
+        with connection() as conn:
+            if not conn.in_transaction:
+                conn.execute('BEGIN IMMEDIATE')
+            cursor = conn.cursor()
+            cursor.execute('''SELECT title, file_name, version, uploaded_by, updated_at, content_hash FROM documents
+                              WHERE id = ?''', (doc_id,))
+            current = cursor.fetchone()
+            if current is None:
+                raise ValueError(f'Document {doc_id} does not exist')
+            if current['version'] != outgoing['version']:
+                continue
+            
+            cursor.execute('''INSERT INTO document_versions (document_id, version, file_name, changes_summary,
+                              uploaded_by, created_at) VALUES (?, ?, ?, ?, ?, ?)''',
+                           (doc_id, current['version'], current['file_name'],
+                            f"Replaced by version {current['version'] + 1}" + (f': {changes_summary}' if changes_summary else ''),
+                            current['uploaded_by'], current['updated_at']))
+            version_id = cursor.lastrowid
+            if chunks is not None:
+                size, hashes = chunks
+                _record_version_manifest(cursor, version_id, hashes)
+                cursor.execute('UPDATE document_versions SET file_size = ?, chunk_count = ? WHERE id = ?',
+                               (size, len(hashes), version_id))
+            if current['content_hash']:
+                _release_blob(cursor, current['content_hash'])
+            
+            new_version = current['version'] + 1
+            cursor.execute('''UPDATE documents SET file_name = ?, file_type = ?, file_size = ?, content_hash = ?,
+                              file_data = NULL, version = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?''',
+                           (file_name, file_type, file_size, content_hash, new_version, doc_id))
+            _acquire_blob(cursor, content_hash, file_size, stored_size)
+            cursor.execute('''INSERT INTO activity_log (user, action, document_id, document_title, details)
+                              VALUES (?, ?, ?, ?, ?)''',
+                           (uploaded_by, 'new_version', doc_id, current['title'],
+                            f'Version {new_version} uploaded: {file_name}' + (f' ({changes_summary})' if changes_summary else '')))
+        break
+    _invalidate('documents', 'versions', 'activity')
     
-    query = '''SELECT d.*, c.name as category_name, c.color as category_color, c.icon as category_icon
-               FROM documents d LEFT JOIN categories c ON d.category_id = c.id WHERE d.status = ?'''
-    params = [status]
+    if not _blob_store.exists(content_hash):
+        if hasattr(file_data, 'seek'):
+            file_data.seek(0)
+        store_payload(file_data, file_type)
     
+    for listener in _document_added_listeners:
+        listener(doc_id)
+    return new_version
+
+def _rebuild_search_index(cursor):
+    cursor.execute('DELETE FROM documents_fts')
+    cursor.execute('''INSERT INTO documents_fts (rowid, title, description, tags, content)
+                      SELECT d.id, d.title, d.description, d.tags, t.content
+                      FROM documents d LEFT JOIN document_text t ON t.document_id = d.id''')
+
+def rebuild_search_index():
+    with connection() as conn:
+        _rebuild_search_index(conn.cursor())
+        conn.execute("INSERT INTO documents_fts (documents_fts) VALUES ('optimize')")
+        indexed = conn.execute('SELECT COUNT(*) FROM documents_fts').fetchone()[0]
+    _invalidate('documents', 'document_text')
+    return indexed
+
+def build_search_query(search_term):
+    # Turns user input into an FTS5 query: "quoted text" is matched as a
+    # phrase, every other word as a prefix of the title, description or file
+    # text, and all parts must match. Tags are matched as whole words only,
+    # so "fire" does not find a document tagged "fireproof". Parts with no
+    # letters or digits (such as "&" or "-") tokenize to nothing and are
+    # dropped, since an empty phrase would match no document.
+    parts = []
+    for phrase, word in re.findall(r'"([^"]*)"|(\S+)', search_term or ''):
+        text = (phrase or word).replace('"', '').strip()
+        if not re.search(r'[^\W_]', text):
+            continue
+        if phrase:
+            parts.append(f'"{text}"')
+        else:
+            parts.append(f'({{title description content}} : "{text}"* OR tags : "{text}")')
+    return ' AND '.join(parts) or None
+
+class DocumentFilter:
+    """Conditions on document metadata that compile to one parameterized WHERE clause.
+
+    Immutable and hashable, so filters can be cached query arguments; where()
+    and & return a new filter with the conditions combined. Dates are
+    inclusive days, file_types a FILE_TYPE_GROUPS name or file extensions,
+    tags_all and tags_any tag names the document must have all or any of.
+    """
+
+    FIELDS = ('status', 'created_from', 'created_to', 'updated_from', 'updated_to', 'file_types',
+              'uploaded_by', 'department', 'has_expiry', 'tags_all', 'tags_any')
+
+    def __init__(self, **conditions):
+        unknown = set(conditions) - set(self.FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown document filter: {', '.join(sorted(unknown))}")
+        file_types = conditions.get('file_types')
+        if file_types is not None:
+            if isinstance(file_types, str):
+                file_types = FILE_TYPE_GROUPS.get(file_types, (file_types,))
+            conditions['file_types'] = tuple(sorted({value.lower().lstrip('.') for value in file_types}))
+        for field in ('tags_all', 'tags_any'):
+            if conditions.get(field) is not None:
+                tags = [conditions[field]] if isinstance(conditions[field], str) else conditions[field]
+                conditions[field] = tuple(sorted({tag.strip().lower() for tag in tags if tag.strip()})) or None
+        for field in ('created_from', 'created_to', 'updated_from', 'updated_to'):
+            if conditions.get(field) is not None:
+                conditions[field] = str(conditions[field])[:10]
+        self._conditions = tuple(sorted((field, value) for field, value in conditions.items() if value is not None))
+
+    def where(self, **conditions):
+        return DocumentFilter(**{**dict(self._conditions), **conditions})
+
+    def __and__(self, other):
+        return self.where(**dict(other._conditions))
+
+    def get(self, field, default=None):
+        return dict(self._conditions).get(field, default)
+
+    def __bool__(self):
+        return bool(self._conditions)
+
+    def __eq__(self, other):
+        return isinstance(other, DocumentFilter) and self._conditions == other._conditions
+
+    def __hash__(self):
+        return hash(self._conditions)
+
+    def __repr__(self):
+        return f"DocumentFilter({', '.join(f'{field}={value!r}' for field, value in self._conditions)})"
+
+    def compile(self, alias='d'):
+        # (conditions, params) for every field except status, which the
+        # listing functions combine with their own status argument
+        conditions = []
+        params = []
+        for column, start, end in (('created_at', 'created_from', 'created_to'),
+                                   ('updated_at', 'updated_from', 'updated_to')):
+            if self.get(start):
+                conditions.append(f'{alias}.{column} >= ?')
+                params.append(self.get(start))
+            if self.get(end):
+                conditions.append(f'{alias}.{column} < ?')
+                params.append((date.fromisoformat(self.get(end)) + timedelta(days=1)).isoformat())
+        file_types = self.get('file_types')
+        if file_types:
+            values = sorted({variant for value in file_types for variant in (value, value.upper())})
+            conditions.append(f"{alias}.file_type IN ({', '.join('?' * len(values))})")
+            params.extend(values)
+        for field in ('uploaded_by', 'department'):
+            if self.get(field):
+                conditions.append(f'{alias}.{field} = ?')
+                params.append(self.get(field))
+        if self.get('has_expiry') is not None:
+            conditions.append(f"{alias}.expiry_date IS {'NOT NULL' if self.get('has_expiry') else 'NULL'}")
+        for field in ('tags_all', 'tags_any'):
+            tags = self.get(field)
+            if tags:
+                # Served by the tags name index and idx_document_tags_tag
+                query = f'''{alias}.id IN (SELECT dt.document_id FROM tags t
+                           JOIN document_tags dt ON dt.tag_id = t.id
+                           WHERE t.name IN ({', '.join('?' * len(tags))})'''
+                conditions.append(query + (' GROUP BY dt.document_id HAVING COUNT(*) = ?)'
+                                           if field == 'tags_all' else ')'))
+                params.extend(tags)
+                if field == 'tags_all':
+                    params.append(len(tags))
+        return conditions, params
+
+def _listing_conditions(status, category_id, filters):
+    # WHERE conditions and params shared by the listing, search and count queries
+    filters = filters or DocumentFilter()
+    conditions = ['d.status = ?']
+    params = [filters.get('status', status)]
     if category_id:
-        query += ' AND d.category_id = ?'
+        conditions.append('d.category_id = ?')
         params.append(category_id)
+    filter_conditions, filter_params = filters.compile()
+    return conditions + filter_conditions, params + filter_params
+
+@_cached('documents', 'categories', 'document_text')
+def search_documents(search_term, category_id=None, status='active', limit=50, after=None, filters=None):
+    # Ranked full-text search. Rows carry the bm25 rank (lower is better), the
+    # title with matches highlighted and snippets of the description and of
+    # the extracted file text. after is the page_cursor(row, 'rank') of the
+    # last row of the previous page; filters is a DocumentFilter.
+    match = build_search_query(search_term)
+    if not match:
+        return []
+    weights = ', '.join(str(weight) for weight in SEARCH_WEIGHTS)
+    with connection() as conn:
+        cursor = conn.cursor()
+        query = f'''SELECT {_document_columns()}, c.name as category_name, c.color as category_color,
+                           c.icon as category_icon,
+                           bm25(documents_fts, {weights}) as rank,
+                           highlight(documents_fts, 0, ?, ?) as title_highlight,
+                           snippet(documents_fts, 1, ?, ?, '…', 24) as snippet,
+                           snippet(documents_fts, 3, ?, ?, '…', 24) as content_snippet
+                    FROM documents_fts
+                    JOIN documents d ON d.id = documents_fts.rowid
+                    LEFT JOIN categories c ON d.category_id = c.id
+                    WHERE documents_fts MATCH ?'''
+        params = [HIGHLIGHT_START, HIGHLIGHT_END] * 3 + [match]
+        
+        conditions, condition_params = _listing_conditions(status, category_id, filters)
+        query += ''.join(f' AND {condition}' for condition in conditions)
+        params.extend(condition_params)
+        
+        if after:
+            # documents_fts has a hidden rank column, so the alias cannot be used here
+            query += f' AND (bm25(documents_fts, {weights}), d.id) > (?, ?)'
+            params.extend(after)
+        
+        query += ' ORDER BY rank, d.id LIMIT ?'
+        params.append(limit)
+        cursor.execute(query, params)
+        results = cursor.fetchall()
+    return results
+
+@_cached('documents', 'categories', 'document_text')
+def get_all_documents(category_id=None, search_term=None, status='active', limit=None, after=None, order='newest',
+                      filters=None):
+    # after is the page_cursor() of the last row of the previous page; rows
+    # continue from it in the given DOCUMENT_ORDERINGS order. filters is a
+    # DocumentFilter applied in the same statement.
+    column, direction = DOCUMENT_ORDERINGS[order]
+    with connection() as conn:
+        cursor = conn.cursor()
+        
+        query = f'''SELECT {_document_columns()}, c.name as category_name, c.color as category_color, c.icon as category_icon
+                   FROM documents d LEFT JOIN categories c ON d.category_id = c.id'''
+        conditions, params = _listing_conditions(status, category_id, filters)
+        query += f" WHERE {' AND '.join(conditions)}"
+        
+        match = build_search_query(search_term)
+        if match:
+            query += ' AND d.id IN (SELECT rowid FROM documents_fts WHERE documents_fts MATCH ?)'
+            params.append(match)
+        
+        if after:
+            query += f" AND (d.{column}, d.id) {'<' if direction == 'DESC' else '>'} (?, ?)"
+            params.extend(after)
+        
+        query += f' ORDER BY d.{column} {direction}, d.id {direction}'
+        if limit:
+            query += ' LIMIT ?'
+            params.append(limit)
+        cursor.execute(query, params)
+        results = cursor.fetchall()
+    return results
+
+def page_cursor(row, order='newest'):
+    # Keyset cursor that continues a listing after this row; order 'rank' is
+    # for search_documents results and 'activity' for search_activity.
+    if order == 'activity':
+        return (row['created_at'], row['id'])
+    column = 'rank' if order == 'rank' else DOCUMENT_ORDERINGS[order][0]
+    return (row[column], row['id'])
+
+@_cached('documents', 'document_text')
+def count_documents(category_id=None, search_term=None, status='active', filters=None):
+    # Number of documents a listing would show. The unfiltered active count
+    # comes from document_stats; filtered counts stop at COUNT_ESTIMATE_CAP so
+    # their cost stays bounded on large repositories.
+    match = build_search_query(search_term)
+    with connection() as conn:
+        cursor = conn.cursor()
+        if status == 'active' and not category_id and not match and not filters:
+            cursor.execute("SELECT documents FROM document_stats WHERE kind = 'total' AND day = ''")
+            row = cursor.fetchone()
+            return row[0] if row else 0
+        
+        conditions, params = _listing_conditions(status, category_id, filters)
+        query = f"SELECT 1 FROM documents d WHERE {' AND '.join(conditions)}"
+        if match:
+            query += ' AND d.id IN (SELECT rowid FROM documents_fts WHERE documents_fts MATCH ?)'
+            params.append(match)
+        cursor.execute(f'SELECT COUNT(*) FROM ({query} LIMIT ?)', params + [COUNT_ESTIMATE_CAP])
+        count = cursor.fetchone()[0]
+    return count
+
+def file_type_group(file_type):
+    # FILE_TYPE_GROUPS name of a file_type value, or None when in no group
+    file_type = (file_type or '').lower()
+    return next((group for group, values in FILE_TYPE_GROUPS.items() if file_type in values), None)
+
+@_cached('documents', 'categories', 'document_text')
+def get_search_facets(category_id=None, search_term=None, status='active', filters=None):
+    # Hit counts per category, file type group, department and year for a
+    # listing's filters, from one grouped scan of at most COUNT_ESTIMATE_CAP
+    # matching documents. Each facet is a list of (value, label, count), most
+    # hits first; 'complete' is False when the scan stopped at the cap.
+    match = build_search_query(search_term)
+    conditions, params = _listing_conditions(status, category_id, filters)
+    query = f"""SELECT d.category_id, d.file_type, d.department, substr(d.created_at, 1, 4) as year
+                FROM documents d WHERE {' AND '.join(conditions)}"""
+    if match:
+        query += ' AND d.id IN (SELECT rowid FROM documents_fts WHERE documents_fts MATCH ?)'
+        params.append(match)
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f'''SELECT h.category_id, c.name as category_name, lower(h.file_type) as file_type,
+                                  h.department, h.year, COUNT(*) as hits
+                           FROM ({query} LIMIT ?) h LEFT JOIN categories c ON c.id = h.category_id
+                           GROUP BY h.category_id, lower(h.file_type), h.department, h.year''',
+                       params + [COUNT_ESTIMATE_CAP])
+        rows = cursor.fetchall()
     
-    if search_term:
-        query += ' AND (d.title LIKE ? OR d.description LIKE ? OR d.tags LIKE ?)'
-        search_pattern = f'%{search_term}%'
-        params.extend([search_pattern, search_pattern, search_pattern])
-    
-    query += ' ORDER BY d.updated_at DESC'
-    cursor.execute(query, params)
-    results = cursor.fetchall()
-    conn.close()
+    facets = {'category': {}, 'file_type': {}, 'department': {}, 'year': {}}
+    for row in rows:
+        group = file_type_group(row['file_type'])
+        for facet, value, label in (('category', row['category_id'], row['category_name'] or 'Uncategorized'),
+                                    ('file_type', group, group or 'Other'),
+                                    ('department', row['department'], row['department'] or 'No department'),
+                                    ('year', row['year'], row['year'] or 'Unknown')):
+            counted = facets[facet].setdefault(value, [label, 0])
+            counted[1] += row['hits']
+    result = {facet: sorted(((value, label, count) for value, (label, count) in values.items()),
+                            key=lambda item: (-item[2], item[1]))
+              for facet, values in facets.items()}
+    result['complete'] = sum(row['hits'] for row in rows) < COUNT_ESTIMATE_CAP
+    return result
+
+@_cached('documents')
+def get_tag_counts(category_id=None, limit=TAG_CLOUD_SIZE):
+    # The most used tags of active documents, optionally within a category,
+    # with the number of documents carrying each
+    with connection() as conn:
+        cursor = conn.cursor()
+        query = '''SELECT t.name, COUNT(*) as documents FROM document_tags dt
+                   JOIN tags t ON t.id = dt.tag_id
+                   JOIN documents d ON d.id = dt.document_id
+                   WHERE d.status = ?'''
+        params = ['active']
+        if category_id:
+            query += ' AND d.category_id = ?'
+            params.append(category_id)
+        query += ' GROUP BY t.id ORDER BY documents DESC, t.name LIMIT ?'
+        params.append(limit)
+        cursor.execute(query, params)
+        results = cursor.fetchall()
+    return results
+
+@_cached('documents', 'categories')
+def get_tag_counts_by_category():
+    # Active documents per (category, tag), most used tags first in each category
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''SELECT d.category_id, c.name as category_name, t.name, COUNT(*) as documents
+                          FROM document_tags dt
+                          JOIN tags t ON t.id = dt.tag_id
+                          JOIN documents d ON d.id = dt.document_id
+                          LEFT JOIN categories c ON c.id = d.category_id
+                          WHERE d.status = 'active'
+                          GROUP BY d.category_id, t.id
+                          ORDER BY c.name, documents DESC, t.name''')
+        results = cursor.fetchall()
     return results
 
+@_cached('documents', 'categories')
 def get_document_by_id(doc_id):
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute('''SELECT d.*, c.name as category_name, c.color as category_color
-                      FROM documents d LEFT JOIN categories c ON d.category_id = c.id WHERE d.id = ?''', (doc_id,))
-    result = cursor.fetchone()
-    conn.close()
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f'''SELECT {_document_columns()}, c.name as category_name, c.color as category_color
+                           FROM documents d LEFT JOIN categories c ON d.category_id = c.id WHERE d.id = ?''', (doc_id,))
+        result = cursor.fetchone()
     return result
 
+def get_document_data(doc_id):
+    reader = open_document_data(doc_id)
+    if reader is None:
+        return None
+    with reader:
+        return reader.read()
+
+def open_document_data(doc_id):
+    return _open_payload('documents', doc_id)
+
+def iter_document_data(doc_id, chunk_size=CHUNK_SIZE):
+    return _iter_payload('documents', doc_id, chunk_size)
+
 def delete_document(doc_id, deleted_by):
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT title FROM documents WHERE id = ?', (doc_id,))
-    result = cursor.fetchone()
-    title = result['title'] if result else 'Unknown'
-    cursor.execute("UPDATE documents SET status = 'deleted', updated_at = CURRENT_TIMESTAMP WHERE id = ?", (doc_id,))
-    cursor.execute('INSERT INTO activity_log (user, action, document_id, document_title, details) VALUES (?, ?, ?, ?, ?)',
-                   (deleted_by, 'delete', doc_id, title, 'Document deleted'))
-    conn.commit()
-    conn.close()
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT title, status, content_hash FROM documents WHERE id = ?', (doc_id,))
+        result = cursor.fetchone()
+        title = result['title'] if result else 'Unknown'
+        cursor.execute("UPDATE documents SET status = 'deleted', updated_at = CURRENT_TIMESTAMP WHERE id = ?", (doc_id,))
+        if result and result['content_hash'] and result['status'] != 'deleted':
+            _release_blob(cursor, result['content_hash'])
+        cursor.execute('INSERT INTO activity_log (user, action, document_id, document_title, details) VALUES (?, ?, ?, ?, ?)',
+                       (deleted_by, 'delete', doc_id, title, 'Document deleted'))
+    _invalidate('documents', 'activity')
+
+class ActivityLogWriter:
+    """Buffers activity events in memory and writes them to activity_log in batches."""
+
+    def __init__(self, max_queue=ACTIVITY_QUEUE_SIZE, batch_size=ACTIVITY_BATCH_SIZE,
+                 interval=ACTIVITY_FLUSH_INTERVAL_SECONDS):
+        self.batch_size = batch_size
+        self.interval = interval
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._flush_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = False
+        self._thread = None
+
+    def log(self, user, action, document_id=None, document_title=None, details=None):
+        self._ensure_started()
+        event = (user, action, document_id, document_title, details,
+                 datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'))
+        # A full buffer is flushed by the caller, so bursts slow down rather than drop audit records
+        while True:
+            try:
+                self._queue.put_nowait(event)
+                break
+            except queue.Full:
+                self.flush()
+        if self._queue.qsize() >= self.batch_size:
+            self._wake.set()
+
+    def flush(self):
+        # Writes everything buffered so far; returns the number of events written
+        written = 0
+        with self._flush_lock:
+            while True:
+                batch = []
+                while len(batch) < self.batch_size:
+                    try:
+                        batch.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                if not batch:
+                    break
+                try:
+                    with connection() as conn:
+                        conn.executemany('''INSERT INTO activity_log (user, action, document_id, document_title,
+                                            details, created_at) VALUES (?, ?, ?, ?, ?, ?)''', batch)
+                except sqlite3.Error:
+                    # Put the batch back (as far as it fits) for the next flush
+                    for event in batch:
+                        try:
+                            self._queue.put_nowait(event)
+                        except queue.Full:
+                            break
+                    raise
+                written += len(batch)
+        if written:
+            _invalidate('activity')
+        return written
+
+    def close(self):
+        self._stopping = True
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.interval * 2)
+        self.flush()
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='activity-log', daemon=True)
+                self._thread.start()
+                atexit.register(self.close)
+
+    def _run(self):
+        while not self._stopping:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except sqlite3.Error:
+                # Typically a locked database; the batch is retried on the next pass
+                pass
+
+_activity_writer = ActivityLogWriter()
+
+def log_activity(user, action, document_id=None, document_title=None, details=None):
+    # Buffered audit entry for reads such as views and downloads. Changes to
+    # documents log inside their own transaction instead, so the record
+    # commits or rolls back with the change.
+    _activity_writer.log(user, action, document_id, document_title, details)
+
+def flush_activity_log():
+    return _activity_writer.flush()
+
+def log_download(doc_id, document_title, file_name, downloaded_by, version=None):
+    # version is set when an earlier version was downloaded
+    details = f"Downloaded version {version}: {file_name}" if version is not None else f"Downloaded {file_name}"
+    log_activity(downloaded_by, 'download', doc_id, document_title, details)
+
+def log_view(doc_id, document_title, viewed_by, details=None):
+    log_activity(viewed_by, 'view', doc_id, document_title, details or 'Document viewed')
+
+# Archive files repeat the activity_log schema and indexes, minus the
+# AUTOINCREMENT bookkeeping, so the same queries run against either.
+ACTIVITY_ARCHIVE_SCHEMA = (
+    '''CREATE TABLE IF NOT EXISTS activity_log (
+        id INTEGER PRIMARY KEY,
+        user TEXT,
+        action TEXT NOT NULL,
+        document_id INTEGER,
+        document_title TEXT,
+        details TEXT,
+        ip_address TEXT,
+        created_at TIMESTAMP
+    )''',
+    'CREATE INDEX IF NOT EXISTS idx_activity_log_created ON activity_log (created_at)',
+    'CREATE INDEX IF NOT EXISTS idx_activity_log_user_created ON activity_log (user, created_at)',
+    'CREATE INDEX IF NOT EXISTS idx_activity_log_document_created ON activity_log (document_id, created_at)',
+    'CREATE INDEX IF NOT EXISTS idx_activity_log_action_created ON activity_log (action, created_at)',
+)
+
+def _month_start(day, months_back=0):
+    # First day of the month months_back before day, as 'YYYY-MM-DD'
+    index = day.year * 12 + day.month - 1 - months_back
+    return f'{index // 12:04d}-{index % 12 + 1:02d}-01'
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# activity_log columns recorded per archived month in activity_archive_keys
+ACTIVITY_ARCHIVE_KEYS = ('user', 'action', 'document_id')
+
+def _activity_archive_keys(archive_conn):
+    # (kind, value) for every distinct ACTIVITY_ARCHIVE_KEYS value in an archive
+    keys = []
+    for column in ACTIVITY_ARCHIVE_KEYS:
+        rows = archive_conn.execute(f'SELECT DISTINCT {column} FROM activity_log WHERE {column} IS NOT NULL')
+        keys.extend((column, str(row[0])) for row in rows)
+    return keys
+
+def _record_activity_archive_keys(conn, month, keys):
+    conn.execute('DELETE FROM activity_archive_keys WHERE month = ?', (month,))
+    conn.executemany('INSERT INTO activity_archive_keys (kind, value, month) VALUES (?, ?, ?)',
+                     [(kind, value, month) for kind, value in keys])
+    conn.execute('UPDATE activity_archives SET keys_indexed = 1 WHERE month = ?', (month,))
+
+def index_activity_archives():
+    # Records the keys of archives written before activity_archive_keys
+    # existed; returns the number of archives indexed.
+    with connection() as conn:
+        archives = conn.execute('SELECT * FROM activity_archives WHERE keys_indexed = 0').fetchall()
+    indexed = 0
+    for archive in archives:
+        try:
+            archive_conn = _open_activity_archive(archive)
+        except (sqlite3.DatabaseError, OSError):
+            # Missing or damaged; left unindexed so searches still open it
+            continue
+        try:
+            keys = _activity_archive_keys(archive_conn)
+        finally:
+            archive_conn.close()
+        with connection() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            current = conn.execute('SELECT sha256 FROM activity_archives WHERE month = ?',
+                                   (archive['month'],)).fetchone()
+            if current is not None and current['sha256'] == archive['sha256']:
+                _record_activity_archive_keys(conn, archive['month'], keys)
+                indexed += 1
+    if indexed:
+        _invalidate('activity')
+    return indexed
+
+def _archive_activity_month(month):
+    # Copies one month of activity_log into its archive file, records it in
+    # activity_archives and deletes the copied rows; returns the archive's row
+    # count, or None if the month could not be archived (another run archived
+    # it meanwhile, or its earlier archive no longer matches its checksum).
+    # The file is built, compressed and hashed from a snapshot bounded by the
+    # current MAX(id) without holding the write lock, which is taken only to
+    # record the archive and delete the copied rows. Rows already in an
+    # earlier archive for the month (from late-logged events) are carried
+    # over. Each rebuild is written under a new file name, named by its
+    # checksum, and the earlier file is removed only once the new one is
+    # recorded, so an interrupted run leaves the catalogued file untouched.
+    start = f'{month}-01'
+    end = _month_start(datetime.strptime(start, '%Y-%m-%d') + timedelta(days=31))
+    os.makedirs(ACTIVITY_ARCHIVE_PATH, exist_ok=True)
+    with connection() as conn:
+        last_id = conn.execute('SELECT MAX(id) FROM activity_log').fetchone()[0]
+        previous = conn.execute('SELECT file_name, sha256 FROM activity_archives WHERE month = ?',
+                                (month,)).fetchone()
+    previous_sha256 = previous['sha256'] if previous else None
+    
+    with tempfile.TemporaryDirectory(dir=ACTIVITY_ARCHIVE_PATH) as workdir:
+        work_path = os.path.join(workdir, 'activity.db')
+        archive = sqlite3.connect(work_path)
+        try:
+            for statement in ACTIVITY_ARCHIVE_SCHEMA:
+                archive.execute(statement)
+            if previous is not None:
+                previous_archive = os.path.join(ACTIVITY_ARCHIVE_PATH, previous['file_name'])
+                if not os.path.exists(previous_archive) or _file_sha256(previous_archive) != previous_sha256:
+                    # Rebuilding without its rows would lose them
+                    return None
+                previous_path = os.path.join(workdir, 'previous.db')
+                with gzip.open(previous_archive) as source, open(previous_path, 'wb') as target:
+                    shutil.copyfileobj(source, target, 1024 * 1024)
+                archive.execute('ATTACH DATABASE ? AS previous', (previous_path,))
+                archive.execute('INSERT INTO activity_log SELECT * FROM previous.activity_log')
+                archive.commit()
+                archive.execute('DETACH DATABASE previous')
+            with connection() as conn:
+                rows = conn.execute('''SELECT id, user, action, document_id, document_title, details, ip_address,
+                                              created_at
+                                       FROM activity_log WHERE created_at >= ? AND created_at < ? AND id <= ?''',
+                                    (start, end, last_id))
+                archive.executemany('INSERT OR REPLACE INTO activity_log VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            archive.commit()
+            row_count, first_at, last_at = archive.execute(
+                'SELECT COUNT(*), MIN(created_at), MAX(created_at) FROM activity_log').fetchone()
+            keys = _activity_archive_keys(archive)
+        finally:
+            archive.close()
+        
+        compressed_path = os.path.join(workdir, 'activity.db.gz')
+        with open(work_path, 'rb') as source, gzip.open(compressed_path, 'wb', compresslevel=9) as target:
+            shutil.copyfileobj(source, target, 1024 * 1024)
+        with open(compressed_path, 'rb') as f:
+            os.fsync(f.fileno())
+        sha256 = _file_sha256(compressed_path)
+        file_size = os.path.getsize(compressed_path)
+        file_name = f'activity_{month}_{sha256[:16]}.db.gz'
+        archive_path = os.path.join(ACTIVITY_ARCHIVE_PATH, file_name)
+        os.replace(compressed_path, archive_path)
+    
+    recorded = False
+    try:
+        with connection() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            current = conn.execute('SELECT sha256 FROM activity_archives WHERE month = ?', (month,)).fetchone()
+            if (current['sha256'] if current else None) != previous_sha256:
+                return None
+            conn.execute('''INSERT OR REPLACE INTO activity_archives (month, file_name, row_count, first_at, last_at,
+                            file_size, sha256) VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                         (month, file_name, row_count, first_at, last_at, file_size, sha256))
+            _record_activity_archive_keys(conn, month, keys)
+            conn.execute('DELETE FROM activity_log WHERE created_at >= ? AND created_at < ? AND id <= ?',
+                         (start, end, last_id))
+        recorded = True
+    finally:
+        # Only one of the new and the earlier file is catalogued after this
+        if not recorded:
+            _remove_unrecorded_archive(file_name)
+        elif previous is not None and previous['file_name'] != file_name:
+            _remove_unrecorded_archive(previous['file_name'])
+    return row_count
+
+def _remove_unrecorded_archive(file_name):
+    # A concurrent run can have recorded the same contents under the same name
+    with connection() as conn:
+        if conn.execute('SELECT 1 FROM activity_archives WHERE file_name = ?', (file_name,)).fetchone():
+            return
+    try:
+        os.remove(os.path.join(ACTIVITY_ARCHIVE_PATH, file_name))
+    except FileNotFoundError:
+        pass
+
+def archive_activity(live_months=ACTIVITY_LIVE_MONTHS):
+    # Moves every month older than the live window out of activity_log; returns
+    # (month, rows in its archive) for each month archived. A month that cannot
+    # be archived is left in activity_log and retried on the next run.
+    flush_activity_log()
+    cutoff = _month_start(datetime.utcnow(), live_months - 1)
+    archived = []
+    after = ''
+    while True:
+        with connection() as conn:
+            oldest = conn.execute('SELECT MIN(created_at) FROM activity_log WHERE created_at >= ?',
+                                  (after,)).fetchone()[0]
+        if oldest is None or oldest >= cutoff:
+            break
+        month = oldest[:7]
+        rows = _archive_activity_month(month)
+        if rows is not None:
+            archived.append((month, rows))
+        after = _month_start(datetime.strptime(f'{month}-01', '%Y-%m-%d') + timedelta(days=31))
+    if archived:
+        _invalidate('activity')
+    index_activity_archives()
+    return archived
 
+_archive_cache = OrderedDict()
+_archive_cache_dir = None
+_archive_cache_lock = threading.Lock()
+
+def _open_activity_archive(archive):
+    # Read connection to a decompressed copy of an archive. Copies are keyed by
+    # checksum, so an archive rewritten by a later run is decompressed afresh.
+    global _archive_cache_dir
+    with _archive_cache_lock:
+        path = _archive_cache.get(archive['sha256'])
+        if path is None:
+            source_path = os.path.join(ACTIVITY_ARCHIVE_PATH, archive['file_name'])
+            if _file_sha256(source_path) != archive['sha256']:
+                raise sqlite3.DatabaseError(f"Activity archive {archive['file_name']} does not match its recorded checksum")
+            if _archive_cache_dir is None:
+                _archive_cache_dir = tempfile.mkdtemp(prefix='activity_archive_')
+                atexit.register(shutil.rmtree, _archive_cache_dir, True)
+            path = os.path.join(_archive_cache_dir, f"{archive['sha256']}.db")
+            with gzip.open(source_path) as source, open(path, 'wb') as target:
+                shutil.copyfileobj(source, target, 1024 * 1024)
+            # Archives written before an index was added get it on the copy
+            copy = sqlite3.connect(path)
+            try:
+                for statement in ACTIVITY_ARCHIVE_SCHEMA:
+                    copy.execute(statement)
+                copy.commit()
+            finally:
+                copy.close()
+            _archive_cache[archive['sha256']] = path
+            while len(_archive_cache) > ACTIVITY_ARCHIVE_CACHE_ENTRIES:
+                try:
+                    os.remove(_archive_cache.popitem(last=False)[1])
+                except OSError:
+                    pass
+        _archive_cache.move_to_end(archive['sha256'])
+        conn = sqlite3.connect(path, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+_archive_thread = None
+
+def start_activity_archiver(interval=ACTIVITY_ARCHIVE_INTERVAL_SECONDS):
+    global _archive_thread
+    if _archive_thread is not None and _archive_thread.is_alive():
+        return _archive_thread
+    
+    def roll_over():
+        while True:
+            try:
+                archive_activity()
+                record_compliance_snapshot()
+            except (sqlite3.Error, OSError):
+                pass
+            time.sleep(interval)
+    
+    _archive_thread = threading.Thread(target=roll_over, name='activity-archive', daemon=True)
+    _archive_thread.start()
+    return _archive_thread
+
+def collect_garbage(grace_period=BLOB_GC_GRACE_PERIOD):
+    # Removes blobs that have had no references for longer than grace_period
+    with connection() as conn:
+        candidates = conn.execute('''SELECT hash, COALESCE(stored_size, size) as size FROM blobs
+                                     WHERE ref_count <= 0 AND released_at <= datetime('now', ?)''',
+                                  (f'-{int(grace_period.total_seconds())} seconds',)).fetchall()
+    freed = {'blobs': 0, 'bytes': 0}
+    for row in candidates:
+        # Re-check inside the delete so a blob re-acquired since the scan is
+        # kept, and remove the file before the delete commits: a writer that
+        # re-acquires the hash waits for the lock and then finds the file
+        # gone, so it stores the payload again instead of trusting a file
+        # about to be deleted.
+        with connection() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            deleted = conn.execute('DELETE FROM blobs WHERE hash = ? AND ref_count <= 0', (row['hash'],)).rowcount
+            if deleted:
+                _blob_store.delete(row['hash'])
+        if deleted:
+            freed['blobs'] += 1
+            freed['bytes'] += row['size']
+    
+    # Files with no blobs row at all, written by a put whose insert then
+    # failed or rolled back, or by an interrupted import, once they are older
+    # than grace_period. Payloads kept in the database have no such files.
+    if not hasattr(_blob_store, 'stored_files'):
+        return freed
+    with connection() as conn:
+        recorded = {row[0] for row in conn.execute('SELECT hash FROM blobs')}
+    cutoff = time.time() - grace_period.total_seconds()
+    for content_hash, path in _blob_store.stored_files():
+        if content_hash in recorded:
+            continue
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        if stat.st_mtime > cutoff:
+            continue
+        # Re-checked under the write lock, as above: a put that reused the
+        # file since the scan has refreshed its modification time
+        with connection() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            if content_hash and conn.execute('SELECT 1 FROM blobs WHERE hash = ?', (content_hash,)).fetchone():
+                continue
+            try:
+                if os.stat(path).st_mtime > cutoff:
+                    continue
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+        freed['blobs'] += 1
+        freed['bytes'] += stat.st_size
+    return freed
+
+_gc_thread = None
+
+def start_garbage_collector(interval=BLOB_GC_INTERVAL_SECONDS):
+    global _gc_thread
+    if _gc_thread is not None and _gc_thread.is_alive():
+        return _gc_thread
+    
+    def sweep():
+        while True:
+            time.sleep(interval)
+            try:
+                collect_garbage()
+            except sqlite3.Error:
+                pass
+    
+    _gc_thread = threading.Thread(target=sweep, name='blob-gc', daemon=True)
+    _gc_thread.start()
+    return _gc_thread
+
+def externalize_inline_payloads():
+    # Moves payloads embedded in file_data by earlier releases into the blob store
+    moved = 0
+    for table in ('documents', 'document_versions'):
+        with connection() as conn:
+            rows = conn.execute(
+                f'SELECT id, file_name FROM {table} WHERE file_data IS NOT NULL AND content_hash IS NULL').fetchall()
+        for row_id, file_name in rows:
+            reader = _open_payload(table, row_id)
+            with reader:
+                content_hash, size, stored_size = store_payload(reader, os.path.splitext(file_name)[1].lstrip('.'))
+            with connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(f'UPDATE {table} SET content_hash = ?, file_data = NULL WHERE id = ?', (content_hash, row_id))
+                _acquire_blob(cursor, content_hash, size, stored_size)
+                if table == 'documents':
+                    cursor.execute("SELECT status FROM documents WHERE id = ?", (row_id,))
+                    if cursor.fetchone()['status'] == 'deleted':
+                        _release_blob(cursor, content_hash)
+            moved += 1
+    if moved:
+        _invalidate('documents', 'versions')
+    return moved
+
+def compact_versions():
+    # Moves version payloads kept whole (inline or in the blob store) into
+    # chunked storage; returns the number of versions converted.
+    with connection() as conn:
+        ids = [row[0] for row in conn.execute('''SELECT id FROM document_versions WHERE chunk_count IS NULL
+                                                 AND (content_hash IS NOT NULL OR file_data IS NOT NULL)''')]
+    converted = 0
+    for version_id in ids:
+        reader = _open_payload('document_versions', version_id)
+        if reader is None:
+            continue
+        with reader:
+            size, hashes = _store_version_chunks(reader)
+        with connection() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            cursor = conn.cursor()
+            row = cursor.execute('SELECT content_hash, chunk_count FROM document_versions WHERE id = ?',
+                                 (version_id,)).fetchone()
+            if row is None or row['chunk_count'] is not None:
+                continue
+            _record_version_manifest(cursor, version_id, hashes)
+            cursor.execute('''UPDATE document_versions SET file_size = ?, chunk_count = ?, content_hash = NULL,
+                              file_data = NULL WHERE id = ?''', (size, len(hashes), version_id))
+            if row['content_hash']:
+                _release_blob(cursor, row['content_hash'])
+        converted += 1
+    if converted:
+        _invalidate('versions')
+    return converted
+
+def get_document_file_path(doc_id):
+    # Local path of the stored payload, or None if the blob store is not file based
+    doc = get_document_by_id(doc_id)
+    if not doc or not doc['content_hash'] or not hasattr(_blob_store, 'path'):
+        return None
+    return _blob_store.path(doc['content_hash'])
+
+def queue_text_extraction(doc_id):
+    with connection() as conn:
+        conn.execute('''INSERT INTO document_text (document_id, status) VALUES (?, 'pending')
+                        ON CONFLICT(document_id) DO UPDATE SET status = 'pending', error = NULL,
+                        queued_at = CURRENT_TIMESTAMP, started_at = NULL, finished_at = NULL, duration_ms = NULL''',
+                     (doc_id,))
+    _invalidate('document_text')
+
+def queue_missing_text_extractions():
+    with connection() as conn:
+        queued = conn.execute('''INSERT OR IGNORE INTO document_text (document_id)
+                                 SELECT id FROM documents WHERE status = 'active' ''').rowcount
+    if queued:
+        _invalidate('document_text')
+    return queued
+
+def get_pending_extractions(limit, exclude=()):
+    with connection() as conn:
+        cursor = conn.cursor()
+        query = '''SELECT t.document_id, d.file_name, d.file_type
+                   FROM document_text t JOIN documents d ON d.id = t.document_id
+                   WHERE t.status = 'pending' '''
+        params = []
+        if exclude:
+            query += f' AND t.document_id NOT IN ({", ".join("?" * len(exclude))})'
+            params.extend(exclude)
+        query += ' ORDER BY t.queued_at LIMIT ?'
+        params.append(limit)
+        cursor.execute(query, params)
+        results = cursor.fetchall()
+    return results
+
+def record_text_extraction(doc_id, status, content=None, extractor=None, error=None,
+                           started_at=None, finished_at=None, duration_ms=None):
+    with connection() as conn:
+        conn.execute('''UPDATE document_text SET status = ?, content = ?, extractor = ?, error = ?,
+                        char_count = ?, started_at = ?, finished_at = ?, duration_ms = ?
+                        WHERE document_id = ?''',
+                     (status, content, extractor, error, len(content) if content else 0,
+                      started_at, finished_at, duration_ms, doc_id))
+    _invalidate('document_text')
+
+@_cached('document_text')
+def get_extraction_stats():
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''SELECT status, COUNT(*) as count, AVG(duration_ms) as avg_ms, MAX(duration_ms) as max_ms,
+                                 MIN(queued_at) as oldest_queued
+                          FROM document_text GROUP BY status''')
+        results = {row['status']: dict(row) for row in cursor.fetchall()}
+    return results
+
+@_cached('categories')
 def get_categories():
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM categories ORDER BY name')
-    results = cursor.fetchall()
-    conn.close()
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT * FROM categories ORDER BY name')
+        results = cursor.fetchall()
     return results
 
+@_cached('documents', 'categories')
 def get_category_stats():
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute('''SELECT c.id, c.name, c.color, c.icon, COUNT(d.id) as doc_count
-                      FROM categories c LEFT JOIN documents d ON c.id = d.category_id AND d.status = 'active'
-                      GROUP BY c.id ORDER BY doc_count DESC''')
-    results = cursor.fetchall()
-    conn.close()
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''SELECT c.id, c.name, c.color, c.icon, COUNT(d.id) as doc_count
+                          FROM categories c LEFT JOIN documents d ON c.id = d.category_id AND d.status = 'active'
+                          GROUP BY c.id ORDER BY doc_count DESC''')
+        results = cursor.fetchall()
     return results
 
-def get_expiring_documents(days=30):
-    conn = get_connection()
-    cursor = conn.cursor()
-    future_date = (datetime.now() + timedelta(days=days)).strftime('%Y-%m-%d')
-    today = datetime.now().strftime('%Y-%m-%d')
-    cursor.execute('''SELECT d.*, c.name as category_name, c.color as category_color
-                      FROM documents d LEFT JOIN categories c ON d.category_id = c.id
-                      WHERE d.status = 'active' AND d.expiry_date IS NOT NULL 
-                      AND d.expiry_date <= ? AND d.expiry_date >= ? ORDER BY d.expiry_date ASC''',
-                   (future_date, today))
-    results = cursor.fetchall()
-    conn.close()
+@_cached('documents', 'categories', daily=True)
+def get_deadlines(start_date=None, end_date=None, kind=None, limit=None):
+    # Deadlines due between two inclusive dates (either may be open), soonest
+    # first, with their documents. kind is 'expiry' or 'review'; a document
+    # with both in the window appears once for each.
+    conditions = []
+    params = []
+    if start_date is not None:
+        conditions.append('dl.due_date >= ?')
+        params.append(str(start_date))
+    if end_date is not None:
+        conditions.append('dl.due_date <= ?')
+        params.append(str(end_date))
+    if kind is not None:
+        conditions.append('dl.kind = ?')
+        params.append(kind)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    query = f'''SELECT dl.due_date, dl.kind, {_document_columns()}, c.name as category_name, c.color as category_color
+                FROM compliance_deadlines dl
+                JOIN documents d ON d.id = dl.document_id
+                LEFT JOIN categories c ON d.category_id = c.id
+                {where} ORDER BY dl.due_date, dl.kind, dl.document_id'''
+    if limit is not None:
+        query += ' LIMIT ?'
+        params.append(limit)
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(query, params)
+        results = cursor.fetchall()
     return results
 
+def get_next_deadlines(limit=10, kind=None):
+    return get_deadlines(start_date=date.today(), kind=kind, limit=limit)
+
+@_cached('documents', daily=True)
+def get_deadline_counts():
+    # {'expiry': {...}, 'review': {...}}, each counting deadlines already
+    # passed ('overdue') and due from today within each DEADLINE_URGENCY_DAYS
+    # ('within_7', ...). Reads the per-day expiry and review counts kept in
+    # document_stats, so the cost follows the number of distinct dates.
+    today = date.today()
+    cutoffs = {f'within_{days}': (today + timedelta(days=days)).isoformat() for days in DEADLINE_URGENCY_DAYS}
+    columns = ', '.join(f'SUM(CASE WHEN day >= :today AND day <= :{name} THEN documents ELSE 0 END) as {name}'
+                        for name in cutoffs)
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f'''SELECT kind, SUM(CASE WHEN day < :today THEN documents ELSE 0 END) as overdue, {columns}
+                           FROM document_stats WHERE kind IN ('expiry', 'review') AND day <= :last
+                           GROUP BY kind''',
+                       {'today': today.isoformat(), 'last': max(cutoffs.values()), **cutoffs})
+        rows = {row['kind']: dict(row) for row in cursor.fetchall()}
+    empty = {'overdue': 0, **{name: 0 for name in cutoffs}}
+    return {kind: {name: (rows.get(kind) or empty)[name] for name in empty} for kind in ('expiry', 'review')}
+
+def get_expiring_documents(days=30):
+    return get_deadlines(start_date=date.today(), end_date=date.today() + timedelta(days=days), kind='expiry')
+
 def get_documents_for_review(days=30):
-    conn = get_connection()
-    cursor = conn.cursor()
-    future_date = (datetime.now() + timedelta(days=days)).strftime('%Y-%m-%d')
-    cursor.execute('''SELECT d.*, c.name as category_name, c.color as category_color
-                      FROM documents d LEFT JOIN categories c ON d.category_id = c.id
-                      WHERE d.status = 'active' AND d.review_date IS NOT NULL 
-                      AND d.review_date <= ? ORDER BY d.review_date ASC''', (future_date,))
-    results = cursor.fetchall()
-    conn.close()
+    # Includes overdue reviews
+    return get_deadlines(end_date=date.today() + timedelta(days=days), kind='review')
+
+def get_last_digest_run():
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''SELECT * FROM compliance_digest_runs
+                          WHERE id = (SELECT MAX(id) FROM compliance_digest_runs)''')
+        result = cursor.fetchone()
+    return result
+
+def get_documents_changed_since(timestamp):
+    # Documents added, replaced or deleted at or after timestamp (UTC)
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f'''SELECT {_document_columns()}, c.name as category_name, c.color as category_color
+                           FROM documents d LEFT JOIN categories c ON d.category_id = c.id
+                           WHERE d.status IN ('active', 'deleted') AND d.updated_at >= ?''', (timestamp,))
+        results = cursor.fetchall()
     return results
 
+def get_digest_alerts(doc_ids):
+    # {(document_id, kind): row} of the reported deadlines of these documents
+    doc_ids = list(doc_ids)
+    alerts = {}
+    with connection() as conn:
+        for start in range(0, len(doc_ids), 500):
+            batch = doc_ids[start:start + 500]
+            rows = conn.execute(f'''SELECT * FROM compliance_digest_alerts
+                                    WHERE document_id IN ({', '.join('?' * len(batch))})''', batch)
+            alerts.update({(row['document_id'], row['kind']): row for row in rows})
+    return alerts
+
+def record_digest_run(run_at, run_date, horizon_date, alerts, resolved):
+    # alerts holds (document_id, kind, due_date, status) to report as current,
+    # resolved the (document_id, kind) keys no longer due
+    with connection() as conn:
+        if not conn.in_transaction:
+            conn.execute('BEGIN IMMEDIATE')
+        conn.executemany('''INSERT INTO compliance_digest_alerts (document_id, kind, due_date, status)
+                            VALUES (?, ?, ?, ?)
+                            ON CONFLICT (document_id, kind) DO UPDATE SET due_date = excluded.due_date,
+                                status = excluded.status, reported_at = CURRENT_TIMESTAMP''', alerts)
+        conn.executemany('DELETE FROM compliance_digest_alerts WHERE document_id = ? AND kind = ?', resolved)
+        conn.execute('''INSERT INTO compliance_digest_runs (run_at, run_date, horizon_date, new_upcoming,
+                        new_overdue, resolved) VALUES (?, ?, ?, ?, ?, ?)''',
+                     (run_at, str(run_date), str(horizon_date),
+                      sum(1 for alert in alerts if alert[3] == 'upcoming'),
+                      sum(1 for alert in alerts if alert[3] == 'overdue'), len(resolved)))
+
+@_cached('versions')
 def get_document_versions(doc_id):
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM document_versions WHERE document_id = ? ORDER BY version DESC', (doc_id,))
-    results = cursor.fetchall()
-    conn.close()
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f'''SELECT {', '.join(VERSION_METADATA_COLUMNS)},
+                                  (chunk_count IS NOT NULL OR content_hash IS NOT NULL OR file_data IS NOT NULL) as has_file
+                           FROM document_versions WHERE document_id = ? ORDER BY version DESC''', (doc_id,))
+        results = cursor.fetchall()
     return results
 
+@_cached('versions')
+def get_version_summaries(doc_ids):
+    # Version count and latest-version metadata for a page of documents, in
+    # one grouped query: {document_id: row}. Documents without versions are
+    # left out.
+    doc_ids = tuple(doc_ids)
+    if not doc_ids:
+        return {}
+    with connection() as conn:
+        cursor = conn.cursor()
+        # SQLite takes the bare columns from the row holding MAX(version)
+        cursor.execute(f'''SELECT document_id, COUNT(*) as version_count, MAX(version) as latest_version,
+                                  uploaded_by as latest_uploaded_by, created_at as latest_created_at
+                           FROM document_versions WHERE document_id IN ({', '.join('?' * len(doc_ids))})
+                           GROUP BY document_id''', doc_ids)
+        results = {row['document_id']: row for row in cursor.fetchall()}
+    return results
+
+def get_version_data(version_id):
+    reader = open_version_data(version_id)
+    if reader is None:
+        return None
+    with reader:
+        return reader.read()
+
+def open_version_data(version_id):
+    with connection() as conn:
+        row = conn.execute('SELECT chunk_count FROM document_versions WHERE id = ?', (version_id,)).fetchone()
+    if row and row['chunk_count'] is not None:
+        return io.BufferedReader(VersionReader(version_id), buffer_size=CHUNK_SIZE)
+    return _open_payload('document_versions', version_id)
+
+def iter_version_data(version_id, chunk_size=CHUNK_SIZE):
+    return _iter_reader(open_version_data(version_id), chunk_size)
+
+@_cached('documents', 'versions')
+def get_version_storage_stats():
+    # Per document with earlier versions: the full size of those versions and
+    # the bytes their chunks actually occupy. Chunks repeated between versions
+    # are counted once; versions not yet chunked count at full size.
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''SELECT v.document_id, d.title, d.file_size as current_size, v.versions, v.version_bytes,
+                                 v.unchunked_bytes + (SELECT COALESCE(SUM(c.stored_size), 0) FROM version_chunks c
+                                     WHERE c.hash IN (SELECT m.chunk_hash FROM document_versions dv
+                                                      JOIN version_manifest m ON m.version_id = dv.id
+                                                      WHERE dv.document_id = v.document_id)) as stored_bytes
+                          FROM (SELECT document_id, COUNT(*) as versions,
+                                       COALESCE(SUM(file_size), 0) as version_bytes,
+                                       COALESCE(SUM(CASE WHEN chunk_count IS NULL THEN file_size END), 0) as unchunked_bytes
+                                FROM document_versions GROUP BY document_id) v
+                          JOIN documents d ON d.id = v.document_id
+                          ORDER BY v.version_bytes DESC''')
+        results = cursor.fetchall()
+    return results
+
+@_cached('activity')
 def get_recent_activity(limit=50):
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM activity_log ORDER BY created_at DESC LIMIT ?', (limit,))
-    results = cursor.fetchall()
-    conn.close()
+    # Reads the live table only; archived months are reached through search_activity
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT * FROM activity_log ORDER BY created_at DESC LIMIT ?', (limit,))
+        results = cursor.fetchall()
     return results
 
-def get_dashboard_stats():
-    conn = get_connection()
-    cursor = conn.cursor()
-    stats = {}
-    
-    cursor.execute("SELECT COUNT(*) FROM documents WHERE status = 'active'")
-    stats['total_documents'] = cursor.fetchone()[0]
+@_cached('activity')
+def search_activity(start_date=None, end_date=None, user=None, action=None, document_id=None,
+                    limit=ACTIVITY_PAGE_SIZE, after=None):
+    # Audit trail matching every given filter, newest first, across the live
+    # table and the archive of each month in range whose activity_archive_keys
+    # hold the filtered user, action and document. Dates are inclusive days;
+    # after is the page_cursor(row, 'activity') of the previous page's last row.
+    conditions = []
+    params = []
+    months = []
+    month_params = []
+    if start_date is not None:
+        conditions.append('created_at >= ?')
+        params.append(str(start_date))
+        months.append('month >= ?')
+        month_params.append(str(start_date)[:7])
+    if end_date is not None:
+        conditions.append('created_at < ?')
+        params.append((datetime.strptime(str(end_date), '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d'))
+        months.append('month <= ?')
+        month_params.append(str(end_date)[:7])
+    for column, value in (('user', user), ('action', action), ('document_id', document_id)):
+        if value is not None:
+            conditions.append(f'{column} = ?')
+            params.append(value)
+            # Only archives known to contain the value, or not yet indexed
+            months.append('''(keys_indexed = 0 OR month IN (SELECT month FROM activity_archive_keys
+                                                                WHERE kind = ? AND value = ?))''')
+            month_params.extend((column, str(value)))
+    if after is not None:
+        conditions.append('(created_at, id) < (?, ?)')
+        params.extend(after)
+        months.append('month <= ?')
+        month_params.append(after[0][:7])
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    query = f'SELECT * FROM activity_log {where} ORDER BY created_at DESC, id DESC LIMIT ?'
+    params.append(limit)
     
+    with connection() as conn:
+        results = conn.execute(query, params).fetchall()
+        archives = conn.execute(f'''SELECT * FROM activity_archives {"WHERE " + " AND ".join(months) if months else ""}
+                                    ORDER BY month DESC''', month_params).fetchall()
+    for archive in archives:
+        # Months are searched newest first; once the page is full and newer
+        # than everything in this archive, the older ones cannot contribute
+        if len(results) >= limit and results[limit - 1]['created_at'] > archive['last_at']:
+            break
+        archive_conn = _open_activity_archive(archive)
+        try:
+            results.extend(archive_conn.execute(query, params).fetchall())
+        finally:
+            archive_conn.close()
+        results.sort(key=lambda row: (row['created_at'], row['id']), reverse=True)
+        del results[limit:]
+    return results
+
+@_cached('activity')
+def get_activity_archives():
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT * FROM activity_archives ORDER BY month DESC')
+        results = cursor.fetchall()
+    return results
+
+@_cached('documents', daily=True)
+def get_dashboard_stats():
+    # Reads the trigger-maintained document_stats buckets; each figure is a
+    # primary key lookup or range, whatever the number of documents.
+    # total_size is the original size of the active documents, stored_size
+    # the bytes actually held for referenced payloads and earlier versions.
     future_date = (datetime.now() + timedelta(days=30)).strftime('%Y-%m-%d')
-    cursor.execute("SELECT COUNT(*) FROM documents WHERE status = 'active' AND expiry_date IS NOT NULL AND expiry_date <= ?", (future_date,))
-    stats['expiring_soon'] = cursor.fetchone()[0]
-    
-    cursor.execute("SELECT COUNT(*) FROM documents WHERE status = 'active' AND review_date IS NOT NULL AND review_date <= ?", (future_date,))
-    stats['due_for_review'] = cursor.fetchone()[0]
-    
     week_ago = (datetime.now() - timedelta(days=7)).strftime('%Y-%m-%d')
-    cursor.execute("SELECT COUNT(*) FROM documents WHERE status = 'active' AND created_at >= ?", (week_ago,))
-    stats['recent_uploads'] = cursor.fetchone()[0]
-    
-    cursor.execute("SELECT SUM(file_size) FROM documents WHERE status = 'active'")
-    total_size = cursor.fetchone()[0]
-    stats['total_size'] = total_size if total_size else 0
-    
-    conn.close()
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''SELECT
+            COALESCE((SELECT documents FROM document_stats WHERE kind = 'total' AND day = ''), 0) as total_documents,
+            COALESCE((SELECT SUM(documents) FROM document_stats WHERE kind = 'expiry' AND day <= ?), 0) as expiring_soon,
+            COALESCE((SELECT SUM(documents) FROM document_stats WHERE kind = 'review' AND day <= ?), 0) as due_for_review,
+            COALESCE((SELECT SUM(documents) FROM document_stats WHERE kind = 'created' AND day >= ?), 0) as recent_uploads,
+            COALESCE((SELECT total_size FROM document_stats WHERE kind = 'total' AND day = ''), 0) as total_size,
+            COALESCE((SELECT SUM(total_size) FROM document_stats WHERE kind = 'stored'), 0) as stored_size''',
+                       (future_date, future_date, week_ago))
+        stats = dict(cursor.fetchone())
     return stats
 
+def record_compliance_snapshot():
+    # Stores today's review and expiry totals in compliance_daily from the
+    # document_stats buckets; repeated calls on one day overwrite the snapshot.
+    today = date.today().isoformat()
+    with connection() as conn:
+        conn.execute('''INSERT OR REPLACE INTO compliance_daily (day, reviews, reviews_overdue, expiries, expired)
+                        SELECT ?,
+                            COALESCE((SELECT SUM(documents) FROM document_stats WHERE kind = 'review'), 0),
+                            COALESCE((SELECT SUM(documents) FROM document_stats WHERE kind = 'review' AND day < ?), 0),
+                            COALESCE((SELECT SUM(documents) FROM document_stats WHERE kind = 'expiry'), 0),
+                            COALESCE((SELECT SUM(documents) FROM document_stats WHERE kind = 'expiry' AND day < ?), 0)''',
+                     (today, today, today))
+    _invalidate('analytics')
+
+def rebuild_analytics():
+    # Recomputes the rollups from the documents table, the live activity log
+    # and every activity archive; returns the number of activity events counted.
+    with connection() as conn:
+        conn.execute('BEGIN IMMEDIATE')
+        conn.execute('DELETE FROM analytics_daily')
+        conn.execute('DELETE FROM activity_daily')
+        _fill_analytics(conn.cursor())
+        archives = conn.execute('SELECT * FROM activity_archives ORDER BY month').fetchall()
+        for archive in archives:
+            archive_conn = _open_activity_archive(archive)
+            try:
+                rows = archive_conn.execute('''SELECT substr(created_at, 1, 10), action, document_id, COUNT(*)
+                                               FROM activity_log WHERE created_at IS NOT NULL
+                                               GROUP BY 1, 2, 3''').fetchall()
+            finally:
+                archive_conn.close()
+            conn.executemany('''INSERT INTO activity_daily (day, action, department, events)
+                                SELECT ?, ?, COALESCE((SELECT department FROM documents WHERE id = ?), ''), ?
+                                ON CONFLICT (day, action, department) DO UPDATE SET
+                                    events = events + excluded.events''', [tuple(row) for row in rows])
+        events = conn.execute('SELECT COALESCE(SUM(events), 0) FROM activity_daily').fetchone()[0]
+    _invalidate('documents', 'activity')
+    return events
+
+def _analytics_period(column, period):
+    # SQL for the first day of the ANALYTICS_PERIODS bucket holding column
+    return ANALYTICS_PERIODS[period].format(column=column)
+
+def _analytics_range(column, start_date, end_date):
+    # Conditions keeping the scan to one index range; an open start still
+    # bounds the range so the rollup's primary key is used
+    conditions = [f'{column} >= ?']
+    params = [str(start_date) if start_date else '']
+    if end_date:
+        conditions.append(f'{column} <= ?')
+        params.append(str(end_date))
+    return conditions, params
+
+@_cached('documents')
+def get_upload_series(period='week', group_by=None, start_date=None, end_date=None, kind='upload'):
+    # (period, group, documents, bytes) per period from analytics_daily; kind
+    # 'version' counts new versions. group_by is None, 'category' or 'department'.
+    group = {None: "''", 'category': 'a.category_id', 'department': 'a.department'}[group_by]
+    conditions, params = _analytics_range('a.day', start_date, end_date)
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f'''SELECT {_analytics_period('a.day', period)} as period, {group} as grp,
+                                  SUM(a.documents) as documents, SUM(a.bytes) as bytes
+                           FROM analytics_daily a WHERE a.kind = ? AND {' AND '.join(conditions)}
+                           GROUP BY period, grp ORDER BY period, grp''', [kind] + params)
+        results = cursor.fetchall()
+    return results
+
+@_cached('documents')
+def get_storage_series(period='month', group_by=None, start_date=None, end_date=None):
+    # (period, group, documents, bytes): active documents and their bytes at
+    # the end of each period with any change, running sums of the daily
+    # 'storage' deltas. Periods before start_date still count towards totals.
+    group = {None: "''", 'category': 'a.category_id', 'department': 'a.department'}[group_by]
+    conditions, params = _analytics_range('a.day', None, end_date)
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f'''SELECT period, grp,
+                                  SUM(documents) OVER (PARTITION BY grp ORDER BY period) as documents,
+                                  SUM(bytes) OVER (PARTITION BY grp ORDER BY period) as bytes
+                           FROM (SELECT {_analytics_period('a.day', period)} as period, {group} as grp,
+                                        SUM(a.documents) as documents, SUM(a.bytes) as bytes
+                                 FROM analytics_daily a WHERE a.kind = 'storage' AND {' AND '.join(conditions)}
+                                 GROUP BY period, grp)
+                           ORDER BY period, grp''', params)
+        results = [row for row in cursor.fetchall() if not start_date or row['period'] >= str(start_date)]
+    return results
+
+@_cached('activity', 'documents')
+def get_activity_series(period='week', group_by='department', start_date=None, end_date=None, action=None):
+    # (period, group, events) per period from activity_daily; group_by is
+    # None, 'department' or 'action'
+    group = {None: "''", 'department': 'department', 'action': 'action'}[group_by]
+    conditions, params = _analytics_range('day', start_date, end_date)
+    if action:
+        conditions.append('action = ?')
+        params.append(action)
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f'''SELECT {_analytics_period('day', period)} as period, {group} as grp, SUM(events) as events
+                           FROM activity_daily WHERE {' AND '.join(conditions)}
+                           GROUP BY period, grp ORDER BY period, grp''', params)
+        results = cursor.fetchall()
+    return results
+
+@_cached('analytics')
+def get_compliance_series(start_date=None, end_date=None):
+    # Daily snapshots with the share of review and expiry deadlines not yet passed
+    conditions, params = _analytics_range('day', start_date, end_date)
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f'''SELECT day, reviews, reviews_overdue, expiries, expired,
+                                  CASE WHEN reviews > 0 THEN 1.0 - reviews_overdue * 1.0 / reviews END as review_rate,
+                                  CASE WHEN expiries > 0 THEN 1.0 - expired * 1.0 / expiries END as expiry_rate
+                           FROM compliance_daily WHERE {' AND '.join(conditions)} ORDER BY day''', params)
+        results = cursor.fetchall()
+    return results
+
+# Small lookup tables that are fine to scan in full (activity_archives has one
+# row per archived month)
+PLAN_SCAN_ALLOWED_TABLES = {'categories', 'c', 'activity_archives'}
+
+def _plan_scans_table(detail, derived=()):
+    # derived holds the names of materialized and co-routine subqueries,
+    # which are temporary results rather than tables
+    if not detail.startswith('SCAN ') or detail == 'SCAN CONSTANT ROW':
+        return False
+    table = detail.split()[1]
+    if table.startswith('(subquery') or table in derived:
+        return False
+    if 'USING' in detail or 'VIRTUAL TABLE INDEX' in detail:
+        return False
+    return table not in PLAN_SCAN_ALLOWED_TABLES
+
+def check_query_plans():
+    # Runs each read function, captures the SELECTs it issues and returns
+    # (function name, sql, plan lines, uses_index) for every statement.
+    global _statement_observer
+    read_calls = [
+        ('get_all_documents', lambda: get_all_documents()),
+        ('get_all_documents(category)', lambda: get_all_documents(category_id=1, limit=6)),
+        ('get_all_documents(search)', lambda: get_all_documents(search_term='policy')),
+        ('get_all_documents(page)', lambda: get_all_documents(limit=21, after=('2024-01-01', 10))),
+        ('get_all_documents(title page)',
+         lambda: get_all_documents(category_id=1, limit=21, after=('Fire', 10), order='title')),
+        ('count_documents', lambda: count_documents(category_id=1)),
+        ('get_all_documents(filters)',
+         lambda: get_all_documents(limit=21, filters=DocumentFilter(file_types='Word', created_from='2024-01-01'))),
+        ('get_all_documents(uploader)', lambda: get_all_documents(limit=21, filters=DocumentFilter(uploaded_by='Admin'))),
+        ('get_all_documents(tags)',
+         lambda: get_all_documents(limit=21, filters=DocumentFilter(tags_all=('fire', 'annual')))),
+        ('count_documents(tags)', lambda: count_documents(filters=DocumentFilter(tags_any=('fire', 'safety')))),
+        ('get_search_facets', lambda: get_search_facets(search_term='policy', filters=DocumentFilter(file_types='PDF'))),
+        ('get_search_facets(category)', lambda: get_search_facets(category_id=1)),
+        ('get_upload_series', lambda: get_upload_series('week', group_by='category', start_date='2024-01-01')),
+        ('get_upload_series(versions)', lambda: get_upload_series('month', kind='version')),
+        ('get_storage_series', lambda: get_storage_series('month', group_by='department')),
+        ('get_activity_series', lambda: get_activity_series('week', start_date='2024-01-01', action='download')),
+        ('get_compliance_series', get_compliance_series),
+        ('get_tag_counts', lambda: get_tag_counts(category_id=1)),
+        ('get_tag_counts_by_category', get_tag_counts_by_category),
+        ('count_documents(filters)', lambda: count_documents(filters=DocumentFilter(department='Care', has_expiry=True))),
+        ('search_documents(filters)',
+         lambda: search_documents('policy', limit=21, filters=DocumentFilter(file_types='PDF'))),
+        ('search_documents', lambda: search_documents('fire "risk assessment"', category_id=1)),
+        ('search_documents(page)', lambda: search_documents('policy', limit=21, after=(-1.5, 10))),
+        ('get_pending_extractions', lambda: get_pending_extractions(8, exclude=(1, 2))),
+        ('get_document_by_id', lambda: get_document_by_id(1)),
+        ('get_category_stats', get_category_stats),
+        ('get_categories', get_categories),
+        ('get_expiring_documents', lambda: get_expiring_documents(30)),
+        ('get_documents_for_review', lambda: get_documents_for_review(30)),
+        ('get_next_deadlines', lambda: get_next_deadlines(10)),
+        ('get_deadline_counts', get_deadline_counts),
+        ('get_last_digest_run', get_last_digest_run),
+        ('get_documents_changed_since', lambda: get_documents_changed_since('2024-01-01 00:00:00')),
+        ('get_digest_alerts', lambda: get_digest_alerts((1, 2, 3))),
+        ('get_document_versions', lambda: get_document_versions(1)),
+        ('get_version_summaries', lambda: get_version_summaries((1, 2, 3))),
+        ('get_version_storage_stats', get_version_storage_stats),
+        ('get_recent_activity', lambda: get_recent_activity(50)),
+        ('search_activity', lambda: search_activity('2024-01-01', '2024-03-31', user='Admin')),
+        ('search_activity(document page)',
+         lambda: search_activity(document_id=1, limit=101, after=('2024-03-01 12:00:00', 500))),
+        ('search_activity(action)', lambda: search_activity(action='download', end_date='2024-03-31')),
+        ('search_activity(page)', lambda: search_activity(limit=101, after=('2024-03-01 12:00:00', 500))),
+        ('get_activity_archives', get_activity_archives),
+        ('get_dashboard_stats', get_dashboard_stats),
+        ('collect_garbage', lambda: collect_garbage(timedelta(days=36500))),
+    ]
+    results = []
+    for name, call in read_calls:
+        statements = []
+        clear_query_cache()
+        _statement_observer = statements.append
+        try:
+            call()
+        finally:
+            _statement_observer = None
+        with connection() as conn:
+            for sql in statements:
+                if not sql.lstrip().upper().startswith('SELECT'):
+                    continue
+                # FTS5 reads its own shadow tables with schema-qualified SQL
+                if "'main'." in sql:
+                    continue
+                plan = [row['detail'] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql)]
+                derived = {detail.split()[1] for detail in plan if detail.startswith(('MATERIALIZE ', 'CO-ROUTINE '))}
+                uses_index = not any(_plan_scans_table(detail, derived) for detail in plan)
+                results.append((name, ' '.join(sql.split()), plan, uses_index))
+    return results
+
 init_database()
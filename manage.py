@@ -0,0 +1,197 @@
+"""
+Maintenance Commands for Care Home Document Management System
+Run with: python manage.py <command>
+"""
+
+import argparse
+import os
+from datetime import timedelta
+
+import bulk_import
+import compliance_digest
+import database as db
+import text_extraction
+
+
+def gc_blobs(args):
+    """Remove stored payloads no longer referenced by any document"""
+    freed = db.collect_garbage(timedelta(days=args.grace_days))
+    print(f"🗑️ Removed {freed['blobs']} unreferenced blobs ({freed['bytes']:,} bytes)")
+
+
+def externalize_blobs(args):
+    """Move payloads embedded in the database into the blob store"""
+    moved = db.externalize_inline_payloads()
+    print(f"📦 Moved {moved} embedded payloads to {db.BLOB_STORE_PATH}")
+    if moved:
+        print("Run VACUUM on the database to reclaim the freed space")
+
+
+def rebuild_search(args):
+    """Rebuild the full-text search index from the documents table"""
+    indexed = db.rebuild_search_index()
+    print(f"🔍 Indexed {indexed} documents for search")
+
+
+def extract_text(args):
+    """Extract searchable text from every document still waiting for it"""
+    queued = db.queue_missing_text_extractions()
+    processed = text_extraction.ExtractionPipeline(workers=args.workers).run_pending()
+    print(f"📝 Queued {queued} new documents, extracted text from {processed}")
+    for status, row in db.get_extraction_stats().items():
+        print(f"   {status}: {row['count']} (avg {row['avg_ms'] or 0:.0f} ms)")
+
+
+def compact_versions(args):
+    """Store earlier document versions as compressed, deduplicated chunks"""
+    converted = db.compact_versions()
+    print(f"🗂️ Converted {converted} earlier versions to chunked storage")
+    for row in db.get_version_storage_stats():
+        saved = 1 - row['stored_bytes'] / row['version_bytes'] if row['version_bytes'] else 0
+        print(f"   {row['title']}: {row['versions']} versions, {row['version_bytes']:,} bytes "
+              f"stored in {row['stored_bytes']:,} ({saved:.0%} saved)")
+
+
+def archive_activity(args):
+    """Move activity older than the live window into compressed monthly archives"""
+    archived = db.archive_activity(live_months=args.live_months)
+    print(f"🗄️ Archived {len(archived)} months of activity to {db.ACTIVITY_ARCHIVE_PATH}")
+    for month, rows in archived:
+        print(f"   {month}: {rows:,} entries")
+
+
+def rebuild_analytics(args):
+    """Recompute the Analytics rollups from documents and the full activity history"""
+    events = db.rebuild_analytics()
+    db.record_compliance_snapshot()
+    print(f"📊 Rebuilt analytics rollups covering {events:,} activity events")
+
+
+def digest(args):
+    """Report compliance deadlines that came up or became overdue since the last digest"""
+    notifiers = [compliance_digest.FileNotifier(args.output)]
+    if args.email_to and args.smtp_host:
+        notifiers.append(compliance_digest.SMTPNotifier(args.smtp_host, args.smtp_port, args.email_from,
+                                                        args.email_to))
+    elif args.email_to:
+        notifiers.append(compliance_digest.OutboxNotifier(os.path.join(args.output, 'outbox'),
+                                                          args.email_from, args.email_to))
+    
+    def report(result, sent, error):
+        if error is not None:
+            print(f"❌ Digest failed, retrying next run: {type(error).__name__}: {error}")
+        elif sent:
+            print(f"📬 {result.subject} → {', '.join(sent)}")
+        else:
+            print(f"📭 No deadline changes up to {result.horizon_date}")
+    
+    if args.every:
+        compliance_digest.run_forever(notifiers, args.every * 60, horizon_days=args.days, report=report)
+    else:
+        result, sent = compliance_digest.run_digest(notifiers, horizon_days=args.days, send_empty=args.always)
+        report(result, sent, None)
+
+
+def import_files(args):
+    """Import a shared-drive folder or ZIP archive, mapping top-level folders to categories"""
+    category_map = dict(mapping.split('=', 1) for mapping in args.map)
+    
+    def report(totals):
+        print(f"   {totals['imported']:,} files, {totals['bytes']:,} bytes "
+              f"({totals['files_per_second']:.1f} files/sec)")
+    
+    totals = bulk_import.import_source(args.source, uploaded_by=args.user, category_map=category_map,
+                                       workers=args.workers, batch_size=args.batch_size, progress=report)
+    print(f"📥 Imported {totals['imported']:,} of {totals['found']:,} files in {totals['seconds']:.1f}s "
+          f"({totals['files_per_second']:.1f} files/sec); {totals['skipped']:,} already imported")
+    if totals['uncategorized_folders']:
+        print(f"   No category for folders: {', '.join(totals['uncategorized_folders'])} (use --map)")
+    for path, error in totals['failed']:
+        print(f"   ❌ {path}: {error}")
+    if totals['failed']:
+        raise SystemExit(f"{len(totals['failed'])} files could not be imported; run again to retry them")
+
+
+def check_plans(args):
+    """Verify with EXPLAIN QUERY PLAN that every read query uses an index"""
+    failures = 0
+    for name, sql, plan, uses_index in db.check_query_plans():
+        status = "✅" if uses_index else "❌"
+        failures += not uses_index
+        print(f"{status} {name}")
+        if args.verbose or not uses_index:
+            print(f"   {sql}")
+            for detail in plan:
+                print(f"   → {detail}")
+    if failures:
+        raise SystemExit(f"{failures} queries scan a table without an index")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Document database maintenance")
+    commands = parser.add_subparsers(dest="command", required=True)
+    
+    gc_parser = commands.add_parser("gc-blobs", help=gc_blobs.__doc__)
+    gc_parser.add_argument("--grace-days", type=float, default=db.BLOB_GC_GRACE_PERIOD.days,
+                           help="Keep unreferenced blobs for this many days")
+    gc_parser.set_defaults(handler=gc_blobs)
+    
+    externalize_parser = commands.add_parser("externalize-blobs", help=externalize_blobs.__doc__)
+    externalize_parser.set_defaults(handler=externalize_blobs)
+    
+    search_parser = commands.add_parser("rebuild-search", help=rebuild_search.__doc__)
+    search_parser.set_defaults(handler=rebuild_search)
+    
+    extract_parser = commands.add_parser("extract-text", help=extract_text.__doc__)
+    extract_parser.add_argument("--workers", type=int, default=text_extraction.EXTRACTION_WORKERS,
+                                help="Number of extraction processes")
+    extract_parser.set_defaults(handler=extract_text)
+    
+    versions_parser = commands.add_parser("compact-versions", help=compact_versions.__doc__)
+    versions_parser.set_defaults(handler=compact_versions)
+    
+    archive_parser = commands.add_parser("archive-activity", help=archive_activity.__doc__)
+    archive_parser.add_argument("--live-months", type=int, default=db.ACTIVITY_LIVE_MONTHS,
+                                help="Calendar months, including the current one, kept in the live table")
+    archive_parser.set_defaults(handler=archive_activity)
+    
+    analytics_parser = commands.add_parser("rebuild-analytics", help=rebuild_analytics.__doc__)
+    analytics_parser.set_defaults(handler=rebuild_analytics)
+    
+    digest_parser = commands.add_parser("digest", help=digest.__doc__)
+    digest_parser.add_argument("--days", type=int, default=compliance_digest.DIGEST_HORIZON_DAYS,
+                               help="Report deadlines due within this many days")
+    digest_parser.add_argument("--output", default=compliance_digest.DIGEST_PATH,
+                               help="Folder digest reports are written to")
+    digest_parser.add_argument("--email-to", action="append", default=[], metavar="ADDRESS",
+                               help="Also email the digest to this address")
+    digest_parser.add_argument("--email-from", default="compliance@localhost", help="Sender address")
+    digest_parser.add_argument("--smtp-host",
+                               help="Send email through this server (default: save it to OUTPUT/outbox)")
+    digest_parser.add_argument("--smtp-port", type=int, default=25)
+    digest_parser.add_argument("--always", action="store_true", help="Write a digest even when nothing changed")
+    digest_parser.add_argument("--every", type=float, metavar="MINUTES",
+                               help="Keep running, producing a digest at this interval")
+    digest_parser.set_defaults(handler=digest)
+    
+    import_parser = commands.add_parser("import", help=import_files.__doc__)
+    import_parser.add_argument("source", help="Folder or .zip archive to import")
+    import_parser.add_argument("--map", action="append", default=[], metavar="FOLDER=CATEGORY",
+                               help="Import a folder into the named category")
+    import_parser.add_argument("--user", default="Bulk Import", help="Name recorded as the uploader")
+    import_parser.add_argument("--workers", type=int, default=bulk_import.IMPORT_WORKERS,
+                               help="Threads hashing and storing files")
+    import_parser.add_argument("--batch-size", type=int, default=bulk_import.IMPORT_BATCH_SIZE,
+                               help="Documents inserted per transaction")
+    import_parser.set_defaults(handler=import_files)
+    
+    plans_parser = commands.add_parser("check-plans", help=check_plans.__doc__)
+    plans_parser.add_argument("--verbose", action="store_true", help="Print every query plan")
+    plans_parser.set_defaults(handler=check_plans)
+    
+    args = parser.parse_args()
+    args.handler(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+"""
+Document Previews for Care Home Document Management System
+Renders small thumbnails of image uploads and first-page text previews of PDFs
+in a background thread after upload, and keeps them in a size-bounded on-disk
+cache keyed by content hash, so listings show what a file is without
+transferring it.
+"""
+
+import io
+import os
+import queue
+import tempfile
+import threading
+from collections import OrderedDict
+
+import database as db
+
+# Folder previews are cached in, and the most it may hold; the least recently
+# shown previews are evicted beyond that
+PREVIEW_CACHE_PATH = "preview_cache"
+PREVIEW_CACHE_MAX_BYTES = 200 * 1024 * 1024
+
+# Thumbnails fit within this many pixels and are saved as JPEG
+THUMBNAIL_SIZE = (320, 320)
+THUMBNAIL_QUALITY = 80
+
+# Characters of a PDF's first page kept as its preview
+PDF_PREVIEW_CHARS = 400
+
+# Files larger than this are not previewed
+PREVIEW_MAX_SOURCE_BYTES = 25 * 1024 * 1024
+
+# Dark background transparent images are flattened onto, matching the cards
+THUMBNAIL_BACKGROUND = (30, 41, 59)
+
+IMAGE_FILE_TYPES = {'jpg', 'jpeg', 'png', 'gif'}
+PREVIEW_FILE_TYPES = IMAGE_FILE_TYPES | {'pdf'}
+
+
+def _render_image(data):
+    from PIL import Image
+
+    with Image.open(io.BytesIO(data)) as image:
+        image.seek(0)
+        image.thumbnail(THUMBNAIL_SIZE)
+        image = image.convert('RGBA')
+        flattened = Image.new('RGB', image.size, THUMBNAIL_BACKGROUND)
+        flattened.paste(image, mask=image.getchannel('A'))
+    output = io.BytesIO()
+    flattened.save(output, 'JPEG', quality=THUMBNAIL_QUALITY, optimize=True)
+    return output.getvalue()
+
+
+def _render_pdf(data):
+    from PyPDF2 import PdfReader
+
+    reader = PdfReader(io.BytesIO(data))
+    if not reader.pages:
+        return b''
+    text = reader.pages[0].extract_text() or ''
+    return ' '.join(text.split())[:PDF_PREVIEW_CHARS].encode('utf-8')
+
+
+def render_preview(data, file_type):
+    """Return (kind, bytes) for a file: 'image' JPEG bytes or 'text' UTF-8 bytes"""
+    file_type = (file_type or '').lower()
+    if file_type in IMAGE_FILE_TYPES:
+        return 'image', _render_image(data)
+    if file_type == 'pdf':
+        return 'text', _render_pdf(data)
+    raise ValueError(f"No preview for file type '{file_type}'")
+
+
+class PreviewCache:
+    """Previews on disk keyed by content hash, evicting the least recently used beyond max_bytes"""
+
+    EXTENSIONS = {'image': '.jpg', 'text': '.txt'}
+
+    def __init__(self, directory=PREVIEW_CACHE_PATH, max_bytes=PREVIEW_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._entries = None  # content hash -> (path, size), least recently used first
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, content_hash):
+        # (kind, bytes) of a cached preview, or None
+        with self._lock:
+            self._load()
+            entry = self._entries.get(content_hash)
+            if entry is None:
+                return None
+            self._entries.move_to_end(content_hash)
+        path = entry[0]
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            # The modification time orders entries when the cache is reloaded
+            os.utime(path)
+        except OSError:
+            self._forget(content_hash)
+            return None
+        kind = next(kind for kind, extension in self.EXTENSIONS.items() if path.endswith(extension))
+        return kind, data
+
+    def put(self, content_hash, kind, data):
+        folder = os.path.join(self.directory, content_hash[:2])
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, content_hash + self.EXTENSIONS[kind])
+        fd, temp_path = tempfile.mkstemp(dir=folder, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+        with self._lock:
+            self._load()
+            previous = self._entries.pop(content_hash, None)
+            if previous is not None:
+                self._size -= previous[1]
+            self._entries[content_hash] = (path, len(data))
+            self._size += len(data)
+            evicted = []
+            while self._size > self.max_bytes and len(self._entries) > 1:
+                _, (old_path, old_size) = self._entries.popitem(last=False)
+                self._size -= old_size
+                evicted.append(old_path)
+        for old_path in evicted:
+            try:
+                os.remove(old_path)
+            except OSError:
+                pass
+
+    def stats(self):
+        with self._lock:
+            self._load()
+            return {'entries': len(self._entries), 'bytes': self._size, 'max_bytes': self.max_bytes}
+
+    def _forget(self, content_hash):
+        with self._lock:
+            entry = self._entries.pop(content_hash, None)
+            if entry is not None:
+                self._size -= entry[1]
+
+    def _load(self):
+        # Builds the index from the files on disk on first use; called with the lock held
+        if self._entries is not None:
+            return
+        found = []
+        if os.path.isdir(self.directory):
+            for folder in os.scandir(self.directory):
+                if not folder.is_dir():
+                    continue
+                for entry in os.scandir(folder.path):
+                    name, extension = os.path.splitext(entry.name)
+                    if extension in self.EXTENSIONS.values():
+                        stat = entry.stat()
+                        found.append((stat.st_mtime, name, entry.path, stat.st_size))
+        found.sort()
+        self._entries = OrderedDict((name, (path, size)) for _, name, path, size in found)
+        self._size = sum(size for _, _, _, size in found)
+
+
+class PreviewWorker:
+    """Renders previews of new uploads, and of documents shown without one, in a background thread"""
+
+    def __init__(self, cache):
+        self.cache = cache
+        self._queue = queue.Queue()
+        self._pending = set()
+        # Content hashes that could not be previewed, so they are not retried
+        self._failed = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        db.on_document_added(self.enqueue)
+        self._thread = threading.Thread(target=self._run, name='previews', daemon=True)
+        self._thread.start()
+
+    def enqueue(self, doc_id):
+        with self._lock:
+            if doc_id in self._pending:
+                return
+            self._pending.add(doc_id)
+        self._queue.put(doc_id)
+
+    def get(self, doc):
+        """Cached (kind, bytes) preview of a document row, queueing it when missing"""
+        if not self.can_preview(doc):
+            return None
+        preview = self.cache.get(doc['content_hash'])
+        if preview is None and self._thread is not None:
+            self.enqueue(doc['id'])
+        return preview
+
+    def can_preview(self, doc):
+        return (bool(doc['content_hash']) and (doc['file_type'] or '').lower() in PREVIEW_FILE_TYPES
+                and (doc['file_size'] or 0) <= PREVIEW_MAX_SOURCE_BYTES and doc['content_hash'] not in self._failed)
+
+    def render(self, doc_id):
+        # Renders and caches one document's preview; returns True if one was stored
+        doc = db.get_document_by_id(doc_id)
+        if doc is None or not self.can_preview(doc) or self.cache.get(doc['content_hash']) is not None:
+            return False
+        data = db.get_document_data(doc_id)
+        if data is None:
+            return False
+        try:
+            kind, preview = render_preview(data, doc['file_type'])
+        except Exception:
+            # Unreadable files, and a missing Pillow or PyPDF2, are not retried
+            # until the app restarts
+            self._failed.add(doc['content_hash'])
+            return False
+        self.cache.put(doc['content_hash'], kind, preview)
+        return True
+
+    def _run(self):
+        while True:
+            doc_id = self._queue.get()
+            try:
+                self.render(doc_id)
+            except Exception:
+                pass
+            finally:
+                with self._lock:
+                    self._pending.discard(doc_id)
+
+
+_worker = PreviewWorker(PreviewCache())
+
+
+def start_previews():
+    """Start rendering previews of new uploads in the background"""
+    _worker.start()
+    return _worker
+
+
+def get_preview(doc):
+    """Cached (kind, bytes) preview of a document row, or None while it is being rendered"""
+    return _worker.get(doc)
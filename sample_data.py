@@ -202,6 +202,7 @@ def generate_sample_data():
     ]
     
     # Add documents with varied dates
+    documents = []
     for doc in sample_documents:
         # Random past date for creation (within last 6 months)
         days_ago = random.randint(7, 180)
@@ -218,22 +219,21 @@ def generate_sample_data():
         
         # Generate dummy file content
         file_content = f"This is a placeholder for: {doc['title']}\n\nGenerated for demonstration purposes.".encode()
-        file_type = doc['file_name'].split('.')[-1]
         
-        # Add to database
-        db.add_document(
-            title=doc['title'],
-            description=doc['description'],
-            category_id=category_dict.get(doc['category']),
-            file_name=doc['file_name'],
-            file_type=file_type,
-            file_size=len(file_content),
-            file_data=file_content,
-            uploaded_by='System Admin',
-            review_date=review_date,
-            expiry_date=expiry_date,
-            tags=[doc['category'].lower().replace(' ', '-'), 'sample']
-        )
+        documents.append({
+            'title': doc['title'],
+            'description': doc['description'],
+            'category_id': category_dict.get(doc['category']),
+            'file_name': doc['file_name'],
+            'file_type': doc['file_name'].split('.')[-1],
+            'file_data': file_content,
+            'review_date': review_date,
+            'expiry_date': expiry_date,
+            'tags': [doc['category'].lower().replace(' ', '-'), 'sample']
+        })
+    
+    # One batched transaction for the whole set
+    db.add_documents(documents, uploaded_by='System Admin')
     
     print(f"✅ Added {len(sample_documents)} sample documents to the database")
 
@@ -0,0 +1,22 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    """A freshly migrated database, blob store and activity archive under tmp_path"""
+    # Importing the module creates documents.db in the working directory
+    monkeypatch.chdir(tmp_path)
+    import database as db
+    monkeypatch.setattr(db, 'DATABASE_PATH', str(tmp_path / 'documents.db'))
+    monkeypatch.setattr(db, 'ACTIVITY_ARCHIVE_PATH', str(tmp_path / 'activity_archive'))
+    store = db.get_blob_store()
+    db.set_blob_store(db.FileSystemBlobStore(str(tmp_path / 'blob_store')))
+    db.init_database()
+    yield db
+    db.set_blob_store(store)
+    db.get_pool().close_all()
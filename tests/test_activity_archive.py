@@ -0,0 +1,61 @@
+import os
+
+import pytest
+
+
+def log_at(db, created_at, user='alice', action='view'):
+    with db.connection() as conn:
+        conn.execute('INSERT INTO activity_log (user, action, created_at) VALUES (?, ?, ?)',
+                     (user, action, created_at))
+
+
+def archive_files(db):
+    return sorted(os.listdir(db.ACTIVITY_ARCHIVE_PATH))
+
+
+def test_archive_moves_old_months_out_of_the_live_table(database):
+    log_at(database, '2020-01-05 10:00:00')
+    log_at(database, '2020-02-05 10:00:00')
+    assert database.archive_activity() == [('2020-01', 1), ('2020-02', 1)]
+    with database.connection() as conn:
+        assert conn.execute('SELECT COUNT(*) FROM activity_log').fetchone()[0] == 0
+    assert len(database.search_activity(start_date='2020-01-01', end_date='2020-02-29')) == 2
+
+
+def test_interrupted_rebuild_keeps_the_recorded_archive(database, monkeypatch):
+    log_at(database, '2020-01-05 10:00:00')
+    database.archive_activity()
+    recorded = archive_files(database)
+    # A late row for the archived month, whose rebuild fails before it commits
+    log_at(database, '2020-01-20 10:00:00', user='bob')
+    
+    def fail(*args):
+        raise database.sqlite3.OperationalError('disk I/O error')
+    
+    record_keys = database._record_activity_archive_keys
+    monkeypatch.setattr(database, '_record_activity_archive_keys', fail)
+    with pytest.raises(database.sqlite3.OperationalError):
+        database.archive_activity()
+    assert archive_files(database) == recorded
+    assert len(database.search_activity(start_date='2020-01-01', end_date='2020-01-31')) == 2
+    
+    monkeypatch.setattr(database, '_record_activity_archive_keys', record_keys)
+    assert database.archive_activity() == [('2020-01', 2)]
+    assert len(archive_files(database)) == 1 and archive_files(database) != recorded
+    with database.connection() as conn:
+        assert conn.execute('SELECT COUNT(*) FROM activity_log').fetchone()[0] == 0
+    assert [row['user'] for row in database.search_activity(start_date='2020-01-01', end_date='2020-01-31')] == \
+        ['bob', 'alice']
+
+
+def test_damaged_archive_is_skipped_rather_than_retried(database):
+    log_at(database, '2020-01-05 10:00:00')
+    database.archive_activity()
+    with open(os.path.join(database.ACTIVITY_ARCHIVE_PATH, archive_files(database)[0]), 'ab') as f:
+        f.write(b'damage')
+    log_at(database, '2020-01-20 10:00:00')
+    log_at(database, '2020-02-05 10:00:00')
+    # Returns rather than retrying the damaged month, and archives the next one
+    assert database.archive_activity() == [('2020-02', 1)]
+    with database.connection() as conn:
+        assert conn.execute('SELECT created_at FROM activity_log').fetchall()[0][0] == '2020-01-20 10:00:00'
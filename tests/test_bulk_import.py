@@ -0,0 +1,38 @@
+import io
+
+import pytest
+
+
+def stored_row(db, data, title='Imported'):
+    content_hash, file_size, stored_size = db.store_payload(data, 'txt')
+    return {'title': title, 'file_name': 'imported.txt', 'file_type': 'txt', 'content_hash': content_hash,
+            'file_size': file_size, 'stored_size': stored_size}
+
+
+def test_payload_removed_before_the_batch_is_restored(database):
+    row = stored_row(database, b'imported text')
+    # The garbage collector removed the stored copy before the batch commits
+    database.get_blob_store().delete(row['content_hash'])
+    row['open'] = lambda: io.BytesIO(b'imported text')
+    [doc_id] = database.add_documents([row], 'admin')
+    assert database.get_document_data(doc_id) == b'imported text'
+
+
+def test_batch_without_a_way_to_restore_a_payload_is_rolled_back(database):
+    row = stored_row(database, b'imported text')
+    database.get_blob_store().delete(row['content_hash'])
+    with pytest.raises(FileNotFoundError):
+        database.add_documents([row], 'admin')
+    assert database.count_documents() == 0
+
+
+def test_import_folder(database, tmp_path):
+    import bulk_import
+    
+    folder = tmp_path / 'shared' / 'Policies'
+    folder.mkdir(parents=True)
+    (folder / 'fire_safety.txt').write_bytes(b'fire safety')
+    totals = bulk_import.import_source(str(tmp_path / 'shared'), workers=1)
+    assert totals['imported'] == 1
+    [doc] = database.get_all_documents()
+    assert doc['title'] == 'fire safety' and database.get_document_data(doc['id']) == b'fire safety'
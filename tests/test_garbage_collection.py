@@ -0,0 +1,50 @@
+import os
+import time
+from datetime import timedelta
+
+
+def age(path, days):
+    old = time.time() - days * 24 * 3600
+    os.utime(path, (old, old))
+
+
+def test_unreferenced_blob_is_removed_after_the_grace_period(database):
+    doc_id = database.add_document('Policy', '', None, 'policy.txt', 'txt', 4, b'text', 'admin')
+    content_hash = database.get_document_by_id(doc_id)['content_hash']
+    database.delete_document(doc_id, 'admin')
+    with database.connection() as conn:
+        conn.execute("UPDATE blobs SET released_at = datetime('now', '-8 days')")
+    assert database.collect_garbage()['blobs'] == 1
+    assert not database.get_blob_store().exists(content_hash)
+
+
+def test_files_without_a_blobs_row_are_removed_once_old(database):
+    store = database.get_blob_store()
+    # Stored by puts whose document insert never committed
+    old_hash = database.store_payload(b'old orphan')[0]
+    new_hash = database.store_payload(b'new orphan')[0]
+    kept = database.add_document('Policy', '', None, 'policy.txt', 'txt', 4, b'kept', 'admin')
+    kept_hash = database.get_document_by_id(kept)['content_hash']
+    tmp_path = os.path.join(store.root, 'tmp', 'leftover')
+    with open(tmp_path, 'wb') as f:
+        f.write(b'partial')
+    for content_hash in (old_hash, kept_hash):
+        for _, path in store.stored_files():
+            if os.path.basename(path).startswith(content_hash):
+                age(path, 8)
+    age(tmp_path, 8)
+    
+    assert database.collect_garbage(timedelta(days=7))['blobs'] == 2
+    assert not store.exists(old_hash) and not os.path.exists(tmp_path)
+    assert store.exists(new_hash) and store.exists(kept_hash)
+    assert database.get_document_data(kept) == b'kept'
+
+
+def test_reusing_an_orphan_restarts_its_grace_period(database):
+    store = database.get_blob_store()
+    content_hash = database.store_payload(b'orphan')[0]
+    [path] = [path for hash_, path in store.stored_files() if hash_ == content_hash]
+    age(path, 8)
+    database.store_payload(b'orphan')
+    assert database.collect_garbage()['blobs'] == 0
+    assert store.exists(content_hash)
@@ -0,0 +1,20 @@
+import pytest
+
+
+def add(db, title):
+    return db.add_document(title, '', None, 'file.txt', 'txt', 4, b'text', 'admin')
+
+
+@pytest.mark.parametrize('term', ['&', '-', ' - & ', '"&"', '__'])
+def test_punctuation_only_input_builds_no_query(database, term):
+    assert database.build_search_query(term) is None
+
+
+def test_punctuation_words_are_dropped(database):
+    assert database.build_search_query('fire & safety') == database.build_search_query('fire safety')
+
+
+@pytest.mark.parametrize('term', ['Health & Safety', 'fire & safety', 'fire - safety', 'safety -'])
+def test_punctuation_words_do_not_hide_matches(database, term):
+    doc_id = add(database, 'Health & Safety Handbook fire')
+    assert [row['id'] for row in database.search_documents(term)] == [doc_id]
@@ -0,0 +1,11 @@
+def test_missing_payload_is_recorded_as_failed(database):
+    import text_extraction
+    
+    doc_id = database.add_document('Policy', '', None, 'policy.txt', 'txt', 4, b'text', 'admin')
+    database.get_blob_store().delete(database.get_document_by_id(doc_id)['content_hash'])
+    database.queue_text_extraction(doc_id)
+    pipeline = text_extraction.ExtractionPipeline(workers=1)
+    assert pipeline.run_pending() == 1
+    with database.connection() as conn:
+        row = conn.execute('SELECT status, error FROM document_text WHERE document_id = ?', (doc_id,)).fetchone()
+    assert row['status'] == 'failed' and row['error'].startswith('FileNotFoundError')
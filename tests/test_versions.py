@@ -0,0 +1,18 @@
+import os
+
+
+def test_replaced_payload_is_kept_as_chunks(database):
+    first = os.urandom(200 * 1024)
+    doc_id = database.add_document('Policy', '', None, 'policy.bin', 'bin', len(first), first, 'admin')
+    assert database.add_document_version(doc_id, 'policy.bin', 'bin', 5, b'short', 'admin') == 2
+    # Re-issuing the first file again stores none of its chunks twice
+    assert database.add_document_version(doc_id, 'policy.bin', 'bin', len(first), first, 'admin') == 3
+    assert database.add_document_version(doc_id, 'policy.bin', 'bin', 5, b'other', 'admin') == 4
+    versions = {row['version']: row for row in database.get_document_versions(doc_id)}
+    assert database.get_version_data(versions[1]['id']) == first
+    assert database.get_version_data(versions[3]['id']) == first
+    assert database.get_version_data(versions[2]['id']) == b'short'
+    assert versions[1]['chunk_count'] == 4
+    with database.connection() as conn:
+        assert conn.execute('SELECT COUNT(*) FROM version_chunks').fetchone()[0] == 5
+    assert database.get_document_data(doc_id) == b'other'
@@ -0,0 +1,243 @@
+"""
+Text Extraction Pipeline for Care Home Document Management System
+Extracts searchable text from uploaded PDF, Word, Excel, text and CSV files in
+a process pool, so large files never block the Streamlit script thread.
+"""
+
+import io
+import multiprocessing
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timezone
+
+import database as db
+
+# Worker processes used for extraction
+EXTRACTION_WORKERS = 2
+
+# Extracted text beyond this many characters is not indexed
+MAX_TEXT_CHARS = 1_000_000
+
+# Seconds the dispatcher sleeps when no new work has been signalled
+POLL_INTERVAL_SECONDS = 30
+
+# Workers are spawned rather than forked because the app process is threaded
+_MP_CONTEXT = multiprocessing.get_context('spawn')
+
+
+def _open_source(source):
+    """Open a worker source, which is either a file path or the file bytes"""
+    return open(source, 'rb') if isinstance(source, str) else io.BytesIO(source)
+
+
+def _extract_pdf(source):
+    from PyPDF2 import PdfReader
+
+    with _open_source(source) as stream:
+        reader = PdfReader(stream)
+        return '\n'.join(page.extract_text() or '' for page in reader.pages)
+
+
+def _extract_docx(source):
+    import docx
+
+    with _open_source(source) as stream:
+        document = docx.Document(stream)
+        paragraphs = [paragraph.text for paragraph in document.paragraphs]
+        for table in document.tables:
+            for row in table.rows:
+                paragraphs.append(' '.join(cell.text for cell in row.cells))
+        return '\n'.join(paragraphs)
+
+
+def _extract_xlsx(source):
+    from openpyxl import load_workbook
+
+    with _open_source(source) as stream:
+        workbook = load_workbook(stream, read_only=True, data_only=True)
+        lines = []
+        for sheet in workbook.worksheets:
+            lines.append(sheet.title)
+            for row in sheet.iter_rows(values_only=True):
+                values = [str(value) for value in row if value is not None]
+                if values:
+                    lines.append(' '.join(values))
+        workbook.close()
+        return '\n'.join(lines)
+
+
+def _extract_plain_text(source):
+    with _open_source(source) as stream:
+        return stream.read(MAX_TEXT_CHARS * 4).decode('utf-8', errors='replace')
+
+
+EXTRACTORS = {
+    'pdf': _extract_pdf,
+    'docx': _extract_docx,
+    'xlsx': _extract_xlsx,
+    'txt': _extract_plain_text,
+    'csv': _extract_plain_text,
+}
+
+
+def _timestamp(epoch_seconds):
+    return datetime.fromtimestamp(epoch_seconds, timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def extract_text(source, file_type):
+    """Extract text from a file; runs inside a worker process"""
+    started = time.time()
+    clock = time.perf_counter()
+    extractor = EXTRACTORS.get((file_type or '').lower())
+    result = {'status': 'unsupported', 'content': None, 'error': None,
+              'extractor': extractor.__name__.lstrip('_') if extractor else None}
+
+    if extractor:
+        try:
+            content = extractor(source)
+            result['status'] = 'done'
+            result['content'] = content[:MAX_TEXT_CHARS]
+        except ImportError as e:
+            result['status'] = 'unsupported'
+            result['error'] = f'Missing library: {e.name}'
+        except Exception as e:
+            result['status'] = 'failed'
+            result['error'] = f'{type(e).__name__}: {e}'
+
+    result['started_at'] = _timestamp(started)
+    result['finished_at'] = _timestamp(time.time())
+    result['duration_ms'] = int((time.perf_counter() - clock) * 1000)
+    return result
+
+
+class ExtractionPipeline:
+    """Feeds pending documents to a process pool and records the results"""
+
+    def __init__(self, workers=EXTRACTION_WORKERS):
+        self.workers = workers
+        self._executor = None
+        self._in_flight = set()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        # A pool left by a dispatcher thread that died is reused
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=_MP_CONTEXT)
+        db.on_document_added(self.enqueue)
+        db.queue_missing_text_extractions()
+        self._thread = threading.Thread(target=self._dispatch, name='text-extraction', daemon=True)
+        self._thread.start()
+
+    def enqueue(self, doc_id):
+        db.queue_text_extraction(doc_id)
+        self._wake.set()
+
+    def run_pending(self):
+        """Process the whole backlog and wait for it to finish; returns the number processed"""
+        processed = 0
+        with ProcessPoolExecutor(max_workers=self.workers, mp_context=_MP_CONTEXT) as executor:
+            while True:
+                batch = db.get_pending_extractions(self.workers * 4)
+                if not batch:
+                    break
+                futures = [(row['document_id'], self._submit(executor, row)) for row in batch]
+                for doc_id, future in futures:
+                    if future is not None:
+                        self._record(doc_id, future)
+                    processed += 1
+        return processed
+
+    def _source(self, row):
+        source = db.get_document_file_path(row['document_id'])
+        if source is None or not os.path.exists(source):
+            source = db.get_document_data(row['document_id']) or b''
+        return source, row['file_type']
+
+    def _submit(self, executor, row):
+        # Future extracting one pending document, or None when its file could
+        # not be read, which is recorded as a failed extraction
+        doc_id = row['document_id']
+        try:
+            source = self._source(row)
+        except sqlite3.Error:
+            raise
+        except Exception as e:
+            # A missing or unreadable payload; retrying would fail the same way
+            db.record_text_extraction(doc_id, 'failed', error=f'{type(e).__name__}: {e}')
+            return None
+        return executor.submit(extract_text, *source)
+
+    def _dispatch(self):
+        while True:
+            try:
+                self._fill_slots()
+            except (sqlite3.Error, OSError):
+                pass
+            self._wake.wait(POLL_INTERVAL_SECONDS)
+            self._wake.clear()
+
+    def _fill_slots(self):
+        # Keeps at most two jobs per worker queued so the backlog stays in the database
+        with self._lock:
+            slots = self.workers * 2 - len(self._in_flight)
+            exclude = tuple(self._in_flight)
+        if slots <= 0:
+            return
+        for row in db.get_pending_extractions(slots, exclude=exclude):
+            doc_id = row['document_id']
+            try:
+                future = self._submit(self._executor, row)
+            except BrokenProcessPool:
+                # A worker crashed; jobs already submitted fail through their
+                # futures, so replace the pool and retry on the next pass.
+                self._executor.shutdown(wait=False)
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=_MP_CONTEXT)
+                return
+            if future is None:
+                continue
+            with self._lock:
+                self._in_flight.add(doc_id)
+            future.add_done_callback(lambda f, doc_id=doc_id: self._finished(doc_id, f))
+
+    def _finished(self, doc_id, future):
+        try:
+            self._record(doc_id, future)
+        finally:
+            with self._lock:
+                self._in_flight.discard(doc_id)
+            self._wake.set()
+
+    def _record(self, doc_id, future):
+        try:
+            result = future.result()
+        except Exception as e:
+            # The worker process itself died (e.g. out of memory on a huge file)
+            db.record_text_extraction(doc_id, 'failed', error=f'{type(e).__name__}: {e}')
+            return
+        db.record_text_extraction(
+            doc_id,
+            result['status'],
+            content=result['content'],
+            extractor=result['extractor'],
+            error=result['error'],
+            started_at=result['started_at'],
+            finished_at=result['finished_at'],
+            duration_ms=result['duration_ms']
+        )
+
+
+_pipeline = ExtractionPipeline()
+
+
+def start_pipeline():
+    """Start background extraction for new uploads and any existing backlog"""
+    _pipeline.start()
+    return _pipeline